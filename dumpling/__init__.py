@@ -1,20 +1,82 @@
+import base64
+import bisect
+import copy
+import datetime
+import errno
+import functools
+import hashlib
+import io
+import itertools
+import json
+import os
+import subprocess
 import sys
+import threading
 import transaction
 import yaml
 
+from .cache import default_cache
+from .fulltext import FullTextIndex
+
 strtype = str  # XXX py3 only, need py2 too
 
 
 class Store(object):
-    _session = None
+    _snapshot = None
 
     """
     An instance of a Dumpling object store.
+
+    ``yaml_backend`` may be used to pin the YAML implementation used for
+    loading and saving objects, either ``'libyaml'`` or ``'python'``.  The
+    default is to use libyaml if it is available and fall back to the pure
+    Python implementation otherwise.  Either way, PyYAML's safe loader and
+    dumper are used.  Tuples, complex numbers and the other Python tagged
+    scalars which earlier versions stored are still supported, but values
+    stored as arbitrary Python objects, tagged ``!!python/object``, can't be
+    loaded.
+
+    ``cache`` is the :class:`dumpling.cache.ObjectCache` used to share decoded
+    objects across transactions.  The default is a cache shared by all stores
+    in the process.  Pass `False` to disable caching.
+
+    ``save_workers`` is the number of threads to use for serializing objects
+    when a commit writes at least ``save_threshold`` objects.  Smaller commits
+    are always serialized on the committing thread.  The default is to always
+    serialize on the committing thread.
+
+    ``format`` is the format in which objects are written, either ``'yaml'``,
+    the default, or ``'json'``, a compact format which is faster to load but
+    is not meant to be read by humans.  A model class may override the store's
+    format by setting a ``__dumpling_format__`` attribute.  Objects in either
+    format can always be read, regardless of the store's format.
+
+    If ``fulltext`` is true, the words in the string fields of stored objects
+    are indexed as they are saved, so that they may be found using the
+    ``search`` method of folders.
+
+    A store may be used by any number of threads.  Each thread has its own
+    session, for its current transaction.  The thread which creates the store
+    uses the `AcidFS` instance it was given, so that writing to it directly
+    joins the same transaction as the store's changes.  Since an `AcidFS`
+    instance only has a single session, every other thread uses its own copy
+    of it.
     """
-    def __init__(self, fs, factory=None, blobstore=None):
+    _save_executor = None
+
+    # Counts of serialized files written while saving, and of writes skipped
+    # because an object's file already had the same contents.
+    writes = 0
+    skipped_writes = 0
+
+    def __init__(self, fs, factory=None, blobstore=None, yaml_backend=None,
+                 cache=None, save_workers=None, save_threshold=100,
+                 format='yaml', fulltext=False):
         # Make sure dumpling comes before acidfs during transaction commit.
         fs.name = 'Dumpling.AcidFS'
-        self.fs = fs
+        self._fs = fs
+        self._thread = threading.current_thread()
+        self._local = threading.local()
         if factory is None:
             factory = Folder
         self.factory = factory
@@ -22,6 +84,18 @@ class Store(object):
             from .blob import FileSystemBlobStore  # avoid circular import
             blobstore = FileSystemBlobStore(blobstore)
         self.blobstore = blobstore
+        self.yaml = _yaml_backend(yaml_backend)
+        if cache is None:
+            cache = default_cache
+        elif cache is False:
+            cache = None
+        self.cache = cache
+        self.save_workers = save_workers
+        self.save_threshold = save_threshold
+        if format not in ('yaml', 'json'):
+            raise ValueError(u"Unknown format: {0}".format(format))
+        self.format = format
+        self.fulltext = fulltext
 
     def root(self):
         """
@@ -43,36 +117,290 @@ class Store(object):
         """
         self.session.flush()
 
+    def loads(self, data):
+        """
+        Decodes serialized data, in any supported format.
+        """
+        if data.startswith(_JSON_HEADER):
+            return _json_backend.load(data)
+        return self.yaml.load(data)
+
+    def backend_for(self, obj):
+        """
+        Returns the backend with which to serialize a stored object.
+        """
+        format = getattr(obj, '__dumpling_format__', None) or self.format
+        return _json_backend if format == 'json' else self.yaml
+
+    @property
+    def save_executor(self):
+        executor = self._save_executor
+        if executor is None and self.save_workers:
+            from concurrent.futures import ThreadPoolExecutor
+            self._save_executor = executor = ThreadPoolExecutor(
+                self.save_workers)
+        return executor
+
+    def snapshot(self, commit=None):
+        """
+        Returns the root object of a read only view of the store as it was at
+        `commit`, by default the most recent commit.  The view doesn't join
+        the current transaction and isn't affected by later commits.  Objects
+        in it can't be changed, so their changes aren't tracked, and they may
+        be shared by any number of threads.
+        """
+        if commit is None:
+            commit = _head_commit(self.fs)
+        return self._snapshot_root(commit)
+
+    def readonly_root(self):
+        """
+        Returns the root object of a read only view of the most recent commit,
+        as `snapshot` does.  The same view is returned to every caller, in any
+        thread, until another commit is made, so objects loaded by one reader
+        are shared with the others.
+        """
+        commit = _head_commit(self.fs)
+        snapshot = self._snapshot
+        if snapshot is None or snapshot[0] != commit:
+            self._snapshot = snapshot = (commit, self._snapshot_root(commit))
+        return snapshot[1]
+
+    def _snapshot_root(self, commit):
+        return _ReadOnlySession(self, commit).get_root(self.factory)
+
+    @property
+    def fs(self):
+        """
+        The filesystem for the current thread.
+        """
+        local = self._local
+        fs = getattr(local, 'fs', None)
+        if fs is None:
+            fs = self._fs
+            if (hasattr(fs, '_session') and
+                    threading.current_thread() is not self._thread):
+                fs = copy.copy(fs)
+                fs.session = None
+            local.fs = fs
+        return fs
+
     @property
     def session(self):
-        session = self._session
+        """
+        The session for the current thread's transaction.
+        """
+        local = self._local
+        session = getattr(local, 'session', None)
         if not session or session.closed:
-            self._session = session = _Session(self)
+            local.session = session = _Session(self)
             self.fs._session()   # Make acidfs join transaction
         return session
 
 
+class _YAMLBackend(object):
+    """
+    A pairing of YAML loader and dumper classes.
+    """
+
+    def __init__(self, name, loader, dumper):
+        self.name = name
+        self.loader = loader
+        self.dumper = dumper
+
+    def load(self, stream):
+        return yaml.load(stream, Loader=self.loader)
+
+    def dumps(self, obj):
+        return yaml.dump(obj, Dumper=self.dumper, default_flow_style=False,
+                         allow_unicode=True, encoding='utf-8')
+
+
+_yaml_backends = {
+    'python': _YAMLBackend('python', yaml.SafeLoader, yaml.SafeDumper),
+}
+
+if getattr(yaml, '__with_libyaml__', False):  # pragma no cover
+    _yaml_backends['libyaml'] = _YAMLBackend(
+        'libyaml', yaml.CSafeLoader, yaml.CSafeDumper)
+    _default_yaml_backend = 'libyaml'
+else:                                         # pragma no cover
+    _default_yaml_backend = 'python'
+
+
+def _yaml_backend(name):
+    if name is None:
+        name = _default_yaml_backend
+    backend = _yaml_backends.get(name)
+    if backend is None:
+        raise ValueError(u"YAML backend is not available: {0}".format(name))
+    return backend
+
+
+def _add_representer(type, representer):
+    for backend in _yaml_backends.values():
+        yaml.add_representer(type, representer, Dumper=backend.dumper)
+
+
+def _add_constructor(tag, constructor):
+    for backend in _yaml_backends.values():
+        yaml.add_constructor(tag, constructor, Loader=backend.loader)
+
+
+# Identifies files in the JSON format.  Since it is a comment in YAML, files
+# can keep the same names whatever their format.
+_JSON_HEADER = b'#dumpling:json\n'
+
+
+class _JSONBackend(object):
+    """
+    A compact, JSON based serialization format.  Models are represented as
+    JSON objects with their tag stored under the key, ``'!'``, and their fields
+    stored under the field names.  Other types which JSON cannot represent
+    directly are represented likewise using YAML's tags for them.
+    """
+    name = 'json'
+
+    def load(self, data):
+        return json.loads(data[len(_JSON_HEADER):].decode('utf-8'),
+                          object_hook=_json_decode)
+
+    def dumps(self, obj):
+        return _JSON_HEADER + json.dumps(
+            _json_encode(obj), ensure_ascii=False,
+            separators=(',', ':')).encode('utf-8')
+
+
+_json_backend = _JSONBackend()
+_models = {}
+
+
+def _json_encode(value):
+    if getattr(value, '__dumpling_model__', False):
+        data = _model_data(value)
+        for name, item in data.items():
+            data[name] = _json_encode(item)
+        data['!'] = value.__dumpling_tag__
+        return data
+    elif isinstance(value, dict):
+        if u'!' in value or not all(
+                isinstance(key, string_type) for key in value):
+            return {
+                u'!': u'!!map',
+                u'items': [[_json_encode(key), _json_encode(item)]
+                           for key, item in value.items()]}
+        return {key: _json_encode(item) for key, item in value.items()}
+    elif isinstance(value, (list, tuple, PersistentLog)):
+        return [_json_encode(item) for item in value]
+    elif isinstance(value, (set, frozenset)):
+        return {u'!': u'!!set',
+                u'items': [_json_encode(item) for item in value]}
+    elif isinstance(value, bytes) and PY3:
+        return {u'!': u'!!binary',
+                u'value': base64.b64encode(value).decode('ascii')}
+    elif isinstance(value, datetime.datetime):
+        return {u'!': u'!!timestamp', u'value': value.isoformat()}
+    elif isinstance(value, datetime.date):
+        return {u'!': u'!!date', u'value': value.isoformat()}
+    elif value is None or isinstance(value, (string_type, bytes, bool, int,
+                                             float)):
+        return value
+    raise TypeError(u"Cannot serialize: {0!r}".format(value))
+
+
+def _json_decode(data):
+    tag = data.get(u'!')
+    if tag is None:
+        return data
+    elif tag == u'!!map':
+        return {_hashable(key): item for key, item in data[u'items']}
+    elif tag == u'!!set':
+        return set(_hashable(item) for item in data[u'items'])
+    elif tag == u'!!binary':
+        return base64.b64decode(data[u'value'].encode('ascii'))
+    elif tag == u'!!timestamp':
+        return _parse_timestamp(data[u'value'])
+    elif tag == u'!!date':
+        return datetime.datetime.strptime(data[u'value'], '%Y-%m-%d').date()
+
+    cls = _models[tag]
+    obj = cls.__new__(cls)
+    for name, value in data.items():
+        field = getattr(cls, name, None)
+        if field:
+            setattr(obj, field.attr, value)
+    return obj
+
+
+def _hashable(value):
+    if isinstance(value, list):
+        return tuple(_hashable(item) for item in value)
+    return value
+
+
+def _parse_timestamp(value):
+    # Loaded the same way YAML does, which also understands ISO 8601
+    return yaml.SafeLoader(u'').construct_yaml_timestamp(
+        yaml.ScalarNode(u'tag:yaml.org,2002:timestamp', value))
+
+
 _nodefault = object()
 
 
 class Field(object):
     """
     Descriptor for fields.
+
+    A field may be declared `lazy`, in which case, for objects stored in their
+    own file, its value is stored in a separate file and is only read the
+    first time the field is accessed.
+
+    A field may be declared `index`, in which case the field's values are
+    indexed by folders containing the model, so that they can be searched with
+    the folder's `query` method.  Folders which don't declare any `indexes` of
+    their own only build their index the first time they're queried, and keep
+    it up to date from then on.
+
+    A field may be declared `log`, in which case its value is a
+    `PersistentLog`, an append only sequence.  For objects stored in their own
+    file, the entries of a log are stored in separate files, so that appending
+    to a log only writes the new entries, rather than the whole object.
     """
     __name__ = _nodefault
 
     def __init__(self, type=object, default=_nodefault, coerce=None,
-                 none=False):
+                 none=False, lazy=False, index=False, log=False):
         self.type = type
         self.default = default
         self.coerce = coerce
         self.none = none
+        self.lazy = lazy
+        self.index = index
+        self.log = log
 
     def __get__(self, obj, objtype=None):
         if obj is None:
             return self
 
         value = getattr(obj, self.attr, _nodefault)
+        shared = obj.__dumpling__.shared
+        if shared and self.attr in shared:
+            # Decoded value shared with the cache and other sessions, copied
+            # before it can be changed, even by a read only session, whose
+            # objects can't be saved, but whose values could still be
+            # mutated in place.
+            value = copy.deepcopy(value)
+            setattr(obj, self.attr, value)
+            shared.discard(self.attr)
+
+        if self.log:
+            if not isinstance(value, PersistentLog):
+                value = _log_for(obj, self, value)
+            return value
+        if value is _nodefault and self.lazy:
+            value = _load_lazy(obj, self)
+            if value is not _nodefault:
+                setattr(obj, self.attr, value)
         if value is _nodefault:
             value = self.default
             if value is _nodefault:
@@ -81,6 +409,10 @@ class Field(object):
                 value = value()
             setattr(obj, self.attr, value)
 
+        if _readonly(obj):
+            # Can't be saved, so changes needn't be tracked
+            return value
+
         if type(value) is list:
             value = PersistentList(value)
             setattr(obj, self.attr, value)
@@ -92,6 +424,19 @@ class Field(object):
         return value
 
     def __set__(self, obj, value):
+        _check_writable(obj)
+        shared = obj.__dumpling__.shared
+        if shared:
+            shared.discard(self.attr)
+        if self.log:
+            # Replaces all of the entries in the log
+            log = PersistentLog(value)
+            log._bind(obj, self.__name__)
+            log._replace = True
+            setattr(obj, self.attr, log)
+            set_dirty(obj)
+            return
+
         if value is None:
             if not self.none:
                 raise TypeError(u"None is not allowed.")
@@ -140,11 +485,9 @@ def model(cls):
     tag = '!{0}.{1}'.format(cls.__module__, cls.__name__)
 
     def representer(dumper, obj):
-        data = {field.__name__: getattr(obj, field.attr)
-                for field in fields if hasattr(obj, field.attr)}
-        return dumper.represent_mapping(tag, data)
+        return dumper.represent_mapping(tag, _model_data(obj))
 
-    yaml.add_representer(cls, representer)
+    _add_representer(cls, representer)
 
     def constructor(loader, node):
         data = loader.construct_mapping(node)
@@ -155,18 +498,64 @@ def model(cls):
                 setattr(obj, field.attr, value)
         return obj
 
-    yaml.add_constructor(tag, constructor)
+    _add_constructor(tag, constructor)
+    _models[tag] = cls
 
     cls.__dumpling_model__ = True
+    cls.__dumpling_tag__ = tag
+    cls.__dumpling_fields__ = tuple(fields)
     cls.__dumpling_folder__ = False
+    cls.__dumpling_lazy__ = tuple(field for field in fields if field.lazy)
+    cls.__dumpling_logs__ = tuple(field for field in fields if field.log)
+    cls.__dumpling_indexed__ = tuple(
+        field.__name__ for field in fields if field.index)
+    _indexed_fields.update(cls.__dumpling_indexed__)
     return cls
 
 
-def folder(cls):
+# Names of fields declared with `index=True` by any model
+_indexed_fields = set()
+
+
+def _model_data(obj):
+    """
+    Returns a dictionary of the field values to serialize for a model.  Lazy
+    fields and logs are stored separately for objects stored in their own
+    files, which are the objects with parents.
+    """
+    stored = '__parent__' in obj.__dict__
+    return {field.__name__: getattr(obj, field.attr)
+            for field in obj.__dumpling_fields__
+            if hasattr(obj, field.attr) and
+            not (stored and (field.lazy or field.log))}
+
+
+def folder(cls=None, indexes=()):
     """
     A class decorator which makes a class into a Dumpling model that can be
     persisted as a folder containing child objects in the file system.
+
+    The names of attributes of children to index, in addition to any fields
+    of the children declared with `index=True`, may be passed as `indexes`::
+
+        @folder(indexes=['author'])
+        class Blog(object):
+            ...
+
+    Children are listed in the order given by the folder's `sort_key` method,
+    if it has one, which is called with the name of a child.  `keys`, `values`
+    and `items` may be passed `start`, the name of the first child to return,
+    and `limit`, the most children to return, in order to page through them.
+
+    A folder which also has a `sort_version` attribute has its order saved
+    along with it, so that it needn't be sorted again each time it is loaded.
+    The saved order is only used while `sort_version` is unchanged, so it must
+    be changed whenever `sort_key` is changed to sort differently.  Folders
+    without a `sort_version` are sorted again in each transaction.
     """
+    if cls is None:
+        return functools.partial(folder, indexes=indexes)
+
     model(cls)
 
     def __getitem__(folder, name):
@@ -175,21 +564,44 @@ def folder(cls):
             raise KeyError(name)
         return item
 
-    def keys(folder):
-        keys = _folder_contents(folder).keys()
+    def keys(folder, start=None, limit=None):
         sort_key = getattr(folder, 'sort_key', None)
         if sort_key:
-            keys = sorted(keys, key=sort_key)
-        return keys
+            order = _folder_order(folder, sort_key)
+            state = folder.__dumpling__
+            contents = state.folder_contents
+            if contents is not None and state.dirty_children:
+                # Sort values may depend on the children's contents
+                order.update([
+                    name for name in state.dirty_children
+                    if name in contents and not contents[name].deleted])
+            names = order.names
+            i = order.index(start) if start is not None else 0
+        else:
+            names = _live_names(_folder_contents(folder))
+            if start is None:
+                i = 0
+            else:
+                i = names.index(start) if start in names else None
+        if i is None:
+            raise KeyError(start)
+        return list(names[i:i + limit if limit is not None else None])
 
     def __iter__(folder):
         return iter(folder.keys())
 
-    def values(folder):
-        return (folder[key] for key in folder.keys())
+    def values(folder, start=None, limit=None, prefetch=False,
+               executor=None):
+        keys = folder.keys(start, limit)
+        if prefetch:
+            folder.prefetch(keys, executor)
+        return (folder[key] for key in keys)
 
-    def items(folder):
-        return ((key, folder[key]) for key in folder.keys())
+    def items(folder, start=None, limit=None, prefetch=False, executor=None):
+        keys = folder.keys(start, limit)
+        if prefetch:
+            folder.prefetch(keys, executor)
+        return ((key, folder[key]) for key in keys)
 
     def pop(folder, name):
         obj = folder[name]
@@ -205,26 +617,81 @@ def folder(cls):
     cls.__iter__ = __iter__
     cls.keys = keys
     cls.pop = pop
+    cls.prefetch = prefetch
+    cls.query = query
+    cls.search = search
     cls.__setitem__ = set_child
     cls.values = values
+    cls.__dumpling_shard__ = None
+    cls.__dumpling_indexes__ = tuple(indexes)
+    return cls
+
+
+def bigfolder(cls=None, indexes=()):
+    """
+    A class decorator which makes a class into a Dumpling folder suitable for
+    very large numbers of children.
+
+    Children are spread across subdirectories named for a hash of the child's
+    name, and a sorted index of child names is persisted alongside them, in
+    pages, so that neither looking up a child nor counting children requires
+    listing the folder or reading every name.  Keys are always iterated in
+    sorted order and may be paged through using the `start` and `limit`
+    arguments to `keys`, `values` and `items`, where `start` needn't be the
+    name of a child.
+    """
+    if cls is None:
+        return functools.partial(bigfolder, indexes=indexes)
+
+    folder(cls, indexes)
+
+    def keys(folder, start=None, limit=None):
+        names = _folder_contents(folder).tree.names(start)
+        return list(itertools.islice(names, limit))
+
+    def __len__(folder):
+        return len(_folder_contents(folder).tree)
+
+    cls.keys = keys
+    cls.__len__ = __len__
+    cls.__dumpling_shard__ = staticmethod(_shard)
     return cls
 
 
+def _shard(name):
+    return hashlib.sha1(name.encode('utf-8')).hexdigest()[:3]
+
+
 def set_dirty(obj):
     obj = getattr(obj.__dumpling__, 'top', obj)
     obj.__dumpling__.dirty = True
     folder = getattr(obj, '__parent__', None)
-    if folder:
-        set_folder_dirty(folder)
+    if folder is not None:
+        set_folder_dirty(folder, obj.__name__)
 
 
-def set_folder_dirty(folder):
+def set_folder_dirty(folder, name=None):
+    """
+    Registers that the child of `folder` named `name` needs to be saved, and
+    likewise for each of the folder's ancestors, so that saving only has to
+    visit the parts of the tree which have changed.  If `name` isn't given,
+    every child of `folder` which has been loaded is saved.
+    """
     while folder is not None:
-        folder.__dumpling__.dirty_children = True
+        state = folder.__dumpling__
+        dirty_children = state.dirty_children
+        if not dirty_children:
+            state.dirty_children = dirty_children = set()
+        if name is not None:
+            dirty_children.add(name)
+        elif state.folder_contents is not None:
+            dirty_children.update(state.folder_contents.keys())
+        name = getattr(folder, '__name__', None)
         folder = getattr(folder, '__parent__', None)
 
 
 def set_child(folder, name, obj):
+    _check_writable(folder)
     state = getattr(obj, '__dumpling__', None)
     if not state:
         raise TypeError(
@@ -236,8 +703,10 @@ def set_child(folder, name, obj):
             'Original path: {0}'.format(state.path))
 
     entry = _FolderEntry(name, obj.__dumpling_folder__, obj)
+    entry.persisted = False
     entry.detached_from = state.detached_from
     contents = _folder_contents(folder)
+    indexes = _folder_indexes(folder)
     old_entry = contents.get(name)
     if old_entry:
         if old_entry.replaces:
@@ -245,6 +714,10 @@ def set_child(folder, name, obj):
         entry.replaces = old_entry
         old_entry.deleted = True
 
+    sort_key = _sort_key(folder)
+    if sort_key:
+        order = _folder_order(folder, sort_key)
+
     obj.__parent__ = folder
     obj.__name__ = name
     contents[name] = entry
@@ -252,6 +725,11 @@ def set_child(folder, name, obj):
     if folder.__dumpling__.session is not _unattached:
         _attach(folder, entry)
 
+    if sort_key:
+        order.add(name)
+    if indexes is not None:
+        indexes.add(name, obj)
+
     set_dirty(obj)
 
 
@@ -267,8 +745,9 @@ def _attach(parent, entry):
         state.dirty = True
 
         if entry.is_folder:
-            state.dirty_children = True
-            for child_entry in _folder_contents(obj).values():
+            contents = _folder_contents(obj)
+            state.dirty_children = set(contents.keys())
+            for child_entry in contents.values():
                 _attach(obj, child_entry)
 
 
@@ -279,14 +758,160 @@ def get_child(folder, name):
         obj = entry.loaded
         if obj is None:
             session = folder.__dumpling__.session
-            path = entry.detached_from if entry.detached_from else entry.path
-            fname = path + ('/__index__.yaml' if entry.is_folder else '.yaml')
-            obj = session.load(entry.path, fname, folder, entry.name)
+            obj = session.load(entry.path, _entry_file(entry), folder,
+                               entry.name)
             obj.__dumpling__.detached_from = entry.detached_from
             entry.loaded = obj
         return obj
 
 
+def _entry_file(entry):
+    path = entry.detached_from if entry.detached_from else entry.path
+    return path + ('/__index__.yaml' if entry.is_folder else '.yaml')
+
+
+def prefetch(folder, keys=None, executor=None):
+    """
+    Loads the children of `folder` named by `keys`, or all children if `keys`
+    is omitted, reading them from the repository in a single pass rather than
+    one at a time.  An `executor` from the `concurrent.futures` module may be
+    passed in order to decode the children in parallel.
+    """
+    session = folder.__dumpling__.session
+    if not isinstance(session, _Session):
+        return  # Nothing to read
+
+    if keys is None:
+        keys = folder.keys()
+    contents = _folder_contents(folder)
+    entries = []
+    for name in keys:
+        entry = contents.get(name)
+        if entry and not entry.deleted and entry.loaded is None:
+            entries.append(entry)
+
+    objs = session.load_many(
+        [(entry.path, _entry_file(entry), folder, entry.name)
+         for entry in entries], executor)
+    for entry, obj in zip(entries, objs):
+        obj.__dumpling__.detached_from = entry.detached_from
+        entry.loaded = obj
+
+
+def query(folder, range=None, **criteria):
+    """
+    Returns the children of `folder` whose indexed attributes match, in order
+    of name.  Keyword arguments give the values attributes must be equal to.
+    `range` may be a dictionary mapping attribute names to `(low, high)`
+    tuples giving inclusive bounds for attributes, either of which may be
+    `None` for no bound::
+
+        folder.query(author=u'fred', range={'date': (start, None)})
+
+    Matches are found using the folder's indexes, so only the matching
+    children are loaded.  Values of an attribute must all be comparable with
+    each other.  `None` values are not indexed.
+    """
+    conditions = [(name, value, value) for name, value in criteria.items()]
+    if range:
+        conditions.extend(
+            (name, low, high) for name, (low, high) in range.items())
+    if not conditions:
+        return folder.values()
+
+    indexes = _folder_indexes(folder, True)
+
+    # Bring the index up to date with any changes not yet saved
+    contents = _folder_contents(folder)
+    for name in folder.__dumpling__.dirty_children:
+        entry = contents.get(name)
+        if (entry is not None and not entry.deleted and
+                entry.loaded is not None):
+            indexes.add(name, entry.loaded)
+
+    names = None
+    for name, low, high in conditions:
+        found = indexes.find(name, low, high)
+        names = found if names is None else names & found
+    names = sorted(names)
+    folder.prefetch(names)
+    return (folder[name] for name in names)
+
+
+def search(folder, text, limit=None):
+    """
+    Returns the paths of the objects in the subtree rooted at `folder` whose
+    string fields contain all of the words in `text`, ordered by the number of
+    times the words occur, most first.  At most `limit` paths are returned if
+    `limit` is given.
+
+    The store must have been created with `fulltext=True`.  The index is
+    updated when objects are saved, so changes made in the current
+    transaction are not found until they are flushed, except that objects
+    which have been removed are not returned.
+    """
+    session = folder.__dumpling__.session
+    if not isinstance(session, _Session):
+        return []
+    store = session.store
+    if not store.fulltext:
+        raise ValueError(u"Full text indexing is not enabled for this store.")
+
+    index = FullTextIndex(session.fs, session.decode,
+                          store.backend_for(None).dumps)
+    paths = [path for path in index.search(text, folder.__dumpling__.path)
+             if _is_live(session, path)]
+    return paths[:limit]
+
+
+def _is_live(session, path):
+    """
+    Returns whether an object stored at `path` has not since been removed,
+    taking into account changes which have not been saved yet.
+    """
+    obj = session.root
+    names = [name for name in path.split('/') if name]
+    while names:
+        if obj is _NotInCache or not obj.__dumpling_folder__:
+            return True
+        contents = obj.__dumpling__.folder_contents
+        if contents is None:
+            return True  # Not loaded, so can't have changed
+        if obj.__dumpling_shard__ is not None:
+            names.pop(0)
+            if not names:
+                return True
+        entry = contents.get(names.pop(0))
+        if entry is None or entry.deleted:
+            return False
+        obj = entry.loaded
+        if obj is None:
+            return True
+    return True
+
+
+def _index_text(index, obj):
+    """
+    Updates the full text index for a stored object.  Lazy fields which have
+    not been loaded are left as they were last indexed.
+    """
+    texts = {}
+    keep = []
+    for field in obj.__dumpling_fields__:
+        if not (isinstance(field.type, type) and
+                issubclass(field.type, string_type)):
+            continue
+        value = getattr(obj, field.attr, _nodefault)
+        if value is _nodefault:
+            if field.lazy:
+                keep.append(field.__name__)
+                continue
+            value = field.default
+        if isinstance(value, string_type):
+            texts[field.__name__] = value
+    index.update(obj.__dumpling__.path, texts, keep)
+
+
 def has_child(folder, name):
     contents = _folder_contents(folder)
     entry = contents.get(name)
@@ -294,83 +919,966 @@ def has_child(folder, name):
 
 
 def delete_child(folder, name):
+    _check_writable(folder)
     contents = _folder_contents(folder)
     entry = contents[name]
+    sort_key = _sort_key(folder)
+    if sort_key:
+        _folder_order(folder, sort_key).discard(name)
+    indexes = _folder_indexes(folder)
+    if indexes is not None:
+        indexes.discard(name)
     entry.deleted = True
-    set_folder_dirty(folder)
-    if entry.loaded:
+    if isinstance(contents, _BigFolderContents):
+        contents.discard(name)
+    set_folder_dirty(folder, name)
+    if entry.loaded is not None:
         _detach(entry)
 
 
 def _detach(entry):
+    # An object which has already been moved in this transaction is still
+    # stored in its original location.
     state = entry.loaded.__dumpling__
-    state.detached_from = state.path
+    if not state.detached_from:
+        state.detached_from = state.path
     if entry.is_folder:
-        for subentry in _folder_contents(entry.loaded).values():
-            subentry.detached_from = subentry.path
-            if subentry.loaded:
+        contents = _folder_contents(entry.loaded)
+        if isinstance(contents, _BigFolderContents):
+            contents.materialize()
+        for subentry in contents.values():
+            if not subentry.detached_from:
+                subentry.detached_from = subentry.path
+            if subentry.loaded is not None:
                 _detach(subentry)
     state.session = _detached
 
 
+def _lazy_file(obj, path, name, ext='.yaml'):
+    """
+    Returns the path of the file in which the lazy field, `name`, of `obj` is
+    stored, given the path of the object.  Lazy fields of a model are stored in
+    a directory with the same name as the model.  Lazy fields of a folder are
+    stored in an `__index__` directory inside of the folder.  The segments of
+    logs are stored in the same places, in directories named with a `.log`
+    extension.
+    """
+    if obj.__dumpling_folder__:
+        return u'{0}/__index__/{1}{2}'.format(path.rstrip('/'), name, ext)
+    return u'{0}/{1}{2}'.format(path, name, ext)
+
+
+def _load_lazy(obj, field):
+    state = obj.__dumpling__
+    session = state.session
+    if not isinstance(session, _Session):
+        return _nodefault
+
+    path = state.detached_from if state.detached_from else state.path
+    fname = _lazy_file(obj, path, field.__name__)
+    if not session.fs.exists(fname):
+        return _nodefault
+    value, = session.decode([fname])
+    return value
+
+
+def _log_for(obj, field, value):
+    """
+    Returns the log for a log field which hasn't been accessed yet.  `value`
+    is the list of entries stored in the object's own file, if any, which is
+    where the entries are kept for objects which aren't stored in their own
+    files, and where earlier versions kept them.
+    """
+    if value is _nodefault:
+        log = PersistentLog()
+    else:
+        log = PersistentLog(value)
+        log._replace = True
+    log._bind(obj, field.__name__)
+    setattr(obj, field.attr, log)
+    return log
+
+
+def _load_log(obj, name):
+    """
+    Returns the entries of the log, `name`, read from its segments.
+    """
+    state = obj.__dumpling__
+    session = state.session
+    if not isinstance(session, _Session):
+        return []
+
+    path = state.detached_from if state.detached_from else state.path
+    dirname = _lazy_file(obj, path, name, '.log')
+    fs = session.fs
+    if not fs.exists(dirname):
+        return []
+    fnames = [u'{0}/{1}'.format(dirname, fname)
+              for fname in sorted(fs.listdir(dirname))]
+    entries = []
+    for segment in session.decode(fnames):
+        entries.extend(segment)
+    return entries
+
+
 def _session_for(obj):
     state = obj.__dumpling__
     top = getattr(state, 'top', obj)
     return top.__dumpling__.session
 
 
+def _readonly(obj):
+    return getattr(_session_for(obj), 'readonly', False)
+
+
+def _check_writable(obj):
+    if _readonly(obj):
+        raise TypeError(u"Objects in a snapshot are read only.")
+
+
 class _FolderEntry(object):
     deleted = False
     detached_from = None
     replaces = None
+    persisted = True  # Whether child has been written at this entry's path
 
     def __init__(self, name, is_folder, loaded=None, parent=None):
         self.name = name
         self.is_folder = is_folder
         self.loaded = loaded
-        if parent:
+        if parent is not None:
             self.set_parent(parent)
 
     def set_parent(self, parent):
-        parent_path = parent.__dumpling__.path
-        if parent_path == '/':
-            parent_path = ''
-        self.path = '{0}/{1}'.format(
-            parent_path, self.name)
+        self.path = _child_path(parent, parent.__dumpling__.path, self.name)
+
+
+def _child_path(folder, path, name):
+    if path == '/':
+        path = ''
+    shard = folder.__dumpling_shard__
+    if shard is not None:
+        return '{0}/{1}/{2}'.format(path, shard(name), name)
+    return '{0}/{1}'.format(path, name)
 
 
 def _folder_contents(folder):
     state = folder.__dumpling__
     contents = state.folder_contents
     if contents is None:
-        contents = {}
-        if state.session is not _unattached:
-            fs = state.session.fs
-            path = (state.detached_from if state.detached_from else state.path)
-            if fs.exists(path):
-                for fname in fs.listdir(path):
-                    fpath = '{0}/{1}'.format(path, fname)
-                    if fname.endswith('.yaml'):
-                        name = fname[:-5]
-                        if name == '__index__':
-                            continue
-                        contents[name] = entry = _FolderEntry(
-                            name, False, parent=folder)
-                        if state.detached_from:
-                            entry.detached_from = '{0}/{1}'.format(
-                                state.detached_from, name)
-                    elif fs.isdir(fpath):
-                        fpath += '/__index__.yaml'
-                        if fs.exists(fpath):
-                            contents[fname] = entry = _FolderEntry(
-                                fname, True, parent=folder)
-                            if state.detached_from:
-                                entry.detached_from = '{0}/{1}'.format(
-                                    state.detached_from, fname)
+        if folder.__dumpling_shard__ is not None:
+            contents = _BigFolderContents(folder)
+        else:
+            contents = {}
+            if state.session is not _unattached:
+                path = (state.detached_from if state.detached_from
+                        else state.path)
+                for name, is_folder in _list_folder(state.session, path):
+                    contents[name] = entry = _FolderEntry(
+                        name, is_folder, parent=folder)
+                    if state.detached_from:
+                        entry.detached_from = _child_path(
+                            folder, state.detached_from, name)
         state.folder_contents = contents
     return contents
 
 
+class _BigFolderContents(dict):
+    """
+    Folder contents for a big folder.  Entries are only created for children
+    as they are accessed.  The names of all children, and which of them are
+    themselves folders, are kept in `tree`, a `_KeyTree`.
+    """
+
+    def __init__(self, folder):
+        self.folder = folder
+        self.tree = _KeyTree(folder)
+
+    def get(self, name, default=None):
+        entry = super(_BigFolderContents, self).get(name)
+        if entry is None:
+            is_folder = self.tree.lookup(name)
+            if is_folder is None:
+                return default
+
+            folder = self.folder
+            state = folder.__dumpling__
+            entry = _FolderEntry(name, is_folder, parent=folder)
+            super(_BigFolderContents, self).__setitem__(name, entry)
+            if state.detached_from:
+                entry.detached_from = _child_path(
+                    folder, state.detached_from, name)
+        return entry
+
+    def __getitem__(self, name):
+        entry = self.get(name)
+        if entry is None:
+            raise KeyError(name)
+        return entry
+
+    def __setitem__(self, name, entry):
+        self.tree.insert(name, entry.is_folder)
+        super(_BigFolderContents, self).__setitem__(name, entry)
+
+    def discard(self, name):
+        """
+        Removes `name` from the index.
+        """
+        self.tree.remove(name)
+
+    def materialize(self):
+        """
+        Makes sure an entry exists for every child.
+        """
+        for name in list(self.tree.names()):
+            self.get(name)
+
+
+class _KeyTree(object):
+    """
+    The sorted names of the children of a big folder, persisted as a B+tree
+    of pages in the folder's `__keys__` directory, so that finding, adding or
+    removing a name only reads and writes the pages on the way from the root
+    to a single leaf.  Leaf pages list names, along with which of them are
+    folders.  Other pages list their child pages, and the first name under
+    each child but the first.  The root is page ``0``, which also holds the
+    number of names and the next unused page number.
+
+    Pages are split in two when they grow past `page_size` and merged with a
+    neighbour when they fall below half of it, where the two fit in one page.
+    """
+    page_size = 256
+
+    def __init__(self, folder):
+        self.folder = folder
+        self.pages = {}
+        self.dirty = set()
+        self.removed = set()
+        self.new = set()
+
+        state = folder.__dumpling__
+        if state.session is not _unattached:
+            if state.session.fs.exists(self._dir()):
+                self._page(0)
+        if 0 not in self.pages:
+            self.pages[0] = {'names': [], 'folders': [], 'count': 0, 'next': 1}
+
+    def __len__(self):
+        return self.pages[0]['count']
+
+    def lookup(self, name):
+        """
+        Returns whether the child, `name`, is a folder, or `None` if there
+        isn't such a child.
+        """
+        id, page, i = self._find(name)[-1]
+        names = page['names']
+        if i < len(names) and names[i] == name:
+            return name in page['folders']
+
+    def names(self, start=None):
+        """
+        Yields the names, in order, starting from `start`, if given.
+        """
+        stack = []
+        page = self._page(0)
+        while 'keys' in page:
+            i = bisect.bisect_right(page['keys'], start) if start else 0
+            stack.append((page, i))
+            page = self._page(page['pages'][i])
+        i = bisect.bisect_left(page['names'], start) if start else 0
+
+        while True:
+            for name in page['names'][i:]:
+                yield name
+            i = 0
+            while stack:
+                parent, j = stack.pop()
+                if j + 1 < len(parent['pages']):
+                    stack.append((parent, j + 1))
+                    page = self._page(parent['pages'][j + 1])
+                    while 'keys' in page:
+                        stack.append((page, 0))
+                        page = self._page(page['pages'][0])
+                    break
+            else:
+                return
+
+    def insert(self, name, is_folder):
+        path = self._find(name)
+        id, page, i = path[-1]
+        names = page['names']
+        folders = page['folders']
+        if i < len(names) and names[i] == name:
+            if (name in folders) != is_folder:
+                if is_folder:
+                    bisect.insort(folders, name)
+                else:
+                    folders.remove(name)
+                self.dirty.add(id)
+            return
+
+        names.insert(i, name)
+        if is_folder:
+            bisect.insort(folders, name)
+        self.dirty.add(id)
+        self._count(1)
+        self._split(path)
+
+    def remove(self, name):
+        path = self._find(name)
+        id, page, i = path[-1]
+        names = page['names']
+        if i == len(names) or names[i] != name:
+            return
+
+        del names[i]
+        if name in page['folders']:
+            page['folders'].remove(name)
+        self.dirty.add(id)
+        self._count(-1)
+
+        self._merge(path)
+        root = self.pages[0]
+        while 'keys' in root and len(root['pages']) == 1:
+            child = root['pages'][0]
+            del root['keys'], root['pages']
+            root.update(self._page(child))
+            self._remove_page(child)
+
+    def _find(self, name):
+        """
+        Returns the `(id, page, position)` of each page on the way from the
+        root to the leaf where `name` belongs.
+        """
+        path = []
+        id = 0
+        page = self._page(0)
+        while 'keys' in page:
+            i = bisect.bisect_right(page['keys'], name)
+            path.append((id, page, i))
+            id = page['pages'][i]
+            page = self._page(id)
+        path.append((id, page, bisect.bisect_left(page['names'], name)))
+        return path
+
+    def _split(self, path):
+        while path:
+            id, page, i = path.pop()
+            if 'names' in page:
+                names = page['names']
+                if len(names) <= self.page_size:
+                    return
+                mid = len(names) // 2
+                key = names[mid]
+                folders = page['folders']
+                right = {'names': names[mid:],
+                         'folders': [name for name in folders if name >= key]}
+                page['names'] = names[:mid]
+                page['folders'] = [name for name in folders if name < key]
+            else:
+                keys, pages = page['keys'], page['pages']
+                if len(pages) <= self.page_size:
+                    return
+                mid = len(keys) // 2
+                key = keys[mid]
+                right = {'keys': keys[mid + 1:], 'pages': pages[mid + 1:]}
+                page['keys'] = keys[:mid]
+                page['pages'] = pages[:mid + 1]
+            self.dirty.add(id)
+
+            if id == 0:
+                # The root stays page 0, so it gets two new children
+                left = {}
+                for field in ('names', 'folders', 'keys', 'pages'):
+                    if field in page:
+                        left[field] = page.pop(field)
+                page['keys'] = [key]
+                page['pages'] = [self._new(left), self._new(right)]
+                return
+
+            parent_id, parent, j = path[-1]
+            parent['keys'].insert(j, key)
+            parent['pages'].insert(j + 1, self._new(right))
+            self.dirty.add(parent_id)
+
+    def _merge(self, path):
+        # Merges pages less than half full with a neighbour they fit in with
+        while len(path) > 1:
+            id, page, i = path.pop()
+            size = len(page.get('names', page.get('pages')))
+            if size >= self.page_size // 2:
+                return
+
+            parent_id, parent, j = path[-1]
+            keys, pages = parent['keys'], parent['pages']
+            if not size:
+                del pages[j]
+                if keys:
+                    del keys[max(j - 1, 0)]
+                self._remove_page(id)
+            else:
+                k = j - 1 if j else j + 1
+                if k == len(pages):
+                    return
+                k = min(j, k)
+                left = self._page(pages[k])
+                right = self._page(pages[k + 1])
+                field = 'names' if 'names' in left else 'pages'
+                if len(left[field]) + len(right[field]) > self.page_size:
+                    return
+                if field == 'names':
+                    left['folders'].extend(right['folders'])
+                else:
+                    left['keys'].append(keys[k])
+                    left['keys'].extend(right['keys'])
+                left[field].extend(right[field])
+                self.dirty.add(pages[k])
+                self._remove_page(pages[k + 1])
+                del pages[k + 1]
+                del keys[k]
+            self.dirty.add(parent_id)
+
+    def rewrite(self):
+        """
+        Marks every page to be written, loading any which haven't been.
+        """
+        list(self.names())  # Loads every page
+        self.dirty.update(self.pages)
+        self.removed.clear()
+
+    def _page(self, id):
+        page = self.pages.get(id)
+        if page is None:
+            session = self.folder.__dumpling__.session
+            page, = session.decode(['{0}/{1}'.format(self._dir(), id)])
+            self.pages[id] = page
+        return page
+
+    def _new(self, page):
+        root = self.pages[0]
+        id = root['next']
+        root['next'] += 1
+        self.pages[id] = page
+        self.dirty.update((0, id))
+        self.new.add(id)
+        return id
+
+    def _remove_page(self, id):
+        del self.pages[id]
+        self.dirty.discard(id)
+        if id in self.new:
+            self.new.discard(id)  # Never written
+        else:
+            self.removed.add(id)
+
+    def _count(self, n):
+        self.pages[0]['count'] += n
+        self.dirty.add(0)
+
+    def _dir(self):
+        state = self.folder.__dumpling__
+        path = state.detached_from if state.detached_from else state.path
+        return path.rstrip('/') + '/__keys__'
+
+
+def _list_folder(session, path):
+    """
+    Returns a sequence of `(name, is_folder)` tuples for the children stored
+    in the folder at `path`.
+    """
+    fs = session.fs
+    if not hasattr(fs, '_session'):
+        return _list_folder_slow(fs, path)
+
+    node = fs._session().find(fs._mkpath(path))
+    if node is None or not hasattr(node, 'contents'):
+        return ()
+
+    # Clean trees are immutable, content addressed Git objects, so listings
+    # of them can be shared across transactions.
+    cache = session.store.cache
+    clean = node.oid and not node.dirty
+    if cache is not None and clean:
+        key = (fs.db, path)
+        listing = cache.get(node.oid, key)
+        if listing is not None:
+            return listing
+
+    listing = []
+    unknown = []
+    for fname, (type, oid, obj) in node.contents.items():
+        if type == b'blob':
+            if fname.endswith('.yaml'):
+                name = fname[:-5]
+                if name != '__index__':
+                    listing.append((name, False))
+        elif obj is not None:
+            if '__index__.yaml' in obj.contents:
+                listing.append((fname, True))
+        else:
+            unknown.append((fname, oid))
+
+    # Find out which subdirectories are folders with a single query to Git,
+    # rather than reading each subtree.
+    if unknown:
+        found = _has_index(fs.db, [oid for fname, oid in unknown])
+        listing.extend((fname, True) for (fname, oid), is_folder
+                       in zip(unknown, found) if is_folder)
+
+    if cache is not None and clean:
+        cache.set(node.oid, key, listing,
+                  sum(len(name) for name, is_folder in listing))
+    return listing
+
+
+def _list_folder_slow(fs, path):
+    listing = []
+    if fs.exists(path):
+        for fname in fs.listdir(path):
+            fpath = '{0}/{1}'.format(path, fname)
+            if fname.endswith('.yaml'):
+                name = fname[:-5]
+                if name != '__index__':
+                    listing.append((name, False))
+            elif fs.isdir(fpath) and fs.exists(fpath + '/__index__.yaml'):
+                listing.append((fname, True))
+    return listing
+
+
+def _has_index(db, tree_oids):
+    """
+    Returns a list of booleans indicating which of the Git trees identified by
+    `tree_oids` contain an `__index__.yaml` file.
+    """
+    out = _git_batch(
+        db, '--batch-check', [oid + b':__index__.yaml' for oid in tree_oids])
+    return [not line.endswith(b' missing') for line in out.splitlines()]
+
+
+def _blob_oids(fs, paths):
+    """
+    Returns the Git object ids of the files at `paths` in an AcidFS
+    filesystem.  Paths which fall in trees which have not yet been read are
+    resolved with a single query to Git.
+    """
+    session = fs._session()
+    oids = [None] * len(paths)
+    unresolved = []
+    for i, path in enumerate(paths):
+        parsed = fs._mkpath(path)
+        node = session.tree
+        for j, name in enumerate(parsed):
+            entry = node.contents.get(name)
+            if entry is None:
+                raise IOError(2, 'No such file or directory', path)
+            type, oid, obj = entry
+            if obj is None and type == b'tree':
+                rest = '/'.join(parsed[j + 1:]).encode(fs.path_encoding)
+                unresolved.append((i, oid + b':' + rest))
+                break
+            node = obj
+        else:
+            oids[i] = oid if oid else obj.hash()
+
+    if unresolved:
+        out = _git_batch(
+            fs.db, '--batch-check', [spec for i, spec in unresolved])
+        for (i, spec), line in zip(unresolved, out.splitlines()):
+            if line.endswith(b' missing'):
+                raise IOError(2, 'No such file or directory', paths[i])
+            oids[i] = line.split()[0]
+
+    return oids
+
+
+def _read_blobs(db, oids):
+    """
+    Returns the contents of the Git blobs identified by `oids`, read in a
+    single pass.
+    """
+    out = _git_batch(db, '--batch', oids)
+    datas = []
+    pos = 0
+    for oid in oids:
+        eol = out.index(b'\n', pos)
+        size = int(out[pos:eol].split()[2])
+        pos = eol + 1
+        datas.append(out[pos:pos + size])
+        pos += size + 1
+    return datas
+
+
+def _git_batch(db, mode, lines):
+    proc = subprocess.Popen(
+        ['git', 'cat-file', mode], cwd=db,
+        stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+    out, _ = proc.communicate(b''.join(line + b'\n' for line in lines))
+    if proc.returncode != 0:  # pragma no cover
+        raise subprocess.CalledProcessError(
+            proc.returncode, 'git cat-file ' + mode)
+    return out
+
+
+def _live_names(contents):
+    return [name for name, entry in contents.items() if not entry.deleted]
+
+
+def _sort_key(folder):
+    # Big folders are always kept sorted by name
+    if folder.__dumpling_shard__ is None:
+        return getattr(folder, 'sort_key', None)
+
+
+def _folder_order(folder, sort_key):
+    """
+    Returns the `_FolderOrder` for a folder, loading the persisted order if
+    it is still valid for the folder's current contents and `sort_key`, or
+    else sorting the folder from scratch.
+    """
+    state = folder.__dumpling__
+    version = getattr(folder, 'sort_version', None)
+    order = state.folder_order
+    if (order is not None and order.sort_key == sort_key and
+            order.version == version):
+        return order
+
+    order = None
+    if version is not None and state.session not in (_unattached, _detached):
+        path = state.detached_from if state.detached_from else state.path
+        names = _load_order(state.session, path, version)
+        if names is not None:
+            order = _FolderOrder(sort_key, version, names)
+
+    if order is None:
+        # Persisted order is missing or stale.  The rebuilt order will be
+        # saved next time the folder is saved.
+        order = _FolderOrder(sort_key, version)
+        values = order.values
+        for name in _live_names(_folder_contents(folder)):
+            values[name] = sort_key(name)
+        order.names = sorted(values, key=lambda name: (values[name], name))
+        order.dirty = True
+
+    state.folder_order = order
+    return order
+
+
+class _FolderOrder(object):
+    """
+    The names of the children of a folder, kept ordered by the folder's
+    `sort_key`.  Only the names are persisted, along with the folder's
+    `sort_version`, so sort values needn't be serializable.  Sort values are
+    computed as they're needed and remembered, so inserting or removing a
+    child only calls `sort_key` for the children visited by a binary search.
+    """
+    dirty = False
+
+    def __init__(self, sort_key, version, names=()):
+        self.sort_key = sort_key
+        self.version = version
+        self.names = names  # A tuple, shared with the cache, until changed
+        self.values = {}
+
+    def value(self, name):
+        values = self.values
+        value = values.get(name, _nodefault)
+        if value is _nodefault:
+            values[name] = value = self.sort_key(name)
+        return value
+
+    def index(self, name):
+        """
+        Returns the position of `name`, or `None` if it isn't in the order.
+        """
+        names = self.names
+        value = self.values.get(name, _nodefault)
+        if value is not _nodefault:
+            i = self._bisect(value, name)
+            if i < len(names) and names[i] == name:
+                return i
+        # Sort value not known, or changed since the name was placed
+        try:
+            return names.index(name)
+        except ValueError:
+            return None
+
+    def update(self, names):
+        """
+        Places each of `names`, which may be new or have new sort values.
+        The names are all removed before any are placed again, so that the
+        binary searches only visit names which are where they belong.
+        """
+        changed = []
+        for name in names:
+            value = self.sort_key(name)
+            if self.values.get(name, _nodefault) != value:
+                changed.append((name, value, self.index(name)))
+        if not changed:
+            return
+
+        if type(self.names) is not list:
+            self.names = list(self.names)
+        for name, value, i in changed:
+            if i is not None:
+                del self.names[self.index(name)]
+                self.values.pop(name, None)
+        for name, value, i in changed:
+            j = self._bisect(value, name)
+            self.names.insert(j, name)
+            self.values[name] = value
+            if i != j:
+                self.dirty = True
+
+    def add(self, name):
+        self.update((name,))
+
+    def discard(self, name):
+        i = self.index(name)
+        if i is not None:
+            if type(self.names) is not list:
+                self.names = list(self.names)
+            del self.names[i]
+            self.values.pop(name, None)
+            self.dirty = True
+
+    def _bisect(self, value, name):
+        names = self.names
+        key = (value, name)
+        lo, hi = 0, len(names)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            other = names[mid]
+            if (self.value(other), other) < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def dump(self):
+        return {
+            'sort_version': self.version,
+            'order': list(self.names),
+        }
+
+
+def _load_order(session, path, version):
+    """
+    Returns the persisted order of the names of the children of the folder at
+    `path`, or `None` if there isn't one which was saved with `version` of the
+    folder's `sort_version` and is valid for the folder's contents.  Checking
+    an order against the folder's contents requires listing the folder, so the
+    result is cached by the Git object id of the folder's tree, and only done
+    once for each version of a folder.
+    """
+    fs = session.fs
+    fname = path.rstrip('/') + '/__order__'
+    if not fs.exists(fname):
+        return None
+
+    cache = session.store.cache
+    oid = _tree_oid(fs, path)
+    key = (getattr(fs, 'db', None), fname)
+    cached = None
+    if cache is not None and oid is not None:
+        cached = cache.get(oid, key)
+
+    if cached is None:
+        with fs.open(fname, 'rb') as stream:
+            data = stream.read()
+        persisted = session.store.loads(data)
+        names = tuple(persisted['order'])
+        listing = [name for name, is_folder in _list_folder(session, path)]
+        if len(names) != len(listing) or set(names) != set(listing):
+            names = None
+        cached = (persisted.get('sort_version'), names)
+        if cache is not None and oid is not None:
+            cache.set(oid, key, cached, len(data))
+
+    saved_version, names = cached
+    if saved_version != version:
+        return None
+    return names
+
+
+def _tree_oid(fs, path):
+    """
+    Returns the Git object id of the tree at `path`, or `None` if it has been
+    changed in the current transaction, or isn't known.
+    """
+    if not hasattr(fs, '_session'):
+        return None
+    node = fs._session().find(fs._mkpath(path))
+    if node is not None and node.oid and not node.dirty:
+        return node.oid
+
+
+def _sortable(value):
+    # Tuples don't survive a round trip through YAML, so store them as lists.
+    if isinstance(value, (tuple, list)):
+        return [_sortable(item) for item in value]
+    return value
+
+
+def _folder_indexes(folder, create=False):
+    """
+    Returns the `_FolderIndexes` for a folder, loading the persisted indexes
+    if they are still valid for the folder's current contents, or else
+    building them from scratch.  Returns `None` for a folder with no indexes,
+    unless `create` is true.
+    """
+    state = folder.__dumpling__
+    indexes = state.folder_indexes
+    if indexes is not None:
+        return indexes
+
+    fields = folder.__dumpling_indexes__
+    fname = None
+    if state.session not in (_unattached, _detached):
+        path = state.detached_from if state.detached_from else state.path
+        fname = path.rstrip('/') + '/__indexes__'
+        if not state.session.fs.exists(fname):
+            fname = None
+    if not (fields or fname or create):
+        return None
+
+    contents = _folder_contents(folder)
+    if isinstance(contents, _BigFolderContents):
+        names = list(contents.tree.names())
+    else:
+        names = _live_names(contents)
+    if fname:
+        indexes = _load_indexes(state.session, fname, fields)
+        if indexes is not None and indexes.names != set(names):
+            indexes = None
+
+    if indexes is None:
+        # Persisted indexes are missing or stale.  The rebuilt indexes will
+        # be saved next time the folder is saved.
+        indexes = _FolderIndexes(fields)
+        folder.prefetch(names)
+        for name in names:
+            indexes.add(name, get_child(folder, name))
+        indexes.dirty = True
+
+    state.folder_indexes = indexes
+    return indexes
+
+
+class _FolderIndexes(object):
+    """
+    Indexes of the attributes of the children of a folder.  For each indexed
+    attribute a list of `(value, name)` pairs is kept sorted, so that children
+    can be found by value or range of values.  The set of the names of all the
+    children which have been indexed is kept in `names`.
+    """
+    dirty = False
+
+    def __init__(self, fields):
+        self.fields = fields
+        self.names = set()
+        self.pairs = {}
+        self.values = {}
+
+    def add(self, name, obj):
+        values = {}
+        for field in set(self.fields) | set(obj.__dumpling_indexed__):
+            value = getattr(obj, field, None)
+            if value is not None:
+                values[field] = _sortable(value)
+
+        if name in self.names and values == {
+                field: existing[name]
+                for field, existing in self.values.items()
+                if name in existing}:
+            return
+        self.discard(name)
+        self.names.add(name)
+        for field, value in values.items():
+            bisect.insort(self.pairs.setdefault(field, []), (value, name))
+            self.values.setdefault(field, {})[name] = value
+        self.dirty = True
+
+    def discard(self, name):
+        if name not in self.names:
+            return
+        self.names.remove(name)
+        for field, values in self.values.items():
+            value = values.pop(name, _nodefault)
+            if value is not _nodefault:
+                pairs = self.pairs[field]
+                del pairs[bisect.bisect_left(pairs, (value, name))]
+        self.dirty = True
+
+    def find(self, field, low, high):
+        """
+        Returns the set of names of children with values of `field` between
+        `low` and `high` inclusive.
+        """
+        if field not in self.pairs:
+            if field in self.fields or field in _indexed_fields:
+                return set()
+            raise ValueError(u"Not an indexed field: {0}".format(field))
+
+        pairs = self.pairs[field]
+        if low is None:
+            i = 0
+        else:
+            i = bisect.bisect_left(pairs, (_sortable(low),))
+        if high is None:
+            return set(name for value, name in pairs[i:])
+
+        high = _sortable(high)
+        found = set()
+        for value, name in pairs[i:]:
+            if value > high:
+                break
+            found.add(name)
+        return found
+
+    def dump(self):
+        return {
+            'fields': sorted(self.fields),
+            'names': sorted(self.names),
+            'indexes': {
+                field: [[value, name] for value, name in pairs]
+                for field, pairs in self.pairs.items() if pairs},
+        }
+
+
+def _load_indexes(session, fname, fields):
+    fs = session.fs
+    cache = session.store.cache
+    persisted = None
+    if cache is not None:
+        oid = fs.hash(fname)
+        key = (getattr(fs, 'db', None), fname)
+        persisted = cache.get(oid, key)
+
+    if persisted is None:
+        with fs.open(fname, 'rb') as stream:
+            data = stream.read()
+        loaded = session.store.loads(data)
+        persisted = (
+            tuple(loaded['fields']),
+            frozenset(loaded['names']),
+            {field: tuple((value, name) for value, name in pairs)
+             for field, pairs in loaded['indexes'].items()})
+        if cache is not None:
+            cache.set(oid, key, persisted, len(data))
+
+    persisted_fields, names, pairs = persisted
+    if sorted(persisted_fields) != sorted(fields):
+        return None
+
+    indexes = _FolderIndexes(fields)
+    indexes.names = set(names)
+    indexes.pairs = {field: list(items) for field, items in pairs.items()}
+    indexes.values = {field: {name: value for value, name in items}
+                      for field, items in pairs.items()}
+    return indexes
+
+
 class _NotInCacheType(object):
 
     def __nonzero__(self):
@@ -384,6 +1892,7 @@ _NotInCache = _NotInCacheType()
 
 class _Session(object):
     closed = False
+    readonly = False
     root = _NotInCache
 
     def __init__(self, store):
@@ -413,13 +1922,21 @@ class _Session(object):
         """
         Part of datamanager API.
         """
+        # AcidFS locks the repository while committing with a POSIX lock,
+        # which doesn't exclude other threads in the same process, so commits
+        # from different threads are serialized here, until AcidFS is done.
+        # The lock is reentrant, since several stores for the same repository
+        # may take part in one transaction.
+        lock = _commit_lock(getattr(self.fs, 'db', None))
+        lock.acquire()
+        tx.addAfterCommitHook(lambda status: lock.release())
         self.flush()
 
     def flush(self):
-        if self.root:
+        if self.root is not _NotInCache:
             state = self.root.__dumpling__
-            if state.dirty or state.dirty_children:
-                _save(self.fs, self.root)
+            if state.dirty or state.dirty_children or state.logs_dirty:
+                _save(self.store, self.root)
 
     def tpc_finish(self, tx):
         """
@@ -458,7 +1975,84 @@ class _Session(object):
         set_dirty(root)
 
     def load(self, path, file, parent, name):
-        obj = yaml.load(self.fs.open(file))
+        obj, = self.decode([file])
+        return self._loaded(obj, path, parent, name)
+
+    def load_many(self, requests, executor=None):
+        """
+        Loads several objects at once.  `requests` is a sequence of
+        `(path, file, parent, name)` tuples, as would be passed to `load`.
+        """
+        objs = self.decode([file for path, file, parent, name in requests],
+                           executor)
+        return [self._loaded(obj, path, parent, name)
+                for obj, (path, file, parent, name) in zip(objs, requests)]
+
+    def decode(self, files, executor=None):
+        """
+        Returns freshly decoded objects for each of `files`.  When more than
+        one file is requested, data is read from Git in a single pass and may
+        be decoded in parallel using `executor`.  The Git object id of the
+        file each model was decoded from is remembered, so that saving a model
+        which hasn't actually changed doesn't rewrite its file.
+
+        Decoded models are kept in the store's cache and shared by every
+        session, in every thread, which loads them.  Each session gets its own
+        shallow copy of a model, whose field values are only copied when
+        they're first accessed through the model's fields, so that they may
+        be changed.
+        """
+        fs = self.fs
+        cache = self.store.cache
+        batch = len(files) > 1 and hasattr(fs, '_session')
+        if batch:
+            oids = _blob_oids(fs, files)
+        elif cache is not None:
+            oids = [fs.hash(file) for file in files]
+        else:
+            oids = [None] * len(files)
+
+        db = getattr(fs, 'db', None)
+        objs = [None] * len(files)
+        missing = []
+        for i, file in enumerate(files):
+            obj = None
+            if cache is not None:
+                obj = cache.get(oids[i], (db, file))
+            if obj is None:
+                missing.append(i)
+            else:
+                objs[i] = _share(obj)
+
+        if missing:
+            if batch:
+                datas = _read_blobs(db, [oids[i] for i in missing])
+            else:
+                datas = []
+                for i in missing:
+                    with fs.open(files[i], 'rb') as stream:
+                        datas.append(stream.read())
+
+            load = self.store.loads
+            if executor is not None:
+                decoded = executor.map(load, datas)
+            else:
+                decoded = map(load, datas)
+            for i, data, obj in zip(missing, datas, decoded):
+                if cache is not None:
+                    cache.set(oids[i], (db, files[i]), obj, len(data))
+                    obj = _share(obj)
+                elif oids[i] is None:
+                    oids[i] = _git_oid(data)
+                objs[i] = obj
+
+        for file, oid, obj in zip(files, oids, objs):
+            if getattr(obj, '__dumpling_model__', False):
+                obj.__dumpling__.stored_as = (file, oid)
+
+        return objs
+
+    def _loaded(self, obj, path, parent, name):
         state = obj.__dumpling__
         state.session = self
         state.path = path
@@ -468,52 +2062,435 @@ class _Session(object):
         return obj
 
 
-def _save(fs, obj):
+_commit_locks = {}
+
+
+def _commit_lock(db):
+    return _commit_locks.setdefault(db, threading.RLock())
+
+
+def _share(obj):
+    """
+    Returns a copy of a cached, decoded object, for use by a session.  A model
+    is copied shallowly, with its field values marked as shared, to be copied
+    when they're first accessed through the model's fields.  Anything else is
+    copied deeply.
+    """
+    if not getattr(obj, '__dumpling_model__', False):
+        return copy.deepcopy(obj)
+    cls = type(obj)
+    copied = cls.__new__(cls)
+    copied.__dict__.update(obj.__dict__)
+    copied.__dumpling__.shared = set(obj.__dict__)
+    return copied
+
+
+class _ReadOnlySession(_Session):
+    """
+    A session for reading a snapshot of a store, as of `commit`, outside of
+    any transaction.
+    """
+    readonly = True
+
+    def __init__(self, store, commit):
+        self.store = store
+        self.fs = _SnapshotFS(store.fs, commit)
+
+    def flush(self):
+        pass  # Nothing can be changed
+
+    def set_root(self, root):
+        # Store has no root yet, `root` is a new, empty one
+        self.root = self._loaded(root, '/', None, None)
+
+
+class _SnapshotFS(object):
+    """
+    Implements the read only parts of the `AcidFS` API, and the parts of its
+    internals used by Dumpling, for the tree of a commit, without joining a
+    transaction.  Git trees are read as they are needed.
+    """
+
+    def __init__(self, fs, commit):
+        from acidfs import _TreeNode
+        self.db = fs.db
+        self.path_encoding = fs.path_encoding
+        self.commit = commit
+        if commit is None:
+            # No commits yet
+            self.tree = _TreeNode(self.db, self.path_encoding)
+        else:
+            if isinstance(commit, bytes):
+                commit = commit.decode('ascii')
+            try:
+                tree = subprocess.check_output(
+                    ['git', 'rev-parse', '--verify', '-q',
+                     commit + '^{tree}'], cwd=self.db).strip()
+            except subprocess.CalledProcessError:
+                raise ValueError(u"No such commit: {0}".format(commit))
+            self.tree = _TreeNode.read(self.db, tree, self.path_encoding)
+
+    def _session(self):
+        return self
+
+    def _mkpath(self, path):
+        return [name for name in path.split('/') if name]
+
+    def find(self, path):
+        return self.tree.find(path)
+
+    def open(self, path, mode='r'):
+        if mode not in ('r', 'rb'):
+            raise ValueError(u"Snapshots are read only.")
+        node = self.find(self._mkpath(path))
+        if node is None or hasattr(node, 'contents'):
+            raise IOError(errno.ENOENT, 'No such file', path)
+        stream = io.BufferedReader(node.open())
+        if mode == 'r':
+            stream = io.TextIOWrapper(stream, 'utf-8')
+        return stream
+
+    def hash(self, path=''):
+        node = self.find(self._mkpath(path))
+        if node is None:
+            raise IOError(errno.ENOENT, 'No such file or directory', path)
+        return node.hash()
+
+    def exists(self, path):
+        return self.find(self._mkpath(path)) is not None
+
+    def isdir(self, path):
+        return hasattr(self.find(self._mkpath(path)), 'contents')
+
+    def listdir(self, path=''):
+        node = self.find(self._mkpath(path))
+        if node is None or not hasattr(node, 'contents'):
+            raise IOError(errno.ENOENT, 'No such directory', path)
+        return list(node.contents.keys())
+
+
+def _head_commit(fs):
+    """
+    Returns the id of the most recent commit to the head of an AcidFS
+    repository, or `None` if nothing has been committed yet.  Refs are read
+    directly, where possible, since this is done for every read only request.
+    """
+    db = fs.db
+    if fs.head == 'HEAD':
+        with open(os.path.join(db, 'HEAD')) as f:
+            ref = f.read().strip()
+        if not ref.startswith('ref: '):
+            return ref.encode('ascii')  # Detached head
+        ref = ref[5:]
+    else:
+        ref = 'refs/heads/' + fs.head
+    try:
+        with open(os.path.join(db, ref)) as f:
+            return f.read().strip().encode('ascii')
+    except IOError:
+        pass
+    try:
+        # Packed ref
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--verify', '-q', ref], cwd=db).strip()
+    except subprocess.CalledProcessError:
+        return None
+
+
+def _save(store, obj):
+    """
+    Writes out the dirty objects in the tree rooted at `obj`.
+
+    Saving is done in two phases.  First the tree is walked to collect the
+    operations needed to bring the filesystem up to date, in path order.  Then
+    the dirty objects are serialized and the operations carried out.  Large
+    saves, of at least `store.save_threshold` objects, are serialized
+    concurrently if the store has `save_workers`.
+    """
+    ops = []
+    _collect_saves(store, obj, ops)
+
+    dumps = [op for op in ops if op[0] == 'dump']
+    backends = [op[3] for op in dumps]
+    objs = [op[2] for op in dumps]
+    executor = store.save_executor
+    if executor is not None and len(dumps) >= store.save_threshold:
+        datas = executor.map(_dumps, backends, objs)
+    else:
+        datas = map(_dumps, backends, objs)
+    datas = iter(list(datas))
+
+    fs = store.fs
+    written = skipped = 0
+    index = None
+    if store.fulltext:
+        index = FullTextIndex(fs, obj.__dumpling__.session.decode,
+                              store.backend_for(None).dumps)
+    for op in ops:
+        kind = op[0]
+        if index is not None:
+            index.apply(op)
+        if kind == 'dump':
+            if not _write_changed(fs, op[1], op[2], next(datas)):
+                skipped += 1
+                continue
+            written += 1
+            # Objects stored in their own files, rather than lazy fields
+            if index is not None and '__parent__' in getattr(
+                    op[2], '__dict__', ()):
+                _index_text(index, op[2])
+        elif kind == 'write':
+            with fs.open(op[1], 'wb') as stream:
+                stream.write(op[2])
+        elif kind == 'mkdirs':
+            _mkdirs(fs, op[1])
+        elif kind == 'mv':
+            fs.mv(op[1], op[2])
+        elif kind == 'rm':
+            fs.rm(op[1])
+        elif kind == 'rmtree':
+            fs.rmtree(op[1])
+        elif kind == 'mv?':
+            if fs.exists(op[1]):
+                fs.mv(op[1], op[2])
+        elif kind == 'rmtree?':
+            if fs.exists(op[1]):
+                fs.rmtree(op[1])
+
+    if index is not None:
+        index.flush()
+
+    store.writes += written
+    store.skipped_writes += skipped
+
+
+def _write_changed(fs, fname, obj, data):
+    """
+    Writes `data` to `fname` unless `obj` is a model which was loaded from or
+    last written to `fname`, with the same contents, and the file hasn't been
+    changed since.  Returns whether the file was written.
+    """
+    model = getattr(obj, '__dumpling_model__', False)
+    if model:
+        oid = _git_oid(data)
+        stored_as = obj.__dumpling__.stored_as
+        if (stored_as == (fname, oid) and fs.exists(fname) and
+                fs.hash(fname) == oid):
+            return False
+
+    with fs.open(fname, 'wb') as stream:
+        stream.write(data)
+    if model:
+        obj.__dumpling__.stored_as = (fname, oid)
+    return True
+
+
+def _git_oid(data):
+    """
+    Returns the Git object id of a blob containing `data`.
+    """
+    sha1 = hashlib.sha1(u'blob {0}\0'.format(len(data)).encode('ascii'))
+    sha1.update(data)
+    return sha1.hexdigest().encode('ascii')
+
+
+def _dumps(backend, obj):
+    return backend.dumps(obj)
+
+
+def _collect_saves(store, obj, ops):
     state = obj.__dumpling__
-    if state.dirty or state.detached_from:
-        if not fs.exists(state.path):
-            fs.mkdir(state.path)
-        fname = state.path + ('/__index__.yaml'
-                              if obj.__dumpling_folder__ else '.yaml')
-        with fs.open(fname, 'w') as stream:
-            yaml.dump(obj, stream, default_flow_style=False,
-                      allow_unicode=True)
+    moved = state.detached_from
+    lazy = obj.__dumpling_lazy__
+    indexes = None
+    if obj.__dumpling_folder__ and (moved or state.dirty_children):
+        # Read while the folder can still be found at its old location
+        indexes = _folder_indexes(obj)
+        contents = _folder_contents(obj)
+        if moved and isinstance(contents, _BigFolderContents):
+            # Every child must be moved along with the folder
+            contents.materialize()
+    logs = [getattr(obj, field.__name__) for field in obj.__dumpling_logs__]
+    if moved:
+        # Make sure lazy fields are read from the old location, so they can be
+        # written to the new location.
+        for field in lazy:
+            if getattr(obj, field.attr, _nodefault) is _nodefault:
+                value = _load_lazy(obj, field)
+                if value is not _nodefault:
+                    setattr(obj, field.attr, value)
+        for log in logs:
+            log._load()
+            log._replace = True
+    state.detached_from = None
+    # Replaced entries may still be in the object's own file, where earlier
+    # versions stored them, so the object is written too.
+    if state.dirty or moved or any(log._replace for log in logs):
+        if obj.__dumpling_folder__:
+            ops.append(('mkdirs', state.path))
+            fname = state.path + '/__index__.yaml'
+        else:
+            fname = state.path + '.yaml'
+            ops.append(('mkdirs', fname.rsplit('/', 1)[0]))
+        backend = store.backend_for(obj)
+        ops.append(('dump', fname, obj, backend))
+        for field in lazy:
+            value = getattr(obj, field.attr, _nodefault)
+            if value is not _nodefault:
+                fname = _lazy_file(obj, state.path, field.__name__)
+                ops.append(('mkdirs', fname.rsplit('/', 1)[0]))
+                ops.append(('dump', fname, value, backend))
         obj.__dumpling__.dirty = False
 
+    for log in logs:
+        _collect_log(store, obj, state.path, log, store.backend_for(obj), ops)
+    state.logs_dirty = False
+
     if obj.__dumpling_folder__:
         def rm(entry):
+            if not entry.persisted or entry.detached_from:
+                # Not written here, or is still in its old location which will
+                # be removed along with the old parent.
+                return
             if entry.is_folder:
-                fs.rmtree(entry.path)
+                ops.append(('rmtree', entry.path))
             else:
-                fs.rm(entry.path + '.yaml')
-
-        for entry in _folder_contents(obj).values():
+                ops.append(('rm', entry.path + '.yaml'))
+                ops.append(('rmtree?', entry.path))  # lazy fields
+
+        # Deletions are done last, since a deleted entry may be the source of
+        # a subtree being moved elsewhere in this folder.
+        contents = _folder_contents(obj)
+        if moved:
+            # Moved folder, every child must be moved along with it
+            names = contents.keys()
+        else:
+            names = state.dirty_children
+        state.dirty_children = _clean
+        deleted = []
+        saved = []
+        for name in sorted(names):
+            entry = contents.get(name)
+            if entry is None:
+                continue
             if entry.deleted:
-                rm(entry)
-            elif entry.loaded:
+                deleted.append(entry)
+            elif entry.loaded is not None:
                 if entry.replaces:
-                    prev = entry.replaces
-                    rm(prev)
+                    rm(entry.replaces)
+                    entry.replaces = None
+                entry.detached_from = None
+                entry.persisted = True
                 child_state = entry.loaded.__dumpling__
                 if (child_state.detached_from or
                         child_state.dirty or
-                        child_state.dirty_children):
-                    _save(fs, entry.loaded)
+                        child_state.dirty_children or
+                        child_state.logs_dirty):
+                    _collect_saves(store, entry.loaded, ops)
+                    saved.append(entry.name)
+                    if indexes is not None:
+                        indexes.add(entry.name, entry.loaded)
             elif entry.detached_from:
+                ops.append(('mkdirs', entry.path.rsplit('/', 1)[0]))
                 if entry.is_folder:
-                    fs.mv(entry.detached_from, entry.path)
+                    ops.append(('mv', entry.detached_from, entry.path))
                 else:
-                    fs.mv(entry.detached_from + '.yaml', entry.path + '.yaml')
+                    ops.append(('mv', entry.detached_from + '.yaml',
+                                entry.path + '.yaml'))
+                    ops.append(('mv?', entry.detached_from, entry.path))
+                entry.detached_from = None
+
+        for entry in deleted:
+            if entry.replaces:
+                rm(entry.replaces)
+            rm(entry)
+            del contents[entry.name]
+
+        if isinstance(contents, _BigFolderContents):
+            _collect_keys(store, state.path, contents.tree, moved, ops)
+
+        order = state.folder_order
+        sort_key = _sort_key(obj)
+        if saved and sort_key:
+            # Sort values may depend on the children's contents
+            order = _folder_order(obj, sort_key)
+            order.update(saved)
+        if (order is not None and order.version is not None and
+                (order.dirty or moved)):
+            ops.append(('dump', state.path.rstrip('/') + '/__order__',
+                        order.dump(), store.backend_for(None)))
+            order.dirty = False
+
+        if indexes is not None and (indexes.dirty or moved):
+            ops.append(('mkdirs', state.path))
+            ops.append(('dump', state.path.rstrip('/') + '/__indexes__',
+                        indexes.dump(), store.backend_for(None)))
+            indexes.dirty = False
+
+
+def _collect_keys(store, path, tree, moved, ops):
+    fname = path.rstrip('/') + '/__keys__'
+    if moved:
+        # Written afresh along with the children at the new location
+        tree.rewrite()
+    if tree.dirty:
+        ops.append(('mkdirs', fname))
+    for id in sorted(tree.removed):
+        ops.append(('rm', '{0}/{1}'.format(fname, id)))
+    backend = store.backend_for(None)
+    for id in sorted(tree.dirty):
+        ops.append(('dump', '{0}/{1}'.format(fname, id), tree.pages[id],
+                    backend))
+    tree.dirty.clear()
+    tree.removed.clear()
+    tree.new.clear()
+
+
+def _collect_log(store, obj, path, log, backend, ops):
+    """
+    Collects the operations needed to write the entries added to `log` since
+    it was last saved, as a new segment.  If the log's entries have been
+    replaced, its old segments are removed and its entries are written as a
+    single segment.
+    """
+    dirname = _lazy_file(obj, path, log._name, '.log')
+    if log._replace:
+        entries = log._load()
+        ops.append(('rmtree?', dirname))
+        segment = 0
+    else:
+        entries = log._pending
+        if not entries:
+            return
+        fs = store.fs
+        segment = len(fs.listdir(dirname)) if fs.exists(dirname) else 0
+    if entries:
+        ops.append(('mkdirs', dirname))
+        ops.append(('dump', u'{0}/{1:08d}'.format(dirname, segment),
+                    list(entries), backend))
+    log._pending = []
+    log._replace = False
+
+
+def _mkdirs(fs, path):
+    if path and not fs.exists(path):
+        fs.mkdirs(path)
 
 
 _detached = object()
 _unattached = object()
+_clean = frozenset()
 
 
 class _ObjectState(object):
     dirty = False
-    dirty_children = False
+    dirty_children = _clean
     folder_contents = None
+    folder_order = None
+    folder_indexes = None
+    logs_dirty = False
+    stored_as = None  # File name and Git object id of last load or save
+    shared = None  # Attributes whose values are shared with the cache
     session = _unattached
     detached_from = None
 
@@ -587,7 +2564,7 @@ class PersistentList(list):
         _connect(self, *self)
 
 
-yaml.add_representer(
+_add_representer(
     PersistentList,
     lambda dumper, value: dumper.represent_sequence(
         u'tag:yaml.org,2002:seq', value))
@@ -635,12 +2612,112 @@ class PersistentDict(dict):
         super(PersistentDict, self).update(mapping)
 
 
-yaml.add_representer(
+_add_representer(
     PersistentDict,
     lambda dumper, value: dumper.represent_mapping(
         u'tag:yaml.org,2002:map', value))
 
 
+class PersistentLog(object):
+    """
+    An append only sequence, used as the value of fields declared with
+    `log=True`.
+
+    Entries are only read when the log is read, so appending to a log doesn't
+    require loading it.  Each time an object is saved, the entries appended to
+    its logs since it was last saved are written as a new segment, without
+    rewriting the object or the entries already stored.  Entries should not be
+    modified after they've been appended.
+
+    Since each save adds a segment, a log which is appended to in many
+    transactions may be compacted, to rewrite its entries as a single segment.
+    """
+
+    def __init__(self, entries=None):
+        self._entries = None if entries is None else list(entries)
+        self._pending = []
+        self._replace = False
+        self._owner = None
+        self._name = None
+
+    def append(self, entry):
+        self.extend([entry])
+
+    def extend(self, entries):
+        entries = list(entries)
+        if not entries:
+            return
+        self._pending.extend(entries)
+        if self._entries is not None:
+            self._entries.extend(entries)
+        self._changed()
+
+    def compact(self):
+        """
+        Rewrites all of the entries of the log as a single segment, the next
+        time its object is saved.
+        """
+        self._load()
+        self._replace = True
+        self._changed()
+
+    def __len__(self):
+        return len(self._load())
+
+    def __iter__(self):
+        return iter(self._load())
+
+    def __getitem__(self, index):
+        return self._load()[index]
+
+    def __eq__(self, other):
+        if isinstance(other, PersistentLog):
+            other = other._load()
+        return self._load() == other
+
+    def __ne__(self, other):
+        return not self == other
+
+    __hash__ = None
+
+    def __repr__(self):
+        return 'PersistentLog({0!r})'.format(self._load())
+
+    def _bind(self, obj, name):
+        self._owner = obj
+        self._name = name
+
+    def _load(self):
+        entries = self._entries
+        if entries is None:
+            entries = []
+            if self._owner is not None:
+                entries.extend(_load_log(self._owner, self._name))
+            entries.extend(self._pending)
+            self._entries = entries
+        return entries
+
+    def _changed(self):
+        obj = self._owner
+        if obj is None:
+            return
+        _check_writable(obj)
+        if '__parent__' in obj.__dict__:
+            # Stored in its own file, only the log needs to be saved
+            obj.__dumpling__.logs_dirty = True
+            folder = obj.__parent__
+            if folder is not None:
+                set_folder_dirty(folder, obj.__name__)
+        else:
+            set_dirty(obj)
+
+
+_add_representer(
+    PersistentLog,
+    lambda dumper, value: dumper.represent_sequence(
+        u'tag:yaml.org,2002:seq', list(value)))
+
+
 def _connect(model, *targets):
     top = getattr(model.__dumpling__, 'top', model)
     for target in targets:
@@ -662,17 +2739,59 @@ else:    # pragma no cover
 
 if not PY3:  # pragma no cover
     # Avoid ugly !!python/unicode tags
-    yaml.add_representer(
+    _add_representer(
         string_type,
         lambda dumper, value: dumper.represent_scalar(
             u'tag:yaml.org,2002:str', value))
 
     # Make sure all strings are unicode
-    yaml.add_constructor(
+    _add_constructor(
         u'tag:yaml.org,2002:str',
         lambda loader, node: string_type(loader.construct_scalar(node)))
 
 
+def _represent_complex(dumper, value):
+    if value.imag == 0.0:
+        data = repr(value.real)
+    elif value.real == 0.0:
+        data = u'{0!r}j'.format(value.imag)
+    elif value.imag > 0:
+        data = u'{0!r}+{1!r}j'.format(value.real, value.imag)
+    else:
+        data = u'{0!r}{1!r}j'.format(value.real, value.imag)
+    return dumper.represent_scalar(u'tag:yaml.org,2002:python/complex', data)
+
+
+# Earlier versions used PyYAML's default dumper, which stores some types with
+# Python specific tags that the safe loaders don't know.  They're supported
+# here, as they were then, so existing stores can still be read.  Arbitrary
+# Python objects, tagged ``!!python/object``, still can't be loaded, since
+# doing so isn't safe.
+_add_representer(
+    tuple,
+    lambda dumper, value: dumper.represent_sequence(
+        u'tag:yaml.org,2002:python/tuple', value))
+_add_constructor(
+    u'tag:yaml.org,2002:python/tuple',
+    lambda loader, node: tuple(loader.construct_sequence(node)))
+
+_add_representer(complex, _represent_complex)
+_add_constructor(
+    u'tag:yaml.org,2002:python/complex',
+    lambda loader, node: complex(loader.construct_scalar(node)))
+
+_add_constructor(
+    u'tag:yaml.org,2002:python/long',
+    lambda loader, node: int(loader.construct_scalar(node)))
+
+_add_constructor(
+    u'tag:yaml.org,2002:python/str',
+    lambda loader, node: string_type(loader.construct_scalar(node)))
+_add_constructor(
+    u'tag:yaml.org,2002:python/unicode',
+    lambda loader, node: string_type(loader.construct_scalar(node)))
+
+
 @folder
 class Folder(object):
     pass
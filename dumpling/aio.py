@@ -0,0 +1,94 @@
+# Asynchronous blob I/O.  Kept in its own module, since it uses asynchronous
+# generators, which need Python 3.6 or later, and is imported by `Blob` as
+# needed.
+import asyncio
+
+from .blob import _blobstore
+
+try:
+    _running_loop = asyncio.get_running_loop
+except AttributeError:  # pragma no cover
+    # Python 3.6, where get_event_loop returns the running loop when called
+    # from a coroutine.
+    _running_loop = asyncio.get_event_loop
+
+
+async def awrite_from(blob, reader, size, executor=None):
+    """
+    Implements `Blob.awrite_from`.
+    """
+    blobstore = _blobstore(blob)
+    if executor is None:
+        executor = blobstore.io_executor
+    loop = _running_loop()
+    f = await loop.run_in_executor(executor, blobstore.new, blob)
+    pending = None
+    try:
+        async for chunk in _chunks(reader, size):
+            if pending is not None:
+                await pending
+            pending = loop.run_in_executor(executor, f.write, chunk)
+        if pending is not None:
+            await _finish(pending)
+    finally:
+        if pending is not None and not pending.done():
+            # Reading failed or was cancelled.  The stream can't be closed
+            # until the write in progress is done with it.
+            await _finish(pending, ignore_errors=True)
+        await loop.run_in_executor(executor, f.close)
+
+
+async def aiter_chunks(blob, size, start, end, executor=None):
+    """
+    Implements `Blob.aiter_chunks`.
+    """
+    if executor is None:
+        executor = _blobstore(blob).io_executor
+    loop = _running_loop()
+    chunks = blob.iter_chunks(size, start, end)
+    pending = loop.run_in_executor(executor, next, chunks, None)
+    try:
+        while True:
+            chunk = await pending
+            pending = None
+            if chunk is None:
+                break
+            # Read the next chunk while the consumer handles this one
+            pending = loop.run_in_executor(executor, next, chunks, None)
+            yield chunk
+    finally:
+        if pending is not None:
+            await _finish(pending, ignore_errors=True)
+        await loop.run_in_executor(executor, chunks.close)
+
+
+async def _chunks(reader, size):
+    """
+    Iterates over the chunks of data read from `reader`.
+    """
+    if hasattr(reader, 'read'):
+        while True:
+            chunk = await reader.read(size)
+            if not chunk:
+                break
+            yield chunk
+    else:
+        async for chunk in reader:
+            if chunk:
+                yield chunk
+
+
+async def _finish(future, ignore_errors=False):
+    """
+    Waits for `future`, which is running in a thread, even if the waiting
+    coroutine is cancelled, since the thread can't be.
+    """
+    try:
+        await asyncio.shield(future)
+    except asyncio.CancelledError:
+        await asyncio.wait([future])
+        if not ignore_errors:
+            raise
+    except Exception:
+        if not ignore_errors:
+            raise
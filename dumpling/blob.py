@@ -1,20 +1,151 @@
+import collections
+import errno
+import gzip
 import hashlib
+import io
+import mmap
 import os
+import re
 import shutil
+import subprocess
 import tempfile
+import time
 
-from . import Field, model, _session_for
+from . import Field, model, _read_blobs, _session_for
 
+try:
+    import lzma
+except ImportError:  # pragma no cover
+    lzma = None
 
-class FileSystemBlobStore(object):
+
+#: Content types which are skipped by default when compressing blobs, since
+#: they are usually compressed already.
+DEFAULT_SKIP_TYPES = (
+    'audio/',
+    'image/',
+    'video/',
+    'application/gzip',
+    'application/x-7z-compressed',
+    'application/x-bzip2',
+    'application/x-gzip',
+    'application/x-rar-compressed',
+    'application/x-xz',
+    'application/zip',
+)
+
+# File name suffixes of compressed blobs
+_suffixes = {'zlib': '.gz', 'lzma': '.xz'}
+
+
+class BlobStore(object):
+    """
+    The interface implemented by blob stores.
+
+    Blobs are stored under the hexadecimal digests of their contents,
+    optionally compressed.  The digests are SHA-1, unless the store uses
+    another hash.  Blob stores must implement `new`, `stream` and
+    `sizeof`.  The other methods have default implementations in terms of
+    those, which blob stores may override with more efficient ones.
+
+    The asynchronous methods of `Blob` do their blocking I/O in a pool of
+    `io_workers` threads, shared by all blobs in the store.
+    """
+    io_workers = 4
+    _io_executor = None
+
+    @property
+    def io_executor(self):
+        """
+        The thread pool used for the asynchronous methods of `Blob` and for
+        storing blobs in bulk.
+        """
+        executor = self._io_executor
+        if executor is None:
+            from concurrent.futures import ThreadPoolExecutor
+            self._io_executor = executor = ThreadPoolExecutor(
+                self.io_workers)
+        return executor
+
+    def new(self, blob):
+        """
+        Returns a stream for writing the contents of `blob`.  When the stream
+        is closed the data is stored and its digest, compression and size are
+        recorded in `blob`.
+        """
+        raise NotImplementedError
+
+    def stream(self, digest, buffering=-1, compression=None):
+        """
+        Returns a stream for reading the blob stored under `digest` with
+        `compression`.  The stream must support `readinto` and `seek`.
+        Raises `IOError` if there is no such blob.
+        """
+        raise NotImplementedError
+
+    def sizeof(self, digest, compression=None):
+        """
+        Returns the stored size of the blob stored under `digest`.
+        """
+        raise NotImplementedError
+
+    def read_range(self, digest, offset, length, compression=None):
+        """
+        Returns `length` bytes of a blob's contents, starting at `offset`.
+        """
+        with self.stream(digest, 0, compression) as f:
+            f.seek(offset)
+            return _read(f, length)
+
+    def import_file(self, blob, path, move=False, link=False):
+        """
+        Stores the file at `path` as the contents of `blob`, removing the file
+        if `move` is true.  `link` is a hint which stores that can't share
+        files with the local filesystem may ignore.
+        """
+        with open(path, 'rb') as f:
+            with self.new(blob) as out:
+                _copy(f, out)
+        if move:
+            os.remove(path)
+
+
+class FileSystemBlobStore(BlobStore):
+    """
+    Stores blobs as files named by the digest of their contents, computed with
+    the hash named by `algorithm`, which may be any hash supported by
+    `hashlib`, such as ``'sha256'`` or ``'blake2b'``.  Each blob records its
+    own digest, so blobs stored with a different hash can still be read after
+    changing a store's `algorithm`.
+
+    Files are spread across subdirectories named for leading characters of
+    their digests, according to `fanout`, a sequence of the widths of the
+    subdirectory names at each level.  The default, ``(2, 2)``, stores a blob
+    with digest ``abcdef...`` as ``ab/cd/abcdef...``.  A `fanout` of ``()``
+    stores all blobs in a single directory.  Blobs stored in a single
+    directory, as was done by earlier versions, can still be found, and can be
+    moved into the configured layout using `migrate`.
+
+    Blobs may be compressed, by passing a `compression` of ``'zlib'`` or
+    ``'lzma'``.  Blobs whose `content_type` matches an entry in `skip_types`
+    are not compressed, since compressing data which is already compressed
+    only wastes time.  Entries ending in ``'/'`` match any content type which
+    starts with them.  The compression used for each blob is recorded in the
+    blob, so changing a store's compression doesn't affect blobs already
+    stored.
+    """
 
     class BlobOutputStream(object):
-        def __init__(self, blob, path):
+        def __init__(self, blob, blobstore):
             self.blob = blob
-            self.path = path
-            self.sha1 = hashlib.sha1()
-            fd, self.tmppath = tempfile.mkstemp(prefix='.blob-', dir=path)
-            self.f = os.fdopen(fd, 'wb')
+            self.blobstore = blobstore
+            self.hasher = hashlib.new(blobstore.algorithm)
+            self.size = 0
+            self.compression = blobstore._compression_for(blob.content_type)
+            fd, self.tmppath = tempfile.mkstemp(
+                prefix='.blob-', dir=blobstore.path)
+            self.raw = os.fdopen(fd, 'wb')
+            self.f = _writer(self.compression, self.raw)
 
         def __enter__(self):
             return self
@@ -23,61 +154,653 @@ class FileSystemBlobStore(object):
             self.close()
 
         def write(self, block):
-            self.sha1.update(block)
+            self.hasher.update(block)
+            self.size += len(block)
             self.f.write(block)
 
         def close(self):
             self.f.close()
-            self.blob._location = digest = self.sha1.hexdigest()
-            os.rename(self.tmppath, os.path.join(self.path, digest))
+            self.raw.close()
+            digest = self.hasher.hexdigest()
+            blobstore = self.blobstore
+            path, compression = blobstore._find(digest)
+            if path is not None and _owned(path):
+                # Same content is already stored.  Touch it so it can't be
+                # mistaken for garbage before this blob is committed.
+                os.remove(self.tmppath)
+                os.utime(path, None)
+            else:
+                # Not stored, or only as a file hard linked in by
+                # `import_file`, which is replaced with a copy of the store's
+                # own, rather than sharing a file which may yet be changed.
+                compression = self.compression
+                path = blobstore._path(digest + _suffixes.get(compression, ''))
+                _makedirs(os.path.dirname(path))
+                os.rename(self.tmppath, path)
+            _stored(self.blob, digest, compression, self.size)
             self.f = None
 
         def __del__(self):
             if self.f:
                 self.close()
 
-    def __init__(self, path):
+    def __init__(self, path, fanout=(2, 2), compression=None,
+                 skip_types=DEFAULT_SKIP_TYPES, algorithm='sha1'):
         self.path = path
+        self.fanout = tuple(fanout)
+        if compression not in (None, 'zlib', 'lzma') or (
+                compression == 'lzma' and lzma is None):
+            raise ValueError(
+                u"Unsupported compression: {0}".format(compression))
+        self.compression = compression
+        self.skip_types = tuple(skip_types)
+        try:
+            hashlib.new(algorithm)
+        except ValueError:
+            raise ValueError(u"Unsupported hash: {0}".format(algorithm))
+        self.algorithm = algorithm
         if not os.path.exists(path):
             os.makedirs(path)
 
     def new(self, blob):
-        return self.BlobOutputStream(blob, self.path)
+        return self.BlobOutputStream(blob, self)
+
+    def stream(self, digest, buffering=-1, compression=None):
+        """
+        Opens a stored blob for reading, decompressing it if it was stored
+        with `compression`.
+        """
+        paths = self._paths(digest + _suffixes.get(compression, ''))
+        for path in paths[:-1]:
+            try:
+                return _reader(compression, path, buffering)
+            except (IOError, OSError):
+                pass
+        return _reader(compression, paths[-1], buffering)
+
+    def sizeof(self, digest, compression=None):
+        """
+        Returns the size of the file in which a blob is stored.
+        """
+        paths = self._paths(digest + _suffixes.get(compression, ''))
+        for path in paths[:-1]:
+            try:
+                return os.stat(path).st_size
+            except OSError:
+                pass
+        return os.stat(paths[-1]).st_size
+
+    def read_range(self, digest, offset, length, compression=None):
+        if compression or not hasattr(os, 'pread'):
+            return super(FileSystemBlobStore, self).read_range(
+                digest, offset, length, compression)
+        with self.stream(digest, 0) as f:
+            return os.pread(f.fileno(), length, offset)
+
+    def import_file(self, blob, path, move=False, link=False):
+        """
+        Stores the file at `path` as the contents of `blob`, without copying
+        it through Python.  See `Blob.import_file`.
+        """
+        if self._compression_for(blob.content_type):
+            # Has to be rewritten anyway, in order to compress it
+            return super(FileSystemBlobStore, self).import_file(
+                blob, path, move)
+
+        digest, size = _hash_file(path, self.algorithm)
+        existing, compression = self._find(digest)
+        if existing is not None and _owned(existing):
+            os.utime(existing, None)
+            if move:
+                os.remove(path)
+        else:
+            compression = None
+            dst = self._path(digest)
+            _makedirs(os.path.dirname(dst))
+            self._import(path, dst, move, link)
+        _stored(blob, digest, compression, size)
+
+    def put_many(self, streams, executor=None):
+        """
+        Stores the contents of each of `streams` as a new blob and returns the
+        new `Blob` objects, in the same order as `streams`.  The streams are
+        hashed and written concurrently in `executor`, by default the store's
+        `io_executor`.  Since `hashlib` and file I/O release the GIL, this is
+        much faster than storing many blobs one at a time.  The blobs can then
+        be added to folders or assigned to fields of other objects.
+        """
+        if executor is None:
+            executor = self.io_executor
+        limit = self.io_workers * 2  # Don't run too far ahead of results
+        blobs = []
+        pending = collections.deque()
+        try:
+            for stream in streams:
+                if len(pending) >= limit:
+                    blobs.append(pending.popleft().result())
+                pending.append(executor.submit(self._put, stream))
+            while pending:
+                blobs.append(pending.popleft().result())
+        finally:
+            for future in pending:
+                future.cancel()
+        return blobs
+
+    def _put(self, stream):
+        blob = Blob()
+        with self.new(blob) as f:
+            _copy(stream, f)
+        return blob
+
+    def _import(self, src, dst, move, link):
+        if move:
+            try:
+                os.rename(src, dst)
+                return
+            except OSError as e:
+                if e.errno != errno.EXDEV:
+                    raise
+
+        fd, tmppath = tempfile.mkstemp(prefix='.blob-', dir=self.path)
+        try:
+            with os.fdopen(fd, 'wb') as out:
+                with open(src, 'rb') as f:
+                    if _reflink(f.fileno(), out.fileno()):
+                        pass
+                    elif link and not move and _link(src, dst):
+                        return
+                    else:
+                        _sendfile(f.fileno(), out.fileno(), 0,
+                                  os.fstat(f.fileno()).st_size)
+            os.rename(tmppath, dst)
+            tmppath = None
+        finally:
+            if tmppath is not None:
+                os.remove(tmppath)
+        if move:
+            os.remove(src)
+
+    def migrate(self):
+        """
+        Moves any blobs which are not stored according to the configured
+        `fanout` into place, and removes directories left empty.  Returns the
+        number of blobs moved.  May be used to move blobs from a single
+        directory into subdirectories, or to change the `fanout` of a store.
+        """
+        moved = 0
+        for dirpath, dirnames, filenames in os.walk(self.path, False):
+            for digest in filenames:
+                if digest.startswith('.'):
+                    continue
+                src = os.path.join(dirpath, digest)
+                dst = self._path(digest)
+                if src == dst:
+                    continue
+                if os.path.exists(dst):
+                    os.remove(src)
+                else:
+                    _makedirs(os.path.dirname(dst))
+                    os.rename(src, dst)
+                moved += 1
+            if dirpath != self.path and not os.listdir(dirpath):
+                os.rmdir(dirpath)
+        return moved
+
+    def gc(self, store, history=True, min_age=3600):
+        """
+        Removes blobs which are not referenced by any `Blob` in the Git
+        repository of `store`, and returns the number of bytes reclaimed.
+
+        By default, blobs referenced by any version of any object in the
+        repository are kept.  If `history` is false, only the committed head
+        used by `store` is searched for references, which is faster, but
+        removes blobs only referenced by earlier commits, so that those blobs
+        can no longer be read from a `Store.snapshot` of an earlier commit, or
+        by other branches sharing the blob store.  Blobs modified less
+        than `min_age` seconds ago are kept, since they may belong to
+        transactions which have not yet been committed.  Blobs hard linked in
+        by `Blob.import_file` are kept while the file they are linked to
+        still exists, since removing them wouldn't reclaim any space.
+        """
+        fs = store.fs
+        referenced = _referenced(fs.db, fs.head, history)
+        cutoff = time.time() - min_age
+        reclaimed = 0
+        for dirpath, dirnames, filenames in os.walk(self.path):
+            for fname in filenames:
+                digest = fname.split('.', 1)[0]
+                if not digest or digest in referenced:
+                    continue
+                path = os.path.join(dirpath, fname)
+                stat = os.stat(path)
+                if stat.st_nlink > 1:
+                    continue
+                # Files linked or moved into the store keep their original
+                # modification times, but not change times.
+                if max(stat.st_mtime, stat.st_ctime) > cutoff:
+                    continue
+                os.remove(path)
+                reclaimed += stat.st_size
+        return reclaimed
+
+    def _path(self, digest):
+        """
+        Returns the path at which a blob is stored, according to `fanout`.
+        """
+        parts = []
+        start = 0
+        for width in self.fanout:
+            parts.append(digest[start:start + width])
+            start += width
+        parts.append(digest)
+        return os.path.join(self.path, *parts)
+
+    def _paths(self, name):
+        """
+        Returns the paths at which a file may be found, which may still be
+        stored in a single directory.
+        """
+        paths = [self._path(name)]
+        if self.fanout:
+            paths.append(os.path.join(self.path, name))
+        return paths
+
+    def _find(self, digest):
+        """
+        Returns the path of an existing blob and the compression with which it
+        is stored, or `(None, None)` if the blob isn't stored.
+        """
+        compressions = [self.compression] + [
+            compression for compression in (None, 'zlib', 'lzma')
+            if compression != self.compression]
+        for compression in compressions:
+            name = digest + _suffixes.get(compression, '')
+            for path in self._paths(name):
+                if os.path.exists(path):
+                    return path, compression
+        return None, None
+
+    def _compression_for(self, content_type):
+        """
+        Returns the compression to use for a blob with `content_type`.
+        """
+        compression = self.compression
+        if compression and content_type:
+            content_type = content_type.split(';', 1)[0].strip().lower()
+            for skip in self.skip_types:
+                if content_type == skip or (
+                        skip.endswith('/') and content_type.startswith(skip)):
+                    return None
+        return compression
+
+
+def _writer(compression, f):
+    if compression == 'zlib':
+        return gzip.GzipFile(fileobj=f, mode='wb', mtime=0)
+    elif compression == 'lzma':
+        return lzma.LZMAFile(f, 'wb')
+    return f
+
+
+def _reader(compression, path, buffering=-1):
+    if compression == 'zlib':
+        return gzip.open(path, 'rb')
+    elif compression == 'lzma':
+        return lzma.open(path, 'rb')
+    return open(path, 'rb', buffering)
+
+
+def _stored(blob, digest, compression, size):
+    blob._location = digest
+    blob._compression = compression
+    blob._size = size
+
 
-    def stream(self, digest):
-        return open(os.path.join(self.path, digest), 'rb')
+def _copy(src, dst):
+    """
+    Copies the contents of the stream, `src`, to `dst`.
+    """
+    if hasattr(src, 'readinto'):
+        # Reuse a single buffer rather than allocating for each read
+        buf = bytearray(_BUFSIZE)
+        view = memoryview(buf)
+        while True:
+            n = src.readinto(buf)
+            if not n:
+                break
+            dst.write(view[:n])
+    else:
+        shutil.copyfileobj(src, dst, _BUFSIZE)
 
-    def sizeof(self, digest):
-        return os.stat(os.path.join(self.path, digest)).st_size
+
+def _hash_file(path, algorithm='sha1'):
+    """
+    Returns the digest and size of the file at `path`.
+    """
+    hasher = hashlib.new(algorithm)
+    size = 0
+    buf = bytearray(_BUFSIZE)
+    view = memoryview(buf)
+    with open(path, 'rb', 0) as f:
+        while True:
+            n = f.readinto(buf)
+            if not n:
+                break
+            hasher.update(view[:n])
+            size += n
+    return hasher.hexdigest(), size
+
+
+# The Linux ioctl to share the data of one file with another, on filesystems
+# which support copy on write.
+_FICLONE = 0x40049409
+
+
+def _reflink(src_fd, dst_fd):
+    try:
+        import fcntl
+        fcntl.ioctl(dst_fd, _FICLONE, src_fd)
+        return True
+    except (ImportError, IOError, OSError):
+        return False
+
+
+def _owned(path):
+    """
+    Returns whether the file at `path` belongs to the blob store alone, rather
+    than being hard linked to a file outside of it.
+    """
+    return os.stat(path).st_nlink == 1
+
+
+def _link(src, dst):
+    try:
+        os.link(src, dst)
+        return True
+    except OSError as e:
+        if e.errno == errno.EEXIST:
+            return True  # Stored concurrently by someone else
+        return False
+
+
+def _makedirs(path):
+    if not os.path.isdir(path):
+        try:
+            os.makedirs(path)
+        except OSError:
+            # Another thread or process may have created it
+            if not os.path.isdir(path):
+                raise
+
+
+# Size of the buffer used when copying blob data
+_BUFSIZE = 1024 * 1024
 
 
 @model
 class Blob(object):
     _location = Field()
+    _compression = Field(none=True, default=None)
+    _size = Field(none=True, default=None)
+    content_type = Field(none=True, default=None)
 
     def write_from(self, stream):
         blobstore = _blobstore(self)
         with blobstore.new(self) as f:
-            shutil.copyfileobj(stream, f)
+            _copy(stream, f)
 
-    def open(self, mode='r'):
+    def open(self, mode='r', buffering=-1):
+        """
+        Opens the blob for reading, with mode ``'r'``, or writing, with mode
+        ``'w'``.  A stream opened for reading supports `readinto`.  Passing
+        a `buffering` of ``0`` returns an unbuffered stream, whose `readinto`
+        reads straight from the file into the caller's buffer.
+        """
         blobstore = _blobstore(self)
         rw = mode.replace('b', '')
         if rw == 'r':
-            return blobstore.stream(self._location)
+            return blobstore.stream(
+                self._location, buffering, self._compression)
         elif rw == 'w':
             return blobstore.new(self)
         else:
             raise ValueError('Invalid mode for open: {0}'.format(mode))
 
+    def import_file(self, path, move=False, link=False):
+        """
+        Stores the existing file at `path` as the contents of this blob.  In
+        a `FileSystemBlobStore`, the file is hashed and then reflinked, on
+        filesystems with copy on write, so its contents are not written a
+        second time, or else copied.  If `move` is true, the file is moved
+        into the blob store instead.
+
+        If `link` is true, a file which can't be reflinked is hard linked into
+        the blob store rather than copied.  The file must then not be modified
+        in place afterwards, since that would change the blob's contents.
+        """
+        _blobstore(self).import_file(self, path, move, link)
+
+    def mmap(self):
+        """
+        Returns a read only memory map of the blob's contents.  An empty blob
+        can't be mapped, so ``b''`` is returned for an empty blob.  The stored
+        data of a compressed blob can't be mapped either, so its decompressed
+        contents are returned.
+        """
+        with self.open(buffering=0) as f:
+            fd = None if self._compression else _fileno(f)
+            if fd is None:
+                # Not stored in a file as is
+                return f.read()
+            if os.fstat(fd).st_size == 0:
+                return b''
+            return mmap.mmap(fd, 0, access=mmap.ACCESS_READ)
+
+    def sendfile(self, out, offset=0, count=None):
+        """
+        Writes the blob's contents, starting at `offset` and for `count`
+        bytes or to the end, to `out`, which may be a socket, file or file
+        descriptor, and returns the number of bytes written.  The data is
+        copied by the kernel, using `os.sendfile` or `os.copy_file_range`
+        where available, without passing through Python.
+        """
+        out_fd = out if isinstance(out, int) else out.fileno()
+        if hasattr(out, 'flush'):
+            out.flush()
+        if count is None:
+            count = max(len(self) - offset, 0)
+        with self.open(buffering=0) as f:
+            fd = None if self._compression else _fileno(f)
+            if fd is None:
+                # Has to pass through Python to be decompressed or fetched
+                f.seek(offset)
+                return _copy_to_fd(f, out_fd, count)
+            return _sendfile(fd, out_fd, offset, count)
+
+    def read_range(self, offset, length=None):
+        """
+        Returns `length` bytes of the blob's contents starting at `offset`,
+        or everything after `offset` if `length` is `None`.  Fewer bytes are
+        returned if the blob ends first.
+        """
+        if length is None:
+            length = max(len(self) - offset, 0)
+        return _blobstore(self).read_range(
+            self._location, offset, length, self._compression)
+
+    def iter_chunks(self, size=64 * 1024, start=0, end=None):
+        """
+        Iterates over the blob's contents from `start` up to, but not
+        including, `end`, or to the end of the blob if `end` is `None`, in
+        chunks of at most `size` bytes.  The blob is only read once, in order,
+        so a compressed blob only has to be decompressed once.
+        """
+        if end is None:
+            end = len(self)
+        with self.open(buffering=0) as f:
+            if start:
+                f.seek(start)
+            pos = start
+            while pos < end:
+                chunk = _read(f, min(size, end - pos))
+                if not chunk:
+                    break
+                yield chunk
+                pos += len(chunk)
+
+    def awrite_from(self, reader, size=64 * 1024, executor=None):
+        """
+        Coroutine which stores the data read from `reader`, an asyncio
+        stream or any object with a `read` coroutine, or an asynchronous
+        iterable of bytes, as the contents of the blob.  Writing is done in
+        `executor`, by default the blob store's `io_executor`, without
+        blocking the event loop.  At most one chunk of `size` bytes is
+        written while the next one is read, so a slow blob store slows down
+        reading rather than buffering the whole upload in memory.  Requires
+        Python 3.6 or later.
+        """
+        from .aio import awrite_from
+        return awrite_from(self, reader, size, executor)
+
+    def aiter_chunks(self, size=64 * 1024, start=0, end=None, executor=None):
+        """
+        Asynchronous version of `iter_chunks`, for use with ``async for``.
+        The blob is read in `executor`, by default the blob store's
+        `io_executor`, without blocking the event loop.  Only one chunk is
+        read ahead of the consumer.  Requires Python 3.6 or later.
+        """
+        from .aio import aiter_chunks
+        return aiter_chunks(self, size, start, end, executor)
+
     def __len__(self):
-        blobstore = _blobstore(self)
-        return blobstore.sizeof(self._location)
+        size = self._size
+        if size is None:
+            # Stored by an earlier version, which didn't record sizes.  Kept
+            # without marking the blob as changed, so it is saved along with
+            # the blob the next time the blob is saved anyway.
+            size = _blobstore(self).sizeof(self._location)
+            setattr(self, type(self)._size.attr, size)
+        return size
 
     def __nonzero__(self):
         return True
 
 
+def _sendfile(fd, out_fd, offset, count):
+    """
+    Copies `count` bytes from the file, `fd`, starting at `offset`, to
+    `out_fd`, using the fastest method available.
+    """
+    sent = 0
+    for name in ('sendfile', 'copy_file_range'):
+        copy = getattr(os, name, None)
+        if copy is None:
+            continue
+        try:
+            while sent < count:
+                if name == 'sendfile':
+                    n = copy(out_fd, fd, offset + sent, count - sent)
+                else:
+                    n = copy(fd, out_fd, count - sent, offset + sent)
+                if not n:
+                    return sent  # End of file
+                sent += n
+            return sent
+        except OSError as e:
+            # Not supported for these kinds of file, try something else
+            if sent or e.errno not in (errno.EINVAL, errno.ENOSYS,
+                                       errno.EXDEV, errno.ENOTSOCK,
+                                       errno.EOPNOTSUPP, errno.EBADF):
+                raise
+
+    with os.fdopen(os.dup(fd), 'rb') as f:
+        f.seek(offset)
+        return _copy_to_fd(f, out_fd, count)
+
+
+def _fileno(f):
+    try:
+        return f.fileno()
+    except (AttributeError, IOError, OSError, io.UnsupportedOperation):
+        return None
+
+
+def _read(f, length):
+    """
+    Reads `length` bytes from the stream, `f`, or until the end of the
+    stream, since unbuffered streams may return fewer bytes than asked for.
+    """
+    data = f.read(length)
+    if data is None or len(data) == length or not data:
+        return data or b''
+    chunks = [data]
+    length -= len(data)
+    while length:
+        data = f.read(length)
+        if not data:
+            break
+        chunks.append(data)
+        length -= len(data)
+    return b''.join(chunks)
+
+
+def _copy_to_fd(f, out_fd, count):
+    """
+    Copies up to `count` bytes from the stream, `f`, to `out_fd`.
+    """
+    sent = 0
+    buf = bytearray(min(_BUFSIZE, count))
+    view = memoryview(buf)
+    while sent < count:
+        n = f.readinto(view[:count - sent])
+        if not n:
+            break
+        _writeall(out_fd, view[:n])
+        sent += n
+    return sent
+
+
+def _writeall(fd, data):
+    while data:
+        data = data[os.write(fd, data):]
+
+
+# Matches the location of a blob in a serialized Blob, in YAML or JSON
+_reference = re.compile(br'_location["\']?\s*:\s*["\']?([0-9a-f]{40,128})')
+
+
+def _referenced(db, head, history, batch_size=1000):
+    """
+    Returns the set of blob locations referenced in the Git repository, `db`,
+    either in the tree of `head` or, if `history` is true, anywhere.
+    """
+    if not history:
+        try:
+            with open(os.devnull, 'wb') as devnull:
+                out = subprocess.check_output(
+                    ['git', 'ls-tree', '-r', head + '^{commit}', '--'],
+                    cwd=db, stderr=devnull)
+            oids = [line.split()[2] for line in out.splitlines()
+                    if line.split()[1] == b'blob']
+        except subprocess.CalledProcessError:
+            # Nothing committed to `head` yet, but other branches may still
+            # reference blobs, so search everything.
+            history = True
+    if history:
+        out = subprocess.check_output(
+            ['git', 'cat-file', '--batch-all-objects', '--batch-check'],
+            cwd=db)
+        oids = [line.split()[0] for line in out.splitlines()
+                if line.split()[1] == b'blob']
+
+    referenced = set()
+    for i in range(0, len(oids), batch_size):
+        for data in _read_blobs(db, oids[i:i + batch_size]):
+            referenced.update(
+                digest.decode('ascii') for digest in _reference.findall(data))
+    return referenced
+
+
 def _blobstore(obj):
     session = _session_for(obj)
     blobstore = session.store.blobstore
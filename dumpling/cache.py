@@ -0,0 +1,84 @@
+import collections
+import threading
+
+
+class ObjectCache(object):
+    """
+    A size bounded, least recently used cache of decoded objects which can be
+    shared by every session in a process.
+
+    Entries are keyed by location, typically a repository and a path within it,
+    and stamped with the Git object id of the data they were decoded from.
+    Since Git object ids are content addresses, an entry can only ever be
+    served for exactly the content it was decoded from.  When the head of the
+    repository moves on and the object at a path changes, lookups for the new
+    object id miss and the stale entry is dropped, to be replaced when the path
+    is loaded again.
+
+    The cache is bounded both by number of objects, ``max_objects``, and by an
+    approximation of memory used, ``max_bytes``, which is taken to be the size
+    of the serialized data.  Either bound may be `None` for no limit.
+    """
+    hits = 0
+    misses = 0
+
+    def __init__(self, max_objects=10000, max_bytes=64 * 1024 * 1024):
+        self.max_objects = max_objects
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.clear()
+
+    def get(self, oid, key):
+        """
+        Returns the cached object for `key`, if it was decoded from the object
+        with id `oid`, otherwise returns `None`.
+        """
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry is None or entry[0] != oid:
+                if entry is not None:
+                    self.nbytes -= entry[2]
+                self.misses += 1
+                return None
+
+            # Reinsert to mark as most recently used
+            self.entries[key] = entry
+            self.hits += 1
+            return entry[1]
+
+    def set(self, oid, key, obj, size):
+        """
+        Stores `obj`, decoded from the object with id `oid` and approximately
+        `size` bytes in size, at `key`.
+        """
+        if self.max_bytes is not None and size > self.max_bytes:
+            return
+
+        with self.lock:
+            entries = self.entries
+            prev = entries.pop(key, None)
+            if prev is not None:
+                self.nbytes -= prev[2]
+            entries[key] = (oid, obj, size)
+            self.nbytes += size
+
+            max_objects, max_bytes = self.max_objects, self.max_bytes
+            while ((max_objects is not None and len(entries) > max_objects) or
+                   (max_bytes is not None and self.nbytes > max_bytes)):
+                key, entry = next(iter(entries.items()))
+                del entries[key]
+                self.nbytes -= entry[2]
+
+    def clear(self):
+        """
+        Removes everything from the cache.
+        """
+        self.entries = collections.OrderedDict()
+        self.nbytes = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+
+#: The cache shared by default by all stores in a process.
+default_cache = ObjectCache()
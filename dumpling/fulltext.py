@@ -0,0 +1,261 @@
+import hashlib
+import re
+
+_word = re.compile(r'\w+', re.UNICODE)
+
+
+def terms(text):
+    """
+    Returns the list of terms, lower cased words, found in `text`.
+    """
+    return _word.findall(text.lower())
+
+
+class FullTextIndex(object):
+    """
+    An inverted index of the words found in the text fields of stored objects,
+    persisted in the directory, `path`, of an AcidFS filesystem.
+
+    The index is stored in two sets of shards.  Document shards map the path
+    of each object to the counts of the terms found in each of its fields, so
+    that an object's terms can be found when it changes.  Term shards map
+    each term to the paths of the objects containing it, along with the
+    number of times it occurs.  Shards are chosen by a hash of the path or
+    term, so that updating an object only reads and writes the shards for its
+    path and the terms which have changed.
+
+    Shards start out named for the first two hexadecimal digits of the hash.
+    A shard which grows larger than `max_shard_size` bytes is split into a
+    directory of up to sixteen shards, named for the next digit of the hash,
+    so that shards stay small however large the index grows, and updating an
+    object only rewrites small files.
+
+    `decode` must return the decoded contents of a list of files and `dumps`
+    must serialize a shard.
+    """
+
+    max_shard_size = 64 * 1024
+
+    def __init__(self, fs, decode, dumps, path='/__fulltext__'):
+        self.fs = fs
+        self.decode = decode
+        self.dumps = dumps
+        self.path = path
+        self.shards = {}
+        self.dirty = set()
+        self.splits = {}
+
+    def update(self, path, texts, keep=()):
+        """
+        Indexes the object at `path`, given a dictionary mapping the names of
+        its text fields to their values.  Terms previously indexed for the
+        fields named in `keep` are kept as they are.
+        """
+        docs, = self._load([self._shard_file('docs', path)])
+        old = docs.get(path, {})
+        new = {}
+        for name, text in texts.items():
+            counts = {}
+            for term in terms(text):
+                counts[term] = counts.get(term, 0) + 1
+            if counts:
+                new[name] = counts
+        for name in keep:
+            if name in old:
+                new[name] = old[name]
+        if new != old:
+            self._set(path, old, new)
+
+    def remove(self, path):
+        """
+        Removes the object at `path` from the index.
+        """
+        docs, = self._load([self._shard_file('docs', path)])
+        old = docs.get(path)
+        if old is not None:
+            self._set(path, old, {})
+
+    def move(self, src, dst):
+        """
+        Moves the object at `src` to `dst` in the index.
+        """
+        src_docs, dst_docs = self._load(
+            [self._shard_file('docs', src), self._shard_file('docs', dst)])
+        fields = src_docs.get(src)
+        if fields is not None:
+            self._set(src, fields, {})
+            self._set(dst, dst_docs.get(dst, {}), fields)
+
+    def apply(self, op):
+        """
+        Updates the index for a removal or move done while saving.  Must be
+        called before the operation is carried out, since the objects in a
+        directory being removed or moved are found by listing it.
+        """
+        kind = op[0]
+        if kind == 'rm' and op[1].endswith('.yaml'):
+            self.remove(op[1][:-5])
+        elif kind == 'rmtree':
+            for path in self._walk(op[1]):
+                self.remove(path)
+        elif kind == 'mv':
+            src, dst = op[1], op[2]
+            if src.endswith('.yaml'):
+                self.move(src[:-5], dst[:-5])
+            else:
+                for path in self._walk(src):
+                    self.move(path, dst + path[len(src):])
+
+    def search(self, text, path='/'):
+        """
+        Returns the paths of the objects at or under `path` which contain all
+        of the terms in `text`, ordered by the total number of times the
+        terms occur, most first.
+        """
+        query = sorted(set(terms(text)))
+        if not query:
+            return []
+
+        shards = self._load([self._shard_file('terms', term)
+                             for term in query])
+        scores = None
+        for term, shard in zip(query, shards):
+            postings = shard.get(term, {})
+            if scores is None:
+                scores = dict(postings)
+            else:
+                scores = {doc: score + postings[doc]
+                          for doc, score in scores.items() if doc in postings}
+
+        prefix = path.rstrip('/') + '/'
+        return [doc for score, doc in sorted(
+            (-score, doc) for doc, score in scores.items()
+            if doc == path or doc.startswith(prefix))]
+
+    def flush(self):
+        """
+        Writes out the shards which have changed.
+        """
+        fs = self.fs
+        for fname in sorted(self.dirty):
+            shard = self.shards[fname]
+            if shard:
+                self._write(fname, shard)
+            elif fs.exists(fname):
+                fs.rm(fname)
+        self.dirty.clear()
+
+    def _write(self, fname, shard):
+        fs = self.fs
+        data = self.dumps(shard)
+        digits = ''.join(fname[len(self.path) + 1:].split('/')[1:])
+        if (len(data) > self.max_shard_size and len(shard) > 1 and
+                len(digits) < 40):
+            self._split(fname, shard, len(digits))
+            return
+
+        folder = fname.rsplit('/', 1)[0]
+        if not fs.exists(folder):
+            fs.mkdirs(folder)
+        with fs.open(fname, 'wb') as stream:
+            stream.write(data)
+
+    def _split(self, fname, shard, depth):
+        """
+        Replaces the shard, `fname`, with a directory of shards chosen by the
+        next digit of the hash of each key.
+        """
+        fs = self.fs
+        children = {}
+        for key, value in shard.items():
+            digit = _hash(key)[depth]
+            children.setdefault(fname + '/' + digit, {})[key] = value
+        if fs.exists(fname):
+            fs.rm(fname)
+        fs.mkdirs(fname)
+        self.splits[fname] = True
+        del self.shards[fname]
+        for child, child_shard in sorted(children.items()):
+            self.shards[child] = child_shard
+            self._write(child, child_shard)
+
+    def _set(self, path, old, new):
+        old_counts = _total(old)
+        new_counts = _total(new)
+        changed = sorted(term for term in set(old_counts) | set(new_counts)
+                         if old_counts.get(term) != new_counts.get(term))
+        fnames = [self._shard_file('terms', term) for term in changed]
+        for term, fname, shard in zip(changed, fnames, self._load(fnames)):
+            postings = shard.setdefault(term, {})
+            count = new_counts.get(term)
+            if count:
+                postings[path] = count
+            else:
+                postings.pop(path, None)
+                if not postings:
+                    del shard[term]
+            self.dirty.add(fname)
+
+        fname = self._shard_file('docs', path)
+        docs = self.shards[fname]
+        if new:
+            docs[path] = new
+        else:
+            docs.pop(path, None)
+        self.dirty.add(fname)
+
+    def _shard_file(self, kind, key):
+        digest = _hash(key)
+        fname = '{0}/{1}/{2}'.format(self.path, kind, digest[:2])
+        depth = 2
+        while self._is_split(fname):
+            fname += '/' + digest[depth]
+            depth += 1
+        return fname
+
+    def _is_split(self, fname):
+        split = self.splits.get(fname)
+        if split is None:
+            split = self.splits[fname] = self.fs.isdir(fname)
+        return split
+
+    def _load(self, fnames):
+        shards = self.shards
+        missing = sorted(set(fname for fname in fnames
+                             if fname not in shards))
+        found = [fname for fname in missing if self.fs.exists(fname)]
+        if found:
+            for fname, shard in zip(found, self.decode(found)):
+                shards[fname] = shard
+        for fname in missing:
+            shards.setdefault(fname, {})
+        return [shards[fname] for fname in fnames]
+
+    def _walk(self, path):
+        """
+        Returns the paths of the objects stored at or under `path`.
+        """
+        fs = self.fs
+        paths = []
+        if fs.isdir(path):
+            for fname in fs.listdir(path):
+                fpath = '{0}/{1}'.format(path, fname)
+                if fname == '__index__.yaml':
+                    paths.append(path)
+                elif fname.endswith('.yaml'):
+                    paths.append(fpath[:-5])
+                elif fs.isdir(fpath):
+                    paths.extend(self._walk(fpath))
+        return paths
+
+
+def _hash(key):
+    return hashlib.sha1(key.encode('utf-8')).hexdigest()
+
+
+def _total(fields):
+    counts = {}
+    for field_counts in fields.values():
+        for term, count in field_counts.items():
+            counts[term] = counts.get(term, 0) + count
+    return counts
@@ -0,0 +1,135 @@
+"""
+Rewrites every object in a store in a particular format, or rebuilds its full
+text index.
+
+Can be run from the command line as::
+
+    python -m dumpling.migrate [--import MODULE ...] REPOSITORY FORMAT
+    python -m dumpling.migrate [--import MODULE ...] --reindex REPOSITORY
+
+Modules defining the models stored in the repository must be imported, using
+``--import``, so that their objects can be loaded.
+"""
+import argparse
+import importlib
+import transaction
+
+from acidfs import AcidFS
+
+from . import (
+    _BigFolderContents,
+    _folder_contents,
+    _folder_indexes,
+    _folder_order,
+    _index_text,
+    _sort_key,
+    set_dirty,
+    Store,
+)
+from .fulltext import FullTextIndex
+
+
+def migrate(store, format):
+    """
+    Marks every object in `store` to be rewritten in `format`, either
+    ``'yaml'`` or ``'json'``, when the current transaction is committed.
+    Returns the number of objects marked.  Models which set their own format
+    with ``__dumpling_format__`` continue to use their own format.
+    """
+    if format not in ('yaml', 'json'):
+        raise ValueError(u"Unknown format: {0}".format(format))
+    store.format = format
+    return _migrate(store.root())
+
+
+def _migrate(obj):
+    for field in obj.__dumpling_lazy__:
+        getattr(obj, field.__name__)  # Loads the field so it is rewritten
+    for field in obj.__dumpling_logs__:
+        getattr(obj, field.__name__).compact()
+    set_dirty(obj)
+    count = 1
+
+    if obj.__dumpling_folder__:
+        sort_key = _sort_key(obj)
+        if sort_key:
+            _folder_order(obj, sort_key).dirty = True
+        indexes = _folder_indexes(obj)
+        if indexes is not None:
+            indexes.dirty = True
+        for child in obj.values(prefetch=True):
+            count += _migrate(child)
+        contents = _folder_contents(obj)
+        if isinstance(contents, _BigFolderContents):
+            contents.tree.rewrite()
+
+    return count
+
+
+def reindex(store):
+    """
+    Rebuilds the full text index of `store` from every object stored in it,
+    enabling full text indexing for the store if it was not already enabled.
+    Use this to index a store whose objects were saved before full text
+    indexing was enabled.  The index is written when the current transaction
+    is committed.  Returns the number of objects indexed.
+    """
+    store.fulltext = True
+    session = store.session
+    fs = store.fs
+    index = FullTextIndex(fs, session.decode, store.backend_for(None).dumps)
+    if fs.exists(index.path):
+        fs.rmtree(index.path)
+    count = _reindex(index, store.root())
+    index.flush()
+    return count
+
+
+def _reindex(index, obj):
+    for field in obj.__dumpling_lazy__:
+        getattr(obj, field.__name__)  # Loads the field so it is indexed
+    _index_text(index, obj)
+    count = 1
+
+    if obj.__dumpling_folder__:
+        for child in obj.values(prefetch=True):
+            count += _reindex(index, child)
+
+    return count
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Rewrite every object in a dumpling store in a format.")
+    parser.add_argument('repository', help="Path to the Git repository.")
+    parser.add_argument('format', nargs='?', choices=('yaml', 'json'))
+    parser.add_argument(
+        '--reindex', action='store_true',
+        help="Rebuild the full text index instead.")
+    parser.add_argument(
+        '--import', dest='modules', action='append', default=[],
+        metavar='MODULE', help="Module defining models used in the store.")
+    args = parser.parse_args(argv)
+    if args.reindex == bool(args.format):
+        parser.error("Give either a format or --reindex.")
+
+    for module in args.modules:
+        importlib.import_module(module)
+
+    store = Store(AcidFS(args.repository))
+    tx = transaction.get()
+    if args.reindex:
+        count = reindex(store)
+        tx.note(u"Rebuild full text index")
+        tx.commit()
+        print("Indexed {0} objects.".format(count))
+        return
+
+    count = migrate(store, args.format)
+    tx.note(u"Migrate to {0} format".format(args.format))
+    tx.commit()
+    print("Rewrote {0} objects.".format(count))
+
+
+if __name__ == '__main__':  # pragma no cover
+    main()
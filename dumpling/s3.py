@@ -0,0 +1,498 @@
+"""
+A blob store which keeps blobs in an S3 compatible object store.
+"""
+import datetime
+import errno
+import hashlib
+import hmac
+import io
+import os
+import re
+import tempfile
+import threading
+
+from .blob import BlobStore, _BUFSIZE, _hash_file, _read, _stored
+
+try:
+    import http.client as httplib
+except ImportError:  # pragma no cover
+    import httplib
+
+try:
+    import queue
+except ImportError:  # pragma no cover
+    import Queue as queue
+
+try:
+    from urllib.parse import quote, urlsplit
+except ImportError:  # pragma no cover
+    from urllib import quote
+    from urlparse import urlsplit
+
+_EMPTY_SHA256 = hashlib.sha256(b'').hexdigest()
+
+
+class S3Error(Exception):
+    """
+    An error response from the object store.
+    """
+
+    def __init__(self, status, body):
+        super(S3Error, self).__init__(u"{0}: {1}".format(
+            status, body.decode('utf-8', 'replace')))
+        self.status = status
+        self.body = body
+
+
+class S3BlobStore(BlobStore):
+    """
+    Stores blobs as objects in a bucket of an S3 compatible object store,
+    under `prefix` followed by their digests.
+
+    `endpoint` is the URL of the object store, for example,
+    ``'https://s3.amazonaws.com'`` or ``'http://localhost:9000'``.  Requests
+    are made using path style addressing and are signed with AWS signature
+    version 4, using `access_key`, `secret_key` and `region`.
+
+    Up to `pool_size` idle connections are kept open for reuse.  Data
+    written to a blob is spooled to a temporary file, in order to compute its
+    digest, and is then uploaded.  Blobs larger than `part_size` are uploaded
+    as multipart uploads, with up to `workers` parts transferred in parallel.
+
+    Blobs are named by digests computed with the hash named by `algorithm`,
+    as for `FileSystemBlobStore`, so both stores name the same content alike.
+    """
+    # Smallest part allowed by S3, except for the last part of an upload
+    min_part_size = 5 * 1024 * 1024
+
+    class BlobOutputStream(object):
+        def __init__(self, blob, blobstore):
+            self.blob = blob
+            self.blobstore = blobstore
+            self.hasher = hashlib.new(blobstore.algorithm)
+            self.size = 0
+            self.f = tempfile.TemporaryFile(prefix='.blob-')
+
+        def __enter__(self):
+            return self
+
+        def __exit__(self, exc_type, exc_value, exc_trace):
+            self.close()
+
+        def write(self, block):
+            self.hasher.update(block)
+            self.size += len(block)
+            self.f.write(block)
+
+        def close(self):
+            self.f.flush()
+            digest = self.hasher.hexdigest()
+            try:
+                self.blobstore._upload(digest, self.f.fileno(), self.size,
+                                       self.blob.content_type)
+            finally:
+                self.f.close()
+                self.f = None
+            _stored(self.blob, digest, None, self.size)
+
+        def __del__(self):
+            if self.f:
+                self.close()
+
+    def __init__(self, endpoint, bucket, access_key, secret_key,
+                 region='us-east-1', prefix='', pool_size=8,
+                 part_size=8 * 1024 * 1024, workers=4, timeout=60,
+                 algorithm='sha1'):
+        url = urlsplit(endpoint)
+        self.secure = url.scheme == 'https'
+        self.host = url.netloc
+        self.bucket = bucket
+        self.access_key = access_key
+        self.secret_key = secret_key
+        self.region = region
+        self.prefix = prefix
+        self.pool = _ConnectionPool(self.secure, self.host, pool_size, timeout)
+        self.part_size = max(part_size, self.min_part_size)
+        self.workers = workers
+        try:
+            hashlib.new(algorithm)
+        except ValueError:
+            raise ValueError(u"Unsupported hash: {0}".format(algorithm))
+        self.algorithm = algorithm
+        self._executor = None
+        self._lock = threading.Lock()
+
+    def new(self, blob):
+        return self.BlobOutputStream(blob, self)
+
+    def stream(self, digest, buffering=-1, compression=None):
+        if compression:
+            raise ValueError(
+                u"Unsupported compression: {0}".format(compression))
+        stream = _S3ReadStream(self, self._key(digest))
+        stream._request()  # Fails now if the blob doesn't exist
+        if buffering == 0:
+            return stream
+        return io.BufferedReader(
+            stream, buffering if buffering > 0 else _BUFSIZE)
+
+    def sizeof(self, digest, compression=None):
+        size = self._head(self._key(digest))
+        if size is None:
+            raise OSError(errno.ENOENT, 'No such blob', digest)
+        return size
+
+    def read_range(self, digest, offset, length, compression=None):
+        if not length:
+            return b''
+        status, headers, body = self.request(
+            'GET', self._key(digest),
+            headers={'range': 'bytes={0}-{1}'.format(
+                offset, offset + length - 1)})
+        if status == 416:
+            return b''  # Range starts after the end
+        elif status == 200:
+            # Server ignored the range and sent the whole object
+            return body[offset:offset + length]
+        return body
+
+    def import_file(self, blob, path, move=False, link=False):
+        """
+        Uploads the file at `path` as the contents of `blob`, without first
+        copying it to a temporary file.
+        """
+        digest, size = _hash_file(path, self.algorithm)
+        with open(path, 'rb') as f:
+            self._upload(digest, f.fileno(), size, blob.content_type)
+        _stored(blob, digest, None, size)
+        if move:
+            os.remove(path)
+
+    def request(self, method, key, query=None, headers=None, body=b'',
+                expect=(200, 204, 206, 416)):
+        """
+        Makes a signed request for the object, `key`, and returns the
+        response's status, headers and body.
+        """
+        conn, response = self._send(method, key, query, headers, body)
+        try:
+            data = response.read()
+        except Exception:
+            conn.close()
+            raise
+        self.pool.put(conn)
+        if response.status not in expect:
+            raise S3Error(response.status, data)
+        return response.status, response, data
+
+    def _send(self, method, key, query=None, headers=None, body=b''):
+        """
+        Sends a signed request, returning the connection and the response,
+        which has not been read.  A connection from the pool may have been
+        closed by the server while it was idle, in which case the request is
+        retried with a new connection.
+        """
+        path = '/{0}/{1}'.format(quote(self.bucket), quote(key))
+        query = query or {}
+        headers = dict(headers or {})
+        headers['host'] = self.host
+        _sign(method, path, query, headers,
+              _EMPTY_SHA256 if not body else 'UNSIGNED-PAYLOAD',
+              self.access_key, self.secret_key, self.region)
+        if query:
+            path += '?' + _canonical_query(query)
+
+        while True:
+            conn, reused = self.pool.get()
+            try:
+                conn.request(method, path, body, headers)
+                return conn, conn.getresponse()
+            except (httplib.HTTPException, IOError, OSError):
+                conn.close()
+                if not reused:
+                    raise
+
+    def _head(self, key):
+        status, response, body = self.request(
+            'HEAD', key, expect=(200, 404))
+        if status == 404:
+            return None
+        return int(response.getheader('content-length'))
+
+    def _key(self, digest):
+        return self.prefix + digest
+
+    def _upload(self, digest, fd, size, content_type=None):
+        """
+        Uploads `size` bytes read from the file, `fd`, as the blob with
+        `digest`, unless it is already stored.
+        """
+        key = self._key(digest)
+        if self._head(key) is not None:
+            return
+
+        headers = {}
+        if content_type:
+            headers['content-type'] = content_type
+        if size <= self.part_size:
+            headers['content-length'] = str(size)
+            self.request('PUT', key, body=_pread(fd, size, 0),
+                         headers=headers)
+            return
+
+        status, response, body = self.request(
+            'POST', key, query={'uploads': ''}, headers=headers)
+        upload_id = _xml_value(body, 'UploadId')
+        query = {'uploadId': upload_id}
+        try:
+            def upload_part(number):
+                offset = (number - 1) * self.part_size
+                data = _pread(fd, min(self.part_size, size - offset), offset)
+                part_query = dict(query, partNumber=str(number))
+                status, response, body = self.request(
+                    'PUT', key, query=part_query, body=data,
+                    headers={'content-length': str(len(data))})
+                return response.getheader('etag')
+
+            count = (size + self.part_size - 1) // self.part_size
+            etags = list(self._get_executor().map(
+                upload_part, range(1, count + 1)))
+            parts = u''.join(
+                u'<Part><PartNumber>{0}</PartNumber><ETag>{1}</ETag></Part>'
+                .format(number, etag)
+                for number, etag in enumerate(etags, 1))
+            xml = u'<CompleteMultipartUpload>{0}</CompleteMultipartUpload>'
+            status, response, body = self.request(
+                'POST', key, query=query,
+                body=xml.format(parts).encode('utf-8'))
+            if b'<Error>' in body:
+                # Errors completing an upload may be sent with a 200 status
+                raise S3Error(status, body)
+        except Exception:
+            self.request('DELETE', key, query=query, expect=(200, 204, 404))
+            raise
+
+    def _get_executor(self):
+        with self._lock:
+            executor = self._executor
+            if executor is None:
+                from concurrent.futures import ThreadPoolExecutor
+                self._executor = executor = ThreadPoolExecutor(self.workers)
+            return executor
+
+
+class _S3ReadStream(io.RawIOBase):
+    """
+    A seekable stream for reading an object.  Data is read with a single
+    request, from the current position to the end of the object, which is
+    only made again if the stream is moved with `seek`.
+    """
+    _size = None
+
+    def __init__(self, blobstore, key):
+        self.blobstore = blobstore
+        self.key = key
+        self.pos = 0
+        self.conn = self.response = None
+
+    @property
+    def size(self):
+        if self._size is None:
+            size = self.blobstore._head(self.key)
+            if size is None:
+                raise IOError(errno.ENOENT, 'No such blob', self.key)
+            self._size = size
+        return self._size
+
+    def _request(self):
+        """
+        Requests the object's data from the current position to the end.
+        """
+        blobstore = self.blobstore
+        conn, response = blobstore._send(
+            'GET', self.key, headers={'range': 'bytes={0}-'.format(self.pos)})
+        status = response.status
+        if status in (200, 206):
+            self.conn, self.response = conn, response
+            self._size = _total_size(response)
+            if status == 200 and self.pos:
+                # Server ignored the range and sent the whole object
+                skip = self.pos
+                while skip:
+                    data = response.read(min(skip, _BUFSIZE))
+                    if not data:
+                        break
+                    skip -= len(data)
+            return
+
+        body = response.read()
+        blobstore.pool.put(conn)
+        if status == 404:
+            raise IOError(errno.ENOENT, 'No such blob', self.key)
+        elif status == 416:
+            # Position is at or past the end
+            self._size = _total_size(response, self.pos)
+        else:
+            raise S3Error(status, body)
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self.pos
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self.pos
+        elif whence == io.SEEK_END:
+            offset += self.size
+        if offset != self.pos:
+            self._release()
+            self.pos = offset
+        return self.pos
+
+    def readinto(self, b):
+        if self._size is not None and self.pos >= self._size:
+            return 0
+        if self.response is None:
+            self._request()
+            if self.response is None:
+                return 0
+        n = self.response.readinto(b)
+        self.pos += n
+        if not n or self.pos >= self._size:
+            self._release()
+        return n
+
+    def close(self):
+        self._release()
+        super(_S3ReadStream, self).close()
+
+    def _release(self):
+        response = self.response
+        if response is not None:
+            self.response = None
+            if response.isclosed():
+                self.blobstore.pool.put(self.conn)
+            else:
+                # Can't be reused without reading the rest of the response
+                self.conn.close()
+            self.conn = None
+
+
+class _ConnectionPool(object):
+    """
+    Keeps up to `size` idle HTTP connections to a host for reuse.
+    """
+
+    def __init__(self, secure, host, size, timeout):
+        self.factory = (httplib.HTTPSConnection if secure
+                        else httplib.HTTPConnection)
+        self.host = host
+        self.timeout = timeout
+        self.idle = queue.LifoQueue(size)
+
+    def get(self):
+        """
+        Returns a connection and whether it has been used before.
+        """
+        try:
+            return self.idle.get_nowait(), True
+        except queue.Empty:
+            return self.factory(self.host, timeout=self.timeout), False
+
+    def put(self, conn):
+        try:
+            self.idle.put_nowait(conn)
+        except queue.Full:
+            conn.close()
+
+
+def _total_size(response, default=None):
+    """
+    Returns the size of an object from the headers of a response to a request
+    for a range of it.
+    """
+    content_range = response.getheader('content-range')
+    if content_range and '/' in content_range:
+        total = content_range.rsplit('/', 1)[1]
+        if total != '*':
+            return int(total)
+    if response.status == 200:
+        return int(response.getheader('content-length'))
+    return default
+
+
+def _pread(fd, length, offset):
+    if hasattr(os, 'pread'):
+        chunks = []
+        while length:
+            data = os.pread(fd, length, offset)
+            if not data:
+                break
+            chunks.append(data)
+            length -= len(data)
+            offset += len(data)
+        return b''.join(chunks)
+    with os.fdopen(os.dup(fd), 'rb') as f:  # pragma no cover
+        f.seek(offset)
+        return _read(f, length)
+
+
+def _xml_value(body, tag):
+    match = re.search(
+        r'<{0}>([^<]*)</{0}>'.format(tag).encode('ascii'), body)
+    if match is None:
+        raise S3Error(200, body)
+    return match.group(1).decode('utf-8')
+
+
+def _canonical_query(query):
+    return '&'.join(
+        '{0}={1}'.format(quote(key, safe='-_.~'), quote(value, safe='-_.~'))
+        for key, value in sorted(query.items()))
+
+
+def _sign(method, path, query, headers, payload_hash, access_key,
+          secret_key, region, now=None):
+    """
+    Adds the headers for an AWS signature version 4 to `headers`.
+    """
+    if now is None:
+        now = datetime.datetime.utcnow()
+    timestamp = now.strftime('%Y%m%dT%H%M%SZ')
+    date = timestamp[:8]
+    headers['x-amz-date'] = timestamp
+    headers['x-amz-content-sha256'] = payload_hash
+
+    names = sorted(name.lower() for name in headers)
+    values = {name.lower(): str(value).strip()
+              for name, value in headers.items()}
+    signed_headers = ';'.join(names)
+    canonical_request = '\n'.join([
+        method,
+        path,
+        _canonical_query(query),
+        ''.join('{0}:{1}\n'.format(name, values[name]) for name in names),
+        signed_headers,
+        payload_hash,
+    ])
+    scope = '{0}/{1}/s3/aws4_request'.format(date, region)
+    string_to_sign = '\n'.join([
+        'AWS4-HMAC-SHA256',
+        timestamp,
+        scope,
+        hashlib.sha256(canonical_request.encode('utf-8')).hexdigest(),
+    ])
+
+    key = ('AWS4' + secret_key).encode('utf-8')
+    for part in (date, region, 's3', 'aws4_request'):
+        key = hmac.new(key, part.encode('utf-8'), hashlib.sha256).digest()
+    signature = hmac.new(key, string_to_sign.encode('utf-8'),
+                         hashlib.sha256).hexdigest()
+    headers['authorization'] = (
+        'AWS4-HMAC-SHA256 Credential={0}/{1}, SignedHeaders={2}, '
+        'Signature={3}'.format(access_key, scope, signed_headers, signature))
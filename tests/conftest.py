@@ -0,0 +1,6 @@
+import sys
+
+collect_ignore = []
+if sys.version_info < (3, 7):
+    # Uses syntax and asyncio functions which aren't available
+    collect_ignore.append('test_aio.py')
@@ -0,0 +1,52 @@
+# Tests of asynchronous blob I/O, which need Python 3.7 or later, so are kept
+# apart from the other tests.  See conftest.py.
+import asyncio
+import os
+import transaction
+
+import test_functional
+
+from dumpling.blob import Blob
+
+factory = test_functional.factory
+tmp = test_functional.tmp
+
+
+def test_blob_async(factory, tmp):
+    store = factory(blobstore=os.path.join(tmp, 'blobs'))
+    data = bytes(bytearray(range(256))) * 4
+    root = store.root()
+    root['a'] = a = Blob()
+    root['b'] = b = Blob()
+
+    async def chunks():
+        for i in range(0, len(data), 300):
+            yield data[i:i + 300]
+
+    async def main():
+        reader = asyncio.StreamReader()
+        reader.feed_data(data)
+        reader.feed_eof()
+        await a.awrite_from(reader, size=100)
+        await b.awrite_from(chunks())
+        return [chunk async for chunk in a.aiter_chunks(400)]
+
+    assert asyncio.run(main()) == [data[:400], data[400:800], data[800:]]
+    assert a._location == b._location
+    with b.open() as f:
+        assert f.read() == data
+    transaction.commit()
+
+    blob = store.root()['a']
+
+    async def read(blob):
+        chunks = []
+        async for chunk in blob.aiter_chunks(100, 250, 420):
+            chunks.append(chunk)
+        stream = blob.aiter_chunks(100)
+        async for chunk in stream:
+            break
+        await stream.aclose()  # Without reading the rest
+        return chunks
+
+    assert asyncio.run(read(blob)) == [data[250:350], data[350:420]]
@@ -0,0 +1,68 @@
+from dumpling.cache import ObjectCache
+
+
+def test_get_miss():
+    cache = ObjectCache()
+    assert cache.get('abc', '/foo') is None
+    assert cache.misses == 1
+
+
+def test_set_get():
+    cache = ObjectCache()
+    obj = object()
+    cache.set('abc', '/foo', obj, 10)
+    assert cache.get('abc', '/foo') is obj
+    assert cache.hits == 1
+    assert cache.nbytes == 10
+
+
+def test_get_stale():
+    cache = ObjectCache()
+    cache.set('abc', '/foo', object(), 10)
+    assert cache.get('def', '/foo') is None
+    assert len(cache) == 0
+    assert cache.nbytes == 0
+
+
+def test_replace():
+    cache = ObjectCache()
+    cache.set('abc', '/foo', object(), 10)
+    obj = object()
+    cache.set('def', '/foo', obj, 5)
+    assert cache.get('def', '/foo') is obj
+    assert len(cache) == 1
+    assert cache.nbytes == 5
+
+
+def test_evict_by_count():
+    cache = ObjectCache(max_objects=2)
+    cache.set('a', '/a', 'a', 1)
+    cache.set('b', '/b', 'b', 1)
+    cache.get('a', '/a')
+    cache.set('c', '/c', 'c', 1)
+    assert cache.get('a', '/a') == 'a'
+    assert cache.get('b', '/b') is None
+    assert cache.get('c', '/c') == 'c'
+
+
+def test_evict_by_size():
+    cache = ObjectCache(max_bytes=10)
+    cache.set('a', '/a', 'a', 6)
+    cache.set('b', '/b', 'b', 6)
+    assert cache.get('a', '/a') is None
+    assert cache.get('b', '/b') == 'b'
+    assert cache.nbytes == 6
+
+
+def test_too_big():
+    cache = ObjectCache(max_bytes=10)
+    cache.set('a', '/a', 'a', 11)
+    assert len(cache) == 0
+
+
+def test_clear():
+    cache = ObjectCache()
+    cache.set('a', '/a', 'a', 6)
+    cache.clear()
+    assert len(cache) == 0
+    assert cache.nbytes == 0
@@ -0,0 +1,102 @@
+import json
+import pytest
+import shutil
+import tempfile
+import transaction
+
+from acidfs import AcidFS
+from dumpling.fulltext import FullTextIndex, terms
+
+
+@pytest.fixture
+def fs(request):
+    tmp = tempfile.mkdtemp()
+
+    def cleanup():
+        transaction.abort()
+        shutil.rmtree(tmp)
+
+    request.addfinalizer(cleanup)
+    return AcidFS(tmp)
+
+
+def mkindex(fs):
+    def decode(fnames):
+        return [json.loads(fs.open(fname, 'rb').read().decode('utf-8'))
+                for fname in fnames]
+
+    def dumps(shard):
+        return json.dumps(shard).encode('utf-8')
+
+    return FullTextIndex(fs, decode, dumps)
+
+
+def test_terms():
+    assert terms(u'Hello, World!  Hello again.') == [
+        u'hello', u'world', u'hello', u'again']
+
+
+def test_update_search(fs):
+    index = mkindex(fs)
+    index.update('/a', {'title': u'red fish', 'body': u'blue fish'})
+    index.update('/b', {'title': u'red'})
+    index.flush()
+
+    index = mkindex(fs)
+    assert index.search(u'fish') == ['/a']
+    assert index.search(u'red') == ['/a', '/b']
+    assert index.search(u'red fish') == ['/a']
+    assert index.search(u'red', '/b') == ['/b']
+
+    index.update('/a', {'title': u'green'}, keep=['body'])
+    index.flush()
+    index = mkindex(fs)
+    assert index.search(u'red') == ['/b']
+    assert index.search(u'blue') == ['/a']
+
+
+def test_remove_move(fs):
+    index = mkindex(fs)
+    index.update('/a', {'title': u'red'})
+    index.update('/b', {'title': u'red'})
+    index.remove('/a')
+    index.move('/b', '/c')
+    index.remove('/nothing')
+    index.flush()
+
+    index = mkindex(fs)
+    assert index.search(u'red') == ['/c']
+    index.remove('/c')
+    index.flush()
+    assert not fs.exists(index._shard_file('docs', '/c'))
+
+
+def test_split_shards(fs):
+    index = mkindex(fs)
+    index.max_shard_size = 128
+    for i in range(1000):
+        index.update('/doc{0}'.format(i),
+                     {'title': u'common word{0}'.format(i)})
+    index.flush()
+
+    index = mkindex(fs)
+    index.max_shard_size = 128
+    fname = index._shard_file('terms', u'word7')
+    assert fname.count('/') > 3
+    assert len(fs.open(fname, 'rb').read()) <= 128
+    assert index.search(u'word7') == ['/doc7']
+    assert len(index.search(u'common')) == 1000
+
+    # Updating a document only touches the shards for its terms
+    index.update('/doc7', {'title': u'common other'})
+    assert len(index.dirty) == 3
+    index.flush()
+    index = mkindex(fs)
+    assert index.search(u'word7') == []
+    assert index.search(u'other') == ['/doc7']
+
+    # A shard holding a single large entry isn't split
+    index.update('/big', {'title': u' '.join([u'common'] * 1000)})
+    index.flush()
+    index = mkindex(fs)
+    assert index.search(u'common')[0] == '/big'
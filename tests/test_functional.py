@@ -1,21 +1,31 @@
+import datetime
+import errno
+import hashlib
+import io
 import os
 import pytest
 import shutil
+import socket
 import subprocess
 import tempfile
 import transaction
+import yaml
 
 from acidfs import AcidFS
 from dumpling import (
+    bigfolder,
     Field,
     folder,
     Folder,
     get_child,
     model,
+    set_folder_dirty,
     Store,
     string_type,
 )
-from dumpling.blob import Blob, ConfigurationError
+from dumpling.blob import Blob, ConfigurationError, FileSystemBlobStore
+from dumpling.cache import ObjectCache
+from dumpling.migrate import migrate, reindex
 
 
 @pytest.fixture
@@ -67,6 +77,206 @@ def test_add_root(factory):
     assert isinstance(store.root().title, string_type)
 
 
+def test_yaml_backend_python(factory):
+    store = factory(yaml_backend='python')
+    assert store.yaml.name == 'python'
+    root = store.root()
+    root[u'widget'] = Widget(u'Hi Dee Ho!')
+    transaction.commit()
+
+    assert store.root()[u'widget'].name == u'Hi Dee Ho!'
+
+
+@pytest.mark.skipif(not yaml.__with_libyaml__, reason='libyaml not available')
+def test_yaml_backend_libyaml(factory):
+    store = factory(yaml_backend='libyaml')
+    assert store.yaml.name == 'libyaml'
+    root = store.root()
+    root[u'widget'] = Widget(u'Hi Dee Ho!')
+    transaction.commit()
+
+    assert store.root()[u'widget'].name == u'Hi Dee Ho!'
+
+
+def test_yaml_backend_unavailable(factory):
+    with pytest.raises(ValueError):
+        factory(yaml_backend='foo')
+
+
+@pytest.mark.parametrize('backend', ['python', 'libyaml'])
+def test_yaml_python_tags(factory, backend):
+    if backend == 'libyaml' and not yaml.__with_libyaml__:
+        pytest.skip('libyaml not available')
+    store = factory(yaml_backend=backend)
+    root = store.root()
+    root['widget'] = widget = Widget(u'Widget')
+    widget.maclets = {u'tuple': (1, (2, u'three')), u'complex': 1 - 2j,
+                      u'real': complex(3)}
+    transaction.commit()
+
+    widget = store.root()['widget']
+    assert widget.maclets == {u'tuple': (1, (2, u'three')),
+                              u'complex': 1 - 2j, u'real': complex(3)}
+    assert isinstance(widget.maclets[u'tuple'], tuple)
+    transaction.abort()
+
+    # As stored by earlier versions, using PyYAML's default dumper
+    with store.fs.open('/widget.yaml', 'w') as f:
+        f.write(u"{0}\n"
+                u"maclets: {{a: !!python/tuple [1, 2], b: !!python/long '3', "
+                u"c: !!python/unicode 'four', d: !!python/str 'five', "
+                u"e: !!python/complex '6.0+7.0j'}}\n"
+                u"name: Widget\n".format(Widget.__dumpling_tag__))
+    transaction.commit()
+    assert store.root()['widget'].maclets == {
+        u'a': (1, 2), u'b': 3, u'c': u'four', u'd': u'five', u'e': 6 + 7j}
+
+
+def test_json_format(factory):
+    store = factory(format='json')
+    root = store.root()
+    root[u'widget'] = widget = Widget(u'Hi Dee Ho!')
+    widget.sprocket = Sprocket(size=3)
+    widget.chiclets = [1, (2, 3), b'\x00']
+    widget.maclets = {u'!': {1, 2}, 3: datetime.date(2015, 1, 2),
+                      (4, 5): datetime.datetime(2015, 1, 2, 3, 4, 5)}
+    root[u'doc'] = doc = Document(u'Title')
+    doc.body = u'Lorem ipsum'
+    transaction.commit()
+
+    assert store.fs.open('/widget.yaml', 'rb').read().startswith(
+        b'#dumpling:json\n')
+    assert store.fs.open('/doc/body.yaml', 'rb').read().startswith(
+        b'#dumpling:json\n')
+
+    store = factory(cache=ObjectCache())
+    widget = store.root()[u'widget']
+    assert widget.name == u'Hi Dee Ho!'
+    assert widget.sprocket.size == 3
+    assert widget.sprocket.spin == 2
+    assert widget.chiclets == [1, [2, 3], b'\x00']
+    assert widget.maclets == {
+        u'!': {1, 2}, 3: datetime.date(2015, 1, 2),
+        (4, 5): datetime.datetime(2015, 1, 2, 3, 4, 5)}
+    assert store.root()[u'doc'].body == u'Lorem ipsum'
+
+
+def test_json_format_per_model(factory):
+    store = factory()
+    root = store.root()
+    root[u'widget'] = Widget(u'Hi Dee Ho!')
+    root[u'gadget'] = Gadget(u'Go go')
+    transaction.commit()
+
+    assert not store.fs.open('/widget.yaml', 'rb').read().startswith(
+        b'#dumpling:json\n')
+    assert store.fs.open('/gadget.yaml', 'rb').read().startswith(
+        b'#dumpling:json\n')
+    assert store.root()[u'gadget'].name == u'Go go'
+
+
+def test_unknown_format(factory):
+    with pytest.raises(ValueError):
+        factory(format='foo')
+
+
+def test_migrate(factory):
+    store = factory()
+    store.set_root(SortedSite())
+    root = store.root()
+    root[u'1'] = site = Site()
+    site[u'widget'] = Widget(u'Hi Dee Ho!')
+    root[u'2'] = doc = Document(u'Title')
+    doc.body = u'Lorem ipsum'
+    transaction.commit()
+
+    store = factory(cache=ObjectCache())
+    assert migrate(store, 'json') == 4
+    transaction.commit()
+
+    for path in ('/__index__.yaml', '/__order__', '/1/__index__.yaml',
+                 '/1/widget.yaml', '/2.yaml', '/2/body.yaml'):
+        assert store.fs.open(path, 'rb').read().startswith(
+            b'#dumpling:json\n')
+
+    store = factory(cache=ObjectCache())
+    root = store.root()
+    assert list(root.keys()) == [u'1', u'2']
+    assert root[u'1'][u'widget'].name == u'Hi Dee Ho!'
+    assert root[u'2'].body == u'Lorem ipsum'
+
+    with pytest.raises(ValueError):
+        migrate(store, 'foo')
+
+
+def test_object_cache(factory):
+    cache = ObjectCache()
+    store = factory(cache=cache)
+    root = store.root()
+    root[u'widget'] = Widget(u'Hi Dee Ho!')
+    transaction.commit()
+
+    # root, listing of root, widget
+    widget = store.root()[u'widget']
+    assert cache.misses == 3
+    widget.name = u'Fred'
+    widget.chiclets.append(1)
+    transaction.abort()
+
+    widget = store.root()[u'widget']
+    assert cache.hits == 3
+    assert widget.name == u'Hi Dee Ho!'
+    assert widget.chiclets == []
+    widget.name = u'Fred'
+    transaction.commit()
+
+    # Root is unchanged, listing of root and widget have changed
+    assert store.root()[u'widget'].name == u'Fred'
+    assert cache.hits == 4
+    assert cache.misses == 5
+
+
+def test_object_cache_disabled(factory):
+    store = factory(cache=False)
+    root = store.root()
+    root[u'widget'] = Widget(u'Hi Dee Ho!')
+    transaction.commit()
+
+    assert store.root()[u'widget'].name == u'Hi Dee Ho!'
+
+
+def test_folder_listing(factory):
+    store = factory()
+    root = store.root()
+    root[u'folder'] = folder = Folder()
+    folder[u'foo'] = Widget(u'foo')
+    folder[u'bar'] = Site()
+    folder[u'bar'][u'baz'] = Sprocket()
+    transaction.commit()
+
+    # Not folders, should be ignored
+    store.fs.mkdir('/folder/notafolder')
+    with store.fs.open('/folder/notafolder/foo.yaml', 'w') as f:
+        f.write(u'{}')
+    with store.fs.open('/folder/README', 'w') as f:
+        f.write(u'Hello')
+    transaction.commit()
+
+    folder = store.root()[u'folder']
+    assert sorted(folder.keys()) == [u'bar', u'foo']
+    assert folder[u'foo'].name == u'foo'
+    assert list(folder[u'bar'].keys()) == [u'baz']
+    transaction.abort()
+
+    folder = store.root()[u'folder']
+    assert sorted(folder.keys()) == [u'bar', u'foo']
+    folder[u'bar'][u'qux'] = Sprocket()
+    assert sorted(folder[u'bar'].keys()) == [u'baz', u'qux']
+    transaction.commit()
+
+    assert sorted(store.root()[u'folder'][u'bar'].keys()) == [u'baz', u'qux']
+
+
 def test_abort(factory):
     store = factory(factory=Site)
     site = Site(u'Mu Shu Pork')
@@ -143,131 +353,1325 @@ def test_nested_structures(factory):
     assert sprocket.spin == 3
 
 
-def test_persistent_list(factory):
+def test_persistent_list(factory):
+    store = factory()
+    root = store.root()
+    root[u'widget'] = widget = Widget(u'Hi Dee Ho!')
+    widget.chiclets[:] = range(10)
+    transaction.commit()
+
+    widget = store.root()[u'widget']
+    assert widget.chiclets == list(range(10))
+    widget.chiclets[5] = 42
+    transaction.commit()
+
+    widget = store.root()[u'widget']
+    assert widget.chiclets[5] == 42
+
+
+def test_list_of_persistent(factory):
+    store = factory()
+    root = store.root()
+    root[u'widget'] = widget = Widget(u'Hi Dee Ho!')
+    widget.chiclets = [Sprocket(), Sprocket(), Sprocket()]
+    transaction.commit()
+
+    widget = store.root()[u'widget']
+    widget.chiclets[1].spin = 42
+    transaction.commit()
+
+    widget = store.root()[u'widget']
+    assert widget.chiclets[1].spin == 42
+
+
+def test_persistent_dict(factory):
+    store = factory()
+    root = store.root()
+    root[u'widget'] = widget = Widget(u'Hi Dee Ho!')
+    widget.maclets.update(((u'a', 1), (u'b', 2), (u'c', 3)))
+    transaction.commit()
+
+    widget = store.root()[u'widget']
+    assert widget.maclets[u'b'] == 2
+    widget.maclets[u'b'] = 42
+    transaction.commit()
+
+    widget = store.root()[u'widget']
+    assert widget.maclets[u'b'] == 42
+
+
+def test_dict_of_persistent(factory):
+    store = factory()
+    root = store.root()
+    root[u'widget'] = widget = Widget(u'Hi Dee Ho!')
+    widget.maclets = {u'a': Sprocket()}
+    transaction.commit()
+
+    widget = store.root()[u'widget']
+    widget.maclets[u'a'].size = 10
+    transaction.commit()
+
+    widget = store.root()[u'widget']
+    assert widget.maclets[u'a'].size == 10
+
+
+@pytest.mark.parametrize('cache', [None, False])
+def test_skip_unchanged_writes(factory, cache):
+    store = factory(cache=cache)
+    root = store.root()
+    root['doc'] = Document(u'Title')
+    root['other'] = Document(u'Other')
+    transaction.commit()
+    assert store.skipped_writes == 0
+    writes = store.writes
+    tree = store.fs.hash('/')
+
+    root = store.root()
+    root['doc'].title = u'Title'  # Same value
+    transaction.commit()
+    assert store.writes == writes
+    assert store.skipped_writes == 1
+    assert store.fs.hash('/') == tree
+
+    root = store.root()
+    root['doc'].title = u'New Title'
+    store.flush()
+    root['doc'].title = u'New Title'
+    transaction.commit()
+    assert store.writes == writes + 1
+    assert store.skipped_writes == 2
+    assert store.root()['doc'].title == u'New Title'
+
+    # Removed and put back in the same place, must be written again
+    root = store.root()
+    root['doc'] = root.pop('doc')
+    transaction.commit()
+    assert store.root()['doc'].title == u'New Title'
+    assert store.writes == writes + 2
+
+
+def test_snapshot(factory, tmp):
+    store = factory()
+    assert list(store.readonly_root().keys()) == []
+
+    root = store.root()
+    root['foo'] = Site()
+    root['foo']['doc'] = doc = Document(u'Title')
+    doc.body = u'Body'
+    doc.tags = [u'a']
+    root['journal'] = Journal(u'Journal')
+    root['journal'].events.append(u'a')
+    transaction.commit()
+    commit = subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=tmp)
+
+    snapshot = store.readonly_root()
+    assert store.readonly_root() is snapshot
+    assert transaction.get()._resources == []  # Doesn't join transaction
+    doc = snapshot['foo']['doc']
+    assert doc.title == u'Title'
+    assert doc.body == u'Body'
+    assert doc.tags == [u'a']
+    assert type(doc.tags) is list  # Changes aren't tracked
+    assert list(snapshot['journal'].events) == [u'a']
+
+    with pytest.raises(TypeError):
+        doc.title = u'Changed'
+    with pytest.raises(TypeError):
+        snapshot['bar'] = Site()
+    with pytest.raises(TypeError):
+        del snapshot['foo']
+    with pytest.raises(TypeError):
+        snapshot['journal'].events.append(u'b')
+
+    root = store.root()
+    root['foo']['doc'].title = u'Changed'
+    del root['journal']
+    transaction.commit()
+
+    assert doc.title == u'Title'
+    assert 'journal' in snapshot
+    latest = store.readonly_root()
+    assert latest is not snapshot
+    assert latest['foo']['doc'].title == u'Changed'
+    assert 'journal' not in latest
+
+    old = store.snapshot(commit.strip())
+    assert old['foo']['doc'].title == u'Title'
+    assert old['journal'].title == u'Journal'
+    with pytest.raises(ValueError):
+        store.snapshot(b'0' * 40)
+
+
+def test_snapshot_threads(factory):
+    import threading
+
+    store = factory()
+    root = store.root()
+    for i in range(20):
+        root[str(i)] = Document(u'Doc {0}'.format(i))
+    transaction.commit()
+
+    snapshot = store.readonly_root()
+    results = []
+
+    def read():
+        results.append(sorted(doc.title for doc in snapshot.values()))
+
+    threads = [threading.Thread(target=read) for i in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    expected = sorted(u'Doc {0}'.format(i) for i in range(20))
+    assert results == [expected] * 4
+
+
+def test_sessions_per_thread(factory):
+    import threading
+
+    store = factory()
+    store.root()
+    transaction.commit()
+
+    barrier = threading.Barrier(2)
+    sessions = []
+    errors = []
+
+    def work(name):
+        try:
+            tx = transaction.begin()
+            tx.setUser('Test User')
+            tx.setExtendedInfo('email', 'test@example.com')
+            root = store.root()
+            sessions.append(store.session)
+            barrier.wait()
+            root[name] = Document(name)
+            barrier.wait()  # Both have made changes before either commits
+            transaction.commit()
+        except Exception as e:  # pragma no cover
+            errors.append(e)
+            barrier.abort()
+
+    threads = [threading.Thread(target=work, args=(name,))
+               for name in (u'a', u'b')]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert errors == []
+    assert sessions[0] is not sessions[1]
+    assert sorted(store.root().keys()) == [u'a', u'b']
+
+
+def test_write_fs_directly(factory):
+    store = factory()
+    store.set_root(Site())
+    transaction.commit()
+
+    root = store.root()
+    root.title = u'Changed'
+    root[u'doc'] = Document(u'Hello')
+    with store.fs.open('/other.txt', 'wb') as f:
+        f.write(b'Hi Mom!')
+    transaction.commit()
+
+    fs = AcidFS(store.fs.wd)
+    assert fs.open('/other.txt', 'rb').read() == b'Hi Mom!'
+    assert fs.exists('/doc.yaml')
+    root = factory().root()
+    assert root.title == u'Changed'
+    assert root[u'doc'].title == u'Hello'
+
+
+def test_two_stores_one_transaction(factory, tmp):
+    store = factory()
+    store.root()[u'a'] = Document(u'A')
+    other = Store(AcidFS(tmp, head='other'))
+    other.root()[u'b'] = Document(u'B')
+    transaction.commit()
+
+    assert list(factory().root().keys()) == [u'a']
+    assert list(Store(AcidFS(tmp, head='other')).root().keys()) == [u'b']
+
+
+def test_shared_decoded_objects(factory):
+    store = factory(cache=ObjectCache())
+    root = store.root()
+    root['widget'] = widget = Widget(u'Widget')
+    widget.chiclets = [u'a']
+    transaction.commit()
+
+    first = store.root()['widget']
+    transaction.abort()
+    second = store.root()['widget']
+    assert first is not second
+    # Nothing copied until a field is accessed
+    assert first.__dict__['.chiclets'] is second.__dict__['.chiclets']
+
+    second.chiclets.append(u'b')
+    assert first.__dict__['.chiclets'] == [u'a']
+    transaction.abort()
+
+    third = store.root()['widget']
+    assert third.chiclets == [u'a']
+    assert third.name == u'Widget'
+
+
+def test_snapshot_doesnt_share_decoded_values(factory):
+    store = factory(cache=ObjectCache())
+    root = store.root()
+    root['widget'] = widget = Widget(u'Widget')
+    widget.chiclets = [u'a']
+    widget.maclets = {u'a': [u'b']}
+    transaction.commit()
+
+    store.root()['widget']  # Cached
+    transaction.abort()
+    widget = store.snapshot()['widget']
+    widget.chiclets.append(u'LEAKED')
+    widget.maclets[u'a'].append(u'LEAKED')
+    transaction.abort()
+
+    widget = store.root()['widget']
+    assert widget.chiclets == [u'a']
+    assert widget.maclets == {u'a': [u'b']}
+    assert store.snapshot()['widget'].chiclets == [u'a']
+
+
+def test_lazy_field(factory):
+    store = factory()
+    root = store.root()
+    root['doc'] = doc = Document(u'Title')
+    doc.body = u'Lorem ipsum'
+    doc.tags = [u'a', u'b']
+    transaction.commit()
+
+    assert store.fs.exists('/doc/body.yaml')
+    assert 'Lorem' not in store.fs.open('/doc.yaml').read()
+
+    doc = store.root()['doc']
+    assert doc.title == u'Title'
+    assert '.body' not in doc.__dict__
+    assert doc.body == u'Lorem ipsum'
+    assert '.tags' not in doc.__dict__
+    doc.tags.append(u'c')
+    transaction.commit()
+
+    doc = store.root()['doc']
+    assert doc.body == u'Lorem ipsum'
+    assert doc.tags == [u'a', u'b', u'c']
+    assert list(store.root().keys()) == ['doc']
+
+
+def test_lazy_field_default(factory):
+    store = factory()
+    root = store.root()
+    root['doc'] = Document(u'Title')
+    transaction.commit()
+
+    assert not store.fs.exists('/doc')
+    doc = store.root()['doc']
+    assert doc.body == u''
+
+
+def test_lazy_field_folder(factory):
+    store = factory()
+    store.set_root(LazySite(u'Site'))
+    store.root().description = u'A site'
+    transaction.commit()
+
+    assert store.fs.exists('/__index__/description.yaml')
+    root = store.root()
+    assert root.description == u'A site'
+    assert list(root.keys()) == []
+
+
+def test_lazy_field_move_and_delete(factory):
+    store = factory()
+    root = store.root()
+    root['foo'] = Site()
+    root['foo']['doc'] = Document(u'Title')
+    root['foo']['doc2'] = Document(u'Title 2')
+    root['foo']['doc'].body = u'Body'
+    root['foo']['doc2'].body = u'Body 2'
+    transaction.commit()
+
+    root = store.root()
+    root['bar'] = root.pop('foo')
+    root['doc'] = root['bar'].pop('doc')
+    transaction.commit()
+
+    root = store.root()
+    assert root['doc'].body == u'Body'
+    assert root['bar']['doc2'].body == u'Body 2'
+    assert not store.fs.exists('/foo')
+    assert not store.fs.exists('/bar/doc')
+    del root['doc']
+    transaction.commit()
+
+    assert not store.fs.exists('/doc')
+    assert not store.fs.exists('/doc.yaml')
+
+
+def test_log(factory):
+    store = factory()
+    root = store.root()
+    root['journal'] = journal = Journal(u'Journal')
+    journal.events.append(u'created')
+    journal.events.extend([u'a', u'b'])
+    assert journal.events == [u'created', u'a', u'b']
+    transaction.commit()
+
+    fs = store.fs
+    assert 'created' not in fs.open('/journal.yaml').read()
+    model_oid = fs.hash('/journal.yaml')
+    assert fs.listdir('/journal/events.log') == ['00000000']
+
+    journal = store.root()['journal']
+    journal.events.append(u'c')
+    assert journal.events._entries is None  # Not loaded
+    transaction.commit()
+
+    assert fs.hash('/journal.yaml') == model_oid
+    assert fs.listdir('/journal/events.log') == ['00000000', '00000001']
+    assert yaml.safe_load(fs.open('/journal/events.log/00000001')) == [u'c']
+
+    journal = store.root()['journal']
+    assert len(journal.events) == 4
+    assert journal.events[-1] == u'c'
+    assert list(journal.events) == [u'created', u'a', u'b', u'c']
+    journal.events.append(u'd')
+    assert journal.events[-1] == u'd'
+    transaction.commit()
+
+    journal = store.root()['journal']
+    journal.events.compact()
+    transaction.commit()
+    assert fs.listdir('/journal/events.log') == ['00000000']
+    assert store.root()['journal'].events == [
+        u'created', u'a', u'b', u'c', u'd']
+
+
+def test_log_replace_move_and_delete(factory):
+    store = factory()
+    store.set_root(LogSite())
+    root = store.root()
+    root.events.append(u'created')
+    root['foo'] = Site()
+    root['foo']['journal'] = journal = Journal(u'Journal')
+    journal.events = [u'a', u'b']
+    transaction.commit()
+
+    fs = store.fs
+    assert fs.exists('/__index__/events.log/00000000')
+    root = store.root()
+    assert root.events == [u'created']
+    root['bar'] = root.pop('foo')
+    root['journal'] = journal = root['bar'].pop('journal')
+    journal.events.append(u'c')
+    transaction.commit()
+
+    root = store.root()
+    assert root['journal'].events == [u'a', u'b', u'c']
+    assert fs.listdir('/journal/events.log') == ['00000000']
+    assert not fs.exists('/foo')
+    assert not fs.exists('/bar/journal')
+    root['journal'].events = []
+    transaction.commit()
+
+    root = store.root()
+    assert root['journal'].events == []
+    assert not fs.exists('/journal/events.log')
+    root['journal'].events.append(u'd')
+    transaction.commit()
+
+    root = store.root()
+    assert root['journal'].events == [u'd']
+    del root['journal']
+    transaction.commit()
+    assert not fs.exists('/journal')
+
+
+def test_log_inline(factory):
+    store = factory()
+    root = store.root()
+    root['widget'] = widget = Widget(u'Widget')
+    widget.maclets[u'journal'] = journal = Journal(u'Nested')
+    journal.events.append(u'a')
+    transaction.commit()
+
+    # Not stored in its own file, so stored with the object containing it
+    fs = store.fs
+    assert u'- a' in fs.open('/widget.yaml').read()
+    widget = store.root()['widget']
+    assert widget.maclets[u'journal'].events == [u'a']
+    widget.maclets[u'journal'].events.append(u'b')
+    transaction.commit()
+
+    widget = store.root()['widget']
+    assert widget.maclets[u'journal'].events == [u'a', u'b']
+
+    # Entries which were stored in the object's own file are moved into
+    # segments.
+    with fs.open('/journal.yaml', 'w') as f:
+        f.write(Journal.__dumpling_tag__ + u' {title: J, events: [a]}\n')
+    transaction.commit()
+    root = store.root()
+    root['journal'].events.append(u'b')
+    transaction.commit()
+
+    assert 'events' not in fs.open('/journal.yaml').read()
+    assert store.root()['journal'].events == [u'a', u'b']
+
+
+def test_query(factory):
+    store = factory()
+    store.set_root(IndexedSite())
+    root = store.root()
+    for i, name in enumerate([u'fred', u'wilma', u'barney', u'betty']):
+        root[name] = Person(name, i * 10)
+    root[u'doc'] = Document(u'Title')
+    transaction.commit()
+    assert store.fs.exists('/__indexes__')
+
+    store = factory(cache=ObjectCache())
+    root = store.root()
+    assert [p.name for p in root.query(age=10)] == [u'wilma']
+    contents = root.__dumpling__.folder_contents
+    assert contents[u'fred'].loaded is None
+    assert contents[u'wilma'].loaded is not None
+    assert [p.name for p in root.query(range={'age': (10, 20)})] == [
+        u'barney', u'wilma']
+    assert [p.name for p in root.query(range={'age': (None, 0)})] == [
+        u'fred']
+    assert [p.name for p in root.query(range={'age': (15, None)})] == [
+        u'barney', u'betty']
+    assert [p.name for p in root.query(age=30,
+                                       range={'age': (0, 30)})] == [u'betty']
+    assert [d.title for d in root.query(title=u'Title')] == [u'Title']
+    assert list(root.query(age=5)) == []
+    assert len(list(root.query())) == 5
+
+    # Unsaved changes are reflected in queries
+    root[u'fred'].age = 10
+    del root[u'wilma']
+    root[u'pebbles'] = Person(u'pebbles', 1)
+    assert [p.name for p in root.query(age=10)] == [u'fred']
+    assert [p.name for p in root.query(range={'age': (None, 5)})] == [
+        u'pebbles']
+    transaction.commit()
+
+    store = factory(cache=ObjectCache())
+    root = store.root()
+    assert [p.name for p in root.query(age=10)] == [u'fred']
+    assert [p.name for p in root.query(range={'age': (None, 5)})] == [
+        u'pebbles']
+    assert root.__dumpling__.folder_indexes.dirty is False
+
+    with pytest.raises(ValueError):
+        root.query(color=u'blue')
+
+
+def test_query_rebuild_stale_index(factory):
+    store = factory()
+    root = store.root()
+    root[u'fred'] = Person(u'fred', 10)
+    root[u'wilma'] = Person(u'wilma', 20)
+    transaction.commit()
+
+    # Folders which don't declare indexes only get one when first queried
+    root = store.root()
+    root[u'dino'] = Person(u'dino', 3)
+    contents = root.__dumpling__.folder_contents
+    assert contents[u'fred'].loaded is None
+    transaction.commit()
+    assert not store.fs.exists('/__indexes__')
+
+    root = store.root()
+    del root[u'dino']
+    assert [p.name for p in root.query(age=20)] == [u'wilma']
+    root[u'pebbles'] = Person(u'pebbles', 1)
+    transaction.commit()
+    assert store.fs.exists('/__indexes__')
+
+    # Another child written behind the index's back
+    store.fs.open('/barney.yaml', 'wb').write(
+        store.fs.open('/fred.yaml', 'rb').read())
+    transaction.commit()
+
+    root = store.root()
+    assert [p.__name__ for p in root.query(age=10)] == [u'barney', u'fred']
+    assert [p.name for p in root.query(age=1)] == [u'pebbles']
+
+
+def test_query_moved_bigfolder(factory):
+    store = factory()
+    root = store.root()
+    root[u'people'] = people = IndexedBigSite()
+    people[u'fred'] = Person(u'fred', 10)
+    people[u'wilma'] = Person(u'wilma', 20)
+    transaction.commit()
+
+    root = store.root()
+    root[u'folks'] = root.pop(u'people')
+    transaction.commit()
+
+    root = store.root()
+    assert store.fs.exists('/folks/__indexes__')
+    assert [p.name for p in root[u'folks'].query(name=u'wilma')] == [
+        u'wilma']
+
+
+def test_search(factory):
+    store = factory(fulltext=True)
+    root = store.root()
+    root[u'site'] = site = Site(u'Bedrock news')
+    site[u'doc1'] = doc = Document(u'Fred and Wilma')
+    doc.body = u'Fred works at the quarry.  Fred likes bowling.'
+    site[u'doc2'] = doc = Document(u'Barney')
+    doc.body = u'Barney is friends with Fred.'
+    root[u'doc3'] = Document(u'Quarry news')
+    transaction.commit()
+
+    root = store.root()
+    assert root.search(u'fred') == [u'/site/doc1', u'/site/doc2']
+    assert root.search(u'FRED quarry') == [u'/site/doc1']
+    assert root.search(u'quarry') == [u'/doc3', u'/site/doc1']
+    assert root.search(u'news') == [u'/doc3', u'/site']
+    assert root[u'site'].search(u'news') == [u'/site']
+    assert root.search(u'quarry', limit=1) == [u'/doc3']
+    assert root.search(u'dino') == []
+    assert root.search(u'') == []
+
+    # Lazy fields which aren't loaded stay indexed
+    root[u'site'][u'doc1'].title = u'Fred'
+    transaction.commit()
+    root = store.root()
+    assert root.search(u'wilma') == []
+    assert root.search(u'bowling') == [u'/site/doc1']
+
+    # Removed objects aren't found, even before being saved
+    del root[u'site'][u'doc2']
+    assert root.search(u'barney') == []
+    transaction.commit()
+    assert store.root().search(u'barney') == []
+
+    root = store.root()
+    root[u'moved'] = root.pop(u'site')
+    transaction.commit()
+    root = store.root()
+    assert root.search(u'bowling') == [u'/moved/doc1']
+    assert root.search(u'bedrock') == [u'/moved']
+
+    del root[u'moved']
+    transaction.commit()
+    assert store.root().search(u'bowling') == []
+    assert store.root().search(u'news') == [u'/doc3']
+
+
+def test_search_reindex(factory):
+    store = factory()
+    root = store.root()
+    root[u'site'] = site = Site(u'Bedrock news')
+    site[u'doc1'] = doc = Document(u'Fred and Wilma')
+    doc.body = u'Fred likes bowling.'
+    transaction.commit()
+
+    store = factory(cache=ObjectCache())
+    assert reindex(store) == 3
+    transaction.commit()
+
+    store = factory(fulltext=True, cache=ObjectCache())
+    root = store.root()
+    assert root.search(u'bowling') == [u'/site/doc1']
+    assert root.search(u'news') == [u'/site']
+
+    # Stale entries are dropped
+    root[u'site'][u'doc1'].body = u'Fred likes golf.'
+    store.fulltext = False
+    transaction.commit()
+    store = factory(cache=ObjectCache())
+    assert reindex(store) == 3
+    transaction.commit()
+    root = factory(fulltext=True, cache=ObjectCache()).root()
+    assert root.search(u'bowling') == []
+    assert root.search(u'golf') == [u'/site/doc1']
+
+
+def test_search_not_enabled(factory):
+    store = factory()
+    with pytest.raises(ValueError):
+        store.root().search(u'fred')
+
+
+def test_blob_no_blobstorage(factory):
+    store = factory()
+    root = store.root()
+    root['blob'] = blob = Blob()
+    with pytest.raises(ConfigurationError):
+        blob.open('w')
+
+
+def test_blob_write_read(factory, tmp):
+    store = factory(blobstore=os.path.join(tmp, 'blobs'))
+    root = store.root()
+    root['blob'] = Blob()
+    root['blob'].open('w').write(b'Hi Mom!')
+    transaction.commit()
+
+    assert root['blob'].open().read() == b'Hi Mom!'
+    assert len(root['blob']) == 7
+
+
+def test_blob_write_from(factory, tmp):
+    testfile = os.path.join(tmp, 'testing')
+    open(testfile, 'wb').write(b'Hi Mom!')
+    store = factory(blobstore=os.path.join(tmp, 'blobs'))
+    root = store.root()
+    root['blob'] = Blob()
+    root['blob'].write_from(open(testfile, 'rb'))
+    transaction.commit()
+
+    assert root['blob'].open().read() == b'Hi Mom!'
+
+
+def test_blob_bad_mode(factory, tmp):
+    store = factory(blobstore=os.path.join(tmp, 'blobs'))
+    root = store.root()
+    root['blob'] = blob = Blob()
+    with pytest.raises(ValueError):
+        blob.open('wt')
+
+
+def test_blob_zero_copy(factory, tmp):
+    store = factory(blobstore=os.path.join(tmp, 'blobs'))
+    root = store.root()
+    root['blob'] = blob = Blob()
+    blob.write_from(io.BytesIO(b'Hi Mom!'))
+    root['empty'] = empty = Blob()
+    empty.write_from(io.BytesIO(b''))
+    transaction.commit()
+
+    mapped = blob.mmap()
+    assert mapped[:] == b'Hi Mom!'
+    mapped.close()
+    assert empty.mmap() == b''
+
+    buf = bytearray(4)
+    with blob.open('rb', buffering=0) as f:
+        assert f.readinto(buf) == 4
+    assert buf == b'Hi M'
+
+    fname = os.path.join(tmp, 'out')
+    with open(fname, 'wb') as f:
+        f.write(b'>')
+        assert blob.sendfile(f) == 7
+        assert blob.sendfile(f.fileno(), offset=3, count=2) == 2
+    assert open(fname, 'rb').read() == b'>Hi Mom!Mo'
+
+    a, b = socket.socketpair()
+    assert blob.sendfile(a, offset=1) == 6
+    a.close()
+    assert b.recv(100) == b'i Mom!'
+    b.close()
+
+
+def test_blob_sendfile_fallback(factory, tmp, monkeypatch):
+    store = factory(blobstore=os.path.join(tmp, 'blobs'))
+    root = store.root()
+    root['blob'] = blob = Blob()
+    blob.write_from(io.BytesIO(b'Hi Mom!'))
+    monkeypatch.delattr(os, 'sendfile', raising=False)
+    monkeypatch.delattr(os, 'copy_file_range', raising=False)
+
+    fname = os.path.join(tmp, 'out')
+    with open(fname, 'wb') as f:
+        assert blob.sendfile(f, offset=3) == 4
+        assert blob.sendfile(f, offset=10) == 0
+    assert open(fname, 'rb').read() == b'Mom!'
+
+
+def test_blob_import_file(factory, tmp):
+    store = factory(blobstore=os.path.join(tmp, 'blobs'))
+    src = os.path.join(tmp, 'upload')
+    open(src, 'wb').write(b'Hi Mom!')
+    root = store.root()
+    root['a'] = a = Blob()
+    a.import_file(src)
+    assert os.path.exists(src)
+    assert a.open().read() == b'Hi Mom!'
+    assert os.stat(src).st_ino != os.stat(
+        store.blobstore._path(a._location)).st_ino
+
+    # Already stored
+    root['b'] = b = Blob()
+    b.import_file(src, move=True)
+    assert not os.path.exists(src)
+    assert b._location == a._location
+
+    open(src, 'wb').write(b'Hi Dad!')
+    root['c'] = c = Blob()
+    c.import_file(src, move=True)
+    assert not os.path.exists(src)
+    transaction.commit()
+
+    assert store.root()['c'].open().read() == b'Hi Dad!'
+
+
+def test_blob_import_file_copy(factory, tmp, monkeypatch):
+    import dumpling.blob
+
+    def nope(*args):
+        raise OSError(errno.EXDEV, 'Nope')
+
+    store = factory(blobstore=os.path.join(tmp, 'blobs'))
+    src = os.path.join(tmp, 'upload')
+    open(src, 'wb').write(b'Hi Mom!')
+    root = store.root()
+    root['a'] = a = Blob()
+    monkeypatch.setattr(os, 'link', nope)
+    monkeypatch.setattr(dumpling.blob, '_reflink', lambda src, dst: False)
+    a.import_file(src)
+    assert os.path.exists(src)
+    assert a.open().read() == b'Hi Mom!'
+    assert os.stat(src).st_ino != os.stat(
+        store.blobstore._path(a._location)).st_ino
+
+
+def test_blob_import_file_link(factory, tmp):
+    store = factory(blobstore=os.path.join(tmp, 'blobs'))
+    src = os.path.join(tmp, 'upload')
+    open(src, 'wb').write(b'Hi Mom!')
+    os.utime(src, (1000, 1000))
+    root = store.root()
+    root['a'] = a = Blob()
+    a.import_file(src, link=True)
+    path = store.blobstore._path(a._location)
+    assert os.path.samefile(src, path)
+    transaction.commit()
+
+    # Linked files aren't touched, or collected while still linked
+    root = store.root()
+    del root['a']
+    root['b'] = b = Blob()
+    b.import_file(src, link=True)
+    assert os.path.samefile(src, path)
+    transaction.commit()
+    assert os.stat(src).st_mtime == 1000
+    assert store.blobstore.gc(store, min_age=0) == 0
+    assert os.path.exists(path)
+
+    # The same content written otherwise gets a file of the store's own
+    root = store.root()
+    root['c'] = c = Blob()
+    c.write_from(io.BytesIO(b'Hi Mom!'))
+    assert c._location == b._location
+    assert not os.path.samefile(src, path)
+    assert os.stat(src).st_mtime == 1000
+    open(src, 'wb').write(b'Changed')
+    assert c.open().read() == b'Hi Mom!'
+
+
+@pytest.mark.parametrize('compression', ['zlib', 'lzma'])
+def test_blob_compression(factory, tmp, compression):
+    blobs = os.path.join(tmp, 'blobs')
+    store = factory(blobstore=FileSystemBlobStore(
+        blobs, compression=compression))
+    data = b'Hi Mom! ' * 1000
+    root = store.root()
+    root['text'] = text = Blob()
+    text.write_from(io.BytesIO(data))
+    root['image'] = image = Blob()
+    image.content_type = 'image/png'
+    image.write_from(io.BytesIO(data + b'!'))
+    transaction.commit()
+
+    text = store.root()['text']
+    image = store.root()['image']
+    assert text._compression == compression
+    assert image._compression is None
+    stored = store.blobstore._path(text._location + {
+        'zlib': '.gz', 'lzma': '.xz'}[compression])
+    assert os.path.getsize(stored) < 1000
+    assert len(text) == 8000
+    assert text.open().read() == data
+    assert text.mmap() == data
+    assert image.open().read() == data + b'!'
+
+    fname = os.path.join(tmp, 'out')
+    with open(fname, 'wb') as f:
+        assert text.sendfile(f, offset=7990) == 10
+    assert open(fname, 'rb').read() == b'! Hi Mom! '
+
+    # Stored uncompressed by a store without compression
+    store.blobstore.compression = None
+    root = store.root()
+    root['again'] = again = Blob()
+    again.write_from(io.BytesIO(data))
+    assert again._compression == compression
+    assert again.open().read() == data
+
+    src = os.path.join(tmp, 'upload')
+    open(src, 'wb').write(data + b'?')
+    root['imported'] = imported = Blob()
+    imported.import_file(src)
+    assert imported._compression is None
+    store.blobstore.compression = compression
+    root['imported2'] = imported2 = Blob()
+    imported2.import_file(src, move=True)
+    assert not os.path.exists(src)
+    assert imported2._compression is None
+    transaction.commit()
+
+    store.blobstore.gc(store, min_age=0)
+    assert len(blob_files(blobs)) == 3
+
+
+def test_blob_compression_skip_types(tmp):
+    blobstore = FileSystemBlobStore(tmp, compression='zlib',
+                                    skip_types=('text/', 'application/foo'))
+    assert blobstore._compression_for(None) == 'zlib'
+    assert blobstore._compression_for('text/plain; charset=utf-8') is None
+    assert blobstore._compression_for('application/foo') is None
+    assert blobstore._compression_for('application/foobar') == 'zlib'
+    with pytest.raises(ValueError):
+        FileSystemBlobStore(tmp, compression='foo')
+
+
+@pytest.mark.parametrize('compression', [None, 'zlib'])
+def test_blob_ranges(factory, tmp, compression):
+    store = factory(blobstore=FileSystemBlobStore(
+        os.path.join(tmp, 'blobs'), compression=compression))
+    data = bytes(bytearray(range(256))) * 4
+    root = store.root()
+    root['blob'] = blob = Blob()
+    blob.write_from(io.BytesIO(data))
+    transaction.commit()
+
+    blob = store.root()['blob']
+    assert blob.read_range(10, 5) == data[10:15]
+    assert blob.read_range(1020, 10) == data[1020:]
+    assert blob.read_range(1000) == data[1000:]
+    assert blob.read_range(2000, 10) == b''
+    assert list(blob.iter_chunks(400)) == [
+        data[:400], data[400:800], data[800:]]
+    assert list(blob.iter_chunks(100, 250, 420)) == [
+        data[250:350], data[350:420]]
+    assert list(blob.iter_chunks(100, 2000)) == []
+
+
+@pytest.mark.parametrize('algorithm', ['sha1', 'sha256', 'blake2b'])
+def test_blob_put_many(factory, tmp, algorithm):
+    blobstore = FileSystemBlobStore(
+        os.path.join(tmp, 'blobs'), algorithm=algorithm)
+    blobstore.io_workers = 2
+    store = factory(blobstore=blobstore)
+    datas = [u'Blob {0}'.format(i).encode('ascii') * i for i in range(10)]
+    blobs = blobstore.put_many(io.BytesIO(data) for data in datas)
+    root = store.root()
+    for i, blob in enumerate(blobs):
+        root[str(i)] = blob
+    transaction.commit()
+
+    root = store.root()
+    for i, data in enumerate(datas):
+        blob = root[str(i)]
+        assert blob._location == hashlib.new(algorithm, data).hexdigest()
+        with blob.open() as f:
+            assert f.read() == data
+
+    src = os.path.join(tmp, 'upload')
+    with open(src, 'wb') as f:
+        f.write(datas[3])
+    root['imported'] = blob = Blob()
+    blob.import_file(src)
+    assert blob._location == root['3']._location
+
+
+def test_blob_put_many_error(tmp):
+    class Broken(object):
+        def read(self, size):
+            raise IOError('Broken')
+
+    blobstore = FileSystemBlobStore(os.path.join(tmp, 'blobs'))
+    with pytest.raises(IOError):
+        blobstore.put_many([io.BytesIO(b'ok'), Broken()])
+
+
+def test_blob_unsupported_hash(tmp):
+    with pytest.raises(ValueError):
+        FileSystemBlobStore(os.path.join(tmp, 'blobs'), algorithm='foo')
+
+
+def test_blob_legacy_size(factory, tmp):
+    store = factory(blobstore=os.path.join(tmp, 'blobs'))
+    root = store.root()
+    root['blob'] = blob = Blob()
+    blob.write_from(io.BytesIO(b'Hi Mom!'))
+    del blob.__dict__['._size']
+    transaction.commit()
+    assert '_size' not in store.fs.open('/blob.yaml').read()
+
+    blob = store.root()['blob']
+    assert len(blob) == 7
+    os.remove(store.blobstore._path(blob._location))
+    assert len(blob) == 7  # No stat
+
+
+def test_blob_dedup(factory, tmp):
+    blobs = os.path.join(tmp, 'blobs')
+    store = factory(blobstore=blobs)
+    root = store.root()
+    root['a'] = Blob()
+    root['a'].open('w').write(b'Hi Mom!')
+    path = store.blobstore._path(root['a']._location)
+    assert path == os.path.join(blobs, path[-40:-38], path[-38:-36],
+                                path[-40:])
+    os.utime(path, (0, 0))
+    root['b'] = Blob()
+    root['b'].open('w').write(b'Hi Mom!')
+    transaction.commit()
+
+    assert root['a']._location == root['b']._location
+    assert blob_files(blobs) == [root['a']._location]
+    assert os.stat(path).st_mtime > 0
+
+
+def test_blob_gc(factory, tmp):
+    blobs = os.path.join(tmp, 'blobs')
+    store = factory(blobstore=blobs)
+    assert store.blobstore.gc(store, min_age=0) == 0
+
+    root = store.root()
+    root['a'] = Blob()
+    root['a'].open('w').write(b'Hi Mom!')
+    root['b'] = Blob()
+    root['b'].open('w').write(b'Hi Dad!!')
+    root['widget'] = widget = Widget(u'Hi Dee Ho!')
+    widget.chiclets.append(Blob())
+    transaction.commit()
+    blob = store.root()['widget'].chiclets[0]
+    blob.open('w').write(b'Nested')
+    transaction.commit()
+
+    root = store.root()
+    old = root['b']._location
+    del root['b']
+    transaction.commit()
+
+    assert store.blobstore.gc(store, history=False) == 0
+    assert store.blobstore.gc(store, min_age=0) == 0
+    assert store.blobstore.gc(store, history=False, min_age=0) == 8
+    assert old not in blob_files(blobs)
+    assert len(blob_files(blobs)) == 2
+
+    root = store.root()
+    assert root['a'].open().read() == b'Hi Mom!'
+    assert root['widget'].chiclets[0].open().read() == b'Nested'
+
+
+def test_blob_gc_branch(factory, tmp):
+    blobs = os.path.join(tmp, 'blobs')
+    store = factory(blobstore=blobs)
+    root = store.root()
+    root['a'] = a = Blob()
+    a.write_from(io.BytesIO(b'Hi Mom!'))
+    transaction.commit()
+
+    branch = Store(AcidFS(tmp, head='other'), blobstore=blobs)
+    assert branch.blobstore.gc(branch, history=False, min_age=0) == 0
+    root = branch.root()
+    root['b'] = b = Blob()
+    b.write_from(io.BytesIO(b'Hi Dad!!'))
+    transaction.commit()
+
+    # Only the branch's own head is searched
+    assert branch.blobstore.gc(branch, history=False, min_age=0) == 7
+    assert branch.root()['b'].open().read() == b'Hi Dad!!'
+
+
+def test_blob_migrate_flat(factory, tmp):
+    blobs = os.path.join(tmp, 'blobs')
+    store = factory(blobstore=FileSystemBlobStore(blobs, fanout=()))
+    root = store.root()
+    root['a'] = Blob()
+    root['a'].open('w').write(b'Hi Mom!')
+    transaction.commit()
+    digest = root['a']._location
+    assert os.listdir(blobs) == [digest]
+
+    # Flat blobs can still be found in a sharded store
+    store = factory(blobstore=FileSystemBlobStore(blobs, fanout=(2,)))
+    root = store.root()
+    assert root['a'].open().read() == b'Hi Mom!'
+    assert len(root['a']) == 7
+    root['b'] = Blob()
+    root['b'].open('w').write(b'Hi Mom!')
+    assert os.listdir(blobs) == [digest]
+
+    assert store.blobstore.migrate() == 1
+    assert os.listdir(blobs) == [digest[:2]]
+    assert root['a'].open().read() == b'Hi Mom!'
+
+    store.blobstore.fanout = (1, 3)
+    assert store.blobstore.migrate() == 1
+    assert os.listdir(blobs) == [digest[:1]]
+    assert root['a'].open().read() == b'Hi Mom!'
+    assert store.blobstore.migrate() == 0
+
+
+def blob_files(path):
+    return [fname for dirpath, dirnames, filenames in os.walk(path)
+            for fname in filenames if not fname.startswith('.')]
+
+
+def test_parallel_save(factory):
+    store = factory(save_workers=2, save_threshold=5)
+    root = store.root()
+    for i in range(10):
+        root['{0:d}'.format(i)] = Sprocket(size=i)
+    transaction.commit()
+
+    root = store.root()
+    assert sorted(root[key].size for key in root.keys()) == list(range(10))
+
+
+def test_parallel_save_threshold(factory):
+    store = factory(save_threshold=3)
+    store._save_executor = executor = DummyExecutor()
+    root = store.root()
+    root['a'] = Sprocket(size=1)
+    transaction.commit()
+    assert executor.calls == 0
+
+    root = store.root()
+    root['b'] = Sprocket(size=2)
+    root['c'] = Sprocket(size=3)
+    root['d'] = Sprocket(size=4)
+    transaction.commit()
+    assert executor.calls == 1
+
+    root = store.root()
+    assert [root[key].size for key in 'abcd'] == [1, 2, 3, 4]
+
+
+def test_folder_keys(factory):
+    store = factory()
+    root = store.root()
+    for i in range(8, 13):
+        root['{0:d}'.format(i)] = Sprocket()
+    assert set(root.keys()) == set(('8', '9', '10', '11', '12'))
+
+
+def test_folder_keys_sorted(factory):
+    store = factory()
+    root = store.root()
+    root.sort_key = lambda x: x
+    for i in range(8, 13):
+        root['{0:d}'.format(i)] = Sprocket()
+    assert root.keys() == ['10', '11', '12', '8', '9']
+
+
+def test_folder_keys_sorted_int(factory):
+    store = factory()
+    root = store.root()
+    root.sort_key = int
+    for i in range(8, 13):
+        root['{0:d}'.format(i)] = Sprocket()
+    assert root.keys() == ['8', '9', '10', '11', '12']
+
+
+def test_folder_keys_sorted_persisted(factory):
     store = factory()
     root = store.root()
-    root[u'widget'] = widget = Widget(u'Hi Dee Ho!')
-    widget.chiclets[:] = range(10)
+    root['sorted'] = folder = SortedSite()
+    for i in range(8, 13):
+        folder['{0:d}'.format(i)] = Sprocket()
+    assert folder.keys() == ['8', '9', '10', '11', '12']
     transaction.commit()
-
-    widget = store.root()[u'widget']
-    assert widget.chiclets == list(range(10))
-    widget.chiclets[5] = 42
+    assert store.fs.exists('/sorted/__order__')
+
+    folder = store.root()['sorted']
+    folder.calls = 0
+    assert folder.keys() == ['8', '9', '10', '11', '12']
+    assert folder.calls == 0
+
+    del folder['10']
+    folder['7'] = Sprocket()
+    folder['11'].size = 11
+    assert folder.keys() == ['7', '8', '9', '11', '12']
+    # '7' and '11', which changed, and the children visited by a binary
+    # search to place '7'
+    assert folder.calls == 6
     transaction.commit()
 
-    widget = store.root()[u'widget']
-    assert widget.chiclets[5] == 42
+    folder = store.root()['sorted']
+    folder.calls = 0
+    assert folder.keys() == ['7', '8', '9', '11', '12']
+    assert folder.calls == 0
 
 
-def test_list_of_persistent(factory):
+def test_folder_keys_sorted_stale(factory):
     store = factory()
     root = store.root()
-    root[u'widget'] = widget = Widget(u'Hi Dee Ho!')
-    widget.chiclets = [Sprocket(), Sprocket(), Sprocket()]
+    root['sorted'] = folder = SortedSite()
+    for i in range(8, 13):
+        folder['{0:d}'.format(i)] = Sprocket()
     transaction.commit()
 
-    widget = store.root()[u'widget']
-    widget.chiclets[1].spin = 42
+    # Change the folder without a sort key, leaving the order stale
+    folder = store.root()['sorted']
+    folder.sort_key = None
+    del folder['10']
+    assert set(folder.keys()) == set(['8', '9', '11', '12'])
     transaction.commit()
 
-    widget = store.root()[u'widget']
-    assert widget.chiclets[1].spin == 42
+    folder = store.root()['sorted']
+    assert folder.keys() == ['8', '9', '11', '12']
 
 
-def test_persistent_dict(factory):
+def test_folder_keys_sorted_unserializable(factory):
+    import decimal
+
     store = factory()
     root = store.root()
-    root[u'widget'] = widget = Widget(u'Hi Dee Ho!')
-    widget.maclets.update(((u'a', 1), (u'b', 2), (u'c', 3)))
+    root['sorted'] = folder = Site()
+    folder.sort_key = lambda name: decimal.Decimal(name)
+    for i in range(8, 13):
+        folder['{0:d}'.format(i)] = Sprocket()
     transaction.commit()
 
-    widget = store.root()[u'widget']
-    assert widget.maclets[u'b'] == 2
-    widget.maclets[u'b'] = 42
+    folder = store.root()['sorted']
+    folder.sort_key = lambda name: decimal.Decimal(name)
+    assert folder.keys() == ['8', '9', '10', '11', '12']
+
+
+def test_folder_keys_sorted_unversioned(factory):
+    store = factory()
+    root = store.root()
+    root.sort_key = lambda x: x
+    for i in range(8, 13):
+        root['{0:d}'.format(i)] = Sprocket()
     transaction.commit()
+    assert not store.fs.exists('/__order__')
 
-    widget = store.root()[u'widget']
-    assert widget.maclets[u'b'] == 42
+    root = store.root()
+    root.sort_key = lambda x: int(x)
+    assert root.keys() == ['8', '9', '10', '11', '12']
 
 
-def test_dict_of_persistent(factory):
+def test_folder_keys_sorted_version(factory):
     store = factory()
     root = store.root()
-    root[u'widget'] = widget = Widget(u'Hi Dee Ho!')
-    widget.maclets = {u'a': Sprocket()}
+    root['sorted'] = folder = SortedSite()
+    for i in range(8, 13):
+        folder['{0:d}'.format(i)] = Sprocket()
     transaction.commit()
 
-    widget = store.root()[u'widget']
-    widget.maclets[u'a'].size = 10
-    transaction.commit()
+    # Sorted differently, but saved order is used until the version changes
+    folder = store.root()['sorted']
+    folder.sort_key = lambda x: x
+    assert folder.keys() == ['8', '9', '10', '11', '12']
+    folder.sort_version = 2
+    assert folder.keys() == ['10', '11', '12', '8', '9']
 
-    widget = store.root()[u'widget']
-    assert widget.maclets[u'a'].size == 10
 
+def test_folder_keys_sorted_changed_child(factory):
+    @folder
+    class BySize(object):
+        def sort_key(self, name):
+            return self[name].size
 
-def test_blob_no_blobstorage(factory):
     store = factory()
     root = store.root()
-    root['blob'] = blob = Blob()
-    with pytest.raises(ConfigurationError):
-        blob.open('w')
+    root['sorted'] = sized = BySize()
+    for i in range(3):
+        sized[str(i)] = Sprocket(size=i)
+    transaction.commit()
 
+    sized = store.root()['sorted']
+    assert sized.keys() == ['0', '1', '2']
+    sized['0'].size = 5
+    assert sized.keys() == ['1', '2', '0']
 
-def test_blob_write_read(factory, tmp):
-    store = factory(blobstore=os.path.join(tmp, 'blobs'))
+
+def test_folder_keys_sorted_checked_once(factory, monkeypatch):
+    import dumpling
+
+    store = factory(cache=ObjectCache())
     root = store.root()
-    root['blob'] = Blob()
-    root['blob'].open('w').write(b'Hi Mom!')
+    root['sorted'] = folder = SortedSite()
+    for i in range(8, 13):
+        folder['{0:d}'.format(i)] = Sprocket()
     transaction.commit()
 
-    assert root['blob'].open().read() == b'Hi Mom!'
-    assert len(root['blob']) == 7
+    listed = []
+    list_folder = dumpling._list_folder
 
+    def counting(session, path):
+        listed.append(path)
+        return list_folder(session, path)
 
-def test_blob_write_from(factory, tmp):
-    testfile = os.path.join(tmp, 'testing')
-    open(testfile, 'wb').write(b'Hi Mom!')
-    store = factory(blobstore=os.path.join(tmp, 'blobs'))
-    root = store.root()
-    root['blob'] = Blob()
-    root['blob'].write_from(open(testfile, 'rb'))
-    transaction.commit()
+    monkeypatch.setattr(dumpling, '_list_folder', counting)
+    assert store.root()['sorted'].keys() == ['8', '9', '10', '11', '12']
+    assert listed.count('/sorted') == 1
+    transaction.abort()
 
-    assert root['blob'].open().read() == b'Hi Mom!'
+    # Same version of the folder, so the order isn't checked again
+    assert store.root()['sorted'].keys() == ['8', '9', '10', '11', '12']
+    assert listed.count('/sorted') == 1
 
 
-def test_blob_bad_mode(factory, tmp):
-    store = factory(blobstore=os.path.join(tmp, 'blobs'))
-    root = store.root()
-    root['blob'] = blob = Blob()
-    with pytest.raises(ValueError):
-        blob.open('wt')
+def test_folder_keys_sorted_by_contents(factory):
+    @folder
+    class BySize(object):
+        sort_version = 1
 
+        def sort_key(self, name):
+            return self[name].size
 
-def test_folder_keys(factory):
     store = factory()
     root = store.root()
-    for i in range(8, 13):
-        root['{0:d}'.format(i)] = Sprocket()
-    assert set(root.keys()) == set(('8', '9', '10', '11', '12'))
+    root['sorted'] = sized = BySize()
+    for i in range(10):
+        sized[str(i)] = Sprocket(size=i)
+    transaction.commit()
 
+    sized = store.root()['sorted']
+    for name, size in (('0', 15), ('9', -1), ('4', 7), ('7', 4)):
+        sized[name].size = size
+    transaction.commit()
 
-def test_folder_keys_sorted(factory):
-    store = factory()
-    root = store.root()
-    root.sort_key = lambda x: x
-    for i in range(8, 13):
-        root['{0:d}'.format(i)] = Sprocket()
-    assert root.keys() == ['10', '11', '12', '8', '9']
+    expected = ['9', '1', '2', '3', '7', '5', '6', '4', '8', '0']
+    assert store.root()['sorted'].keys() == expected
+    assert store.fs.open('/sorted/__order__').read().count('\n- ') == 10
 
 
-def test_folder_keys_sorted_int(factory):
+def test_folder_keys_paged(factory):
     store = factory()
     root = store.root()
-    root.sort_key = int
+    root['sorted'] = folder = SortedSite()
+    root['unsorted'] = unsorted = Site()
     for i in range(8, 13):
-        root['{0:d}'.format(i)] = Sprocket()
-    assert root.keys() == ['8', '9', '10', '11', '12']
+        folder['{0:d}'.format(i)] = Sprocket(size=i)
+        unsorted['{0:d}'.format(i)] = Sprocket(size=i)
+    transaction.commit()
+
+    folder = store.root()['sorted']
+    assert folder.keys(limit=2) == ['8', '9']
+    assert folder.keys('9', 2) == ['9', '10']
+    assert folder.keys('11') == ['11', '12']
+    assert [v.size for v in folder.values('10', 1)] == [10]
+    assert [k for k, v in folder.items('12', 5)] == ['12']
+    with pytest.raises(KeyError):
+        folder.keys('nope')
+
+    unsorted = store.root()['unsorted']
+    keys = unsorted.keys()
+    assert unsorted.keys(keys[1], 2) == keys[1:3]
+    with pytest.raises(KeyError):
+        unsorted.keys('nope')
 
 
 def test_folder_iter(factory):
@@ -303,6 +1707,60 @@ def test_folder_items(factory):
         [('8', 8), ('9', 9), ('10', 10), ('11', 11), ('12', 12)])
 
 
+def test_folder_prefetch(factory):
+    store = factory(cache=False)
+    root = store.root()
+    for i in range(8, 13):
+        root['{0:d}'.format(i)] = Sprocket(size=i)
+    root['sub'] = Site(u'Sub')
+    root['sub']['foo'] = Sprocket(size=42)
+    transaction.commit()
+
+    root = store.root()
+    root.prefetch(['8', '9', 'sub', 'nope'])
+    contents = root.__dumpling__.folder_contents
+    assert contents['8'].loaded.size == 8
+    assert contents['9'].loaded.size == 9
+    assert contents['sub'].loaded.title == u'Sub'
+    assert contents['10'].loaded is None
+    assert root['sub']['foo'].size == 42
+
+    root.sort_key = lambda name: (name == 'sub', int(name) if name != 'sub'
+                                  else 0)
+    values = list(root.values(prefetch=True))
+    assert [v.size for v in values[:-1]] == [8, 9, 10, 11, 12]
+    assert values[-1].title == u'Sub'
+    root['8'].size = 80
+    transaction.commit()
+
+    assert store.root()['8'].size == 80
+
+
+def test_folder_prefetch_executor(factory):
+    store = factory(cache=ObjectCache())
+    root = store.root()
+    root.sort_key = int
+    for i in range(8, 13):
+        root['{0:d}'.format(i)] = Sprocket(size=i)
+    transaction.commit()
+
+    root = store.root()
+    root['9']
+    root.sort_key = int
+    executor = DummyExecutor()
+    items = list(root.items(prefetch=True, executor=executor))
+    assert [(k, v.size) for k, v in items] == [
+        ('8', 8), ('9', 9), ('10', 10), ('11', 11), ('12', 12)]
+    assert executor.calls == 1
+    transaction.abort()
+
+    root = store.root()
+    root.prefetch()
+    assert root['12'].size == 12
+    # root, listing and 5 children
+    assert store.cache.hits == 7
+
+
 def test_folder_contains(factory):
     store = factory()
     root = store.root()
@@ -331,6 +1789,89 @@ def test_folder_delete(factory):
     assert '9' not in store.root()
 
 
+def test_set_folder_dirty(factory):
+    store = factory()
+    root = store.root()
+    root[u'site'] = Site()
+    root[u'site'][u'doc'] = Document(u'Title')
+    transaction.commit()
+
+    # Without a name, every loaded child is saved
+    root = store.root()
+    site = root[u'site']
+    site[u'doc']
+    set_folder_dirty(site)
+    assert site.__dumpling__.dirty_children == set([u'doc'])
+    assert root.__dumpling__.dirty_children == set([u'site'])
+
+    set_folder_dirty(site, u'other')
+    assert site.__dumpling__.dirty_children == set([u'doc', u'other'])
+
+
+def test_folder_delete_unsaved(factory):
+    store = factory()
+    root = store.root()
+    root['a'] = Sprocket(size=1)
+    root['b'] = Site()
+    transaction.commit()
+
+    root = store.root()
+    root['a'] = Sprocket(size=2)
+    root['c'] = Sprocket(size=3)
+    root['b'] = Sprocket(size=4)
+    del root['a']
+    del root['b']
+    del root['c']
+    transaction.commit()
+
+    root = store.root()
+    assert list(root.keys()) == []
+
+
+def test_flush_only_visits_dirty(factory):
+    store = factory()
+    root = store.root()
+    for i in range(5):
+        root['{0:d}'.format(i)] = Site()
+        root['{0:d}'.format(i)]['foo'] = Sprocket(size=i)
+    transaction.commit()
+
+    root = store.root()
+    root['3']['foo'].size = 30
+    assert root.__dumpling__.dirty_children == set(['3'])
+    assert root['3'].__dumpling__.dirty_children == set(['foo'])
+    store.flush()
+    assert not root.__dumpling__.dirty_children
+    assert not root['3'].__dumpling__.dirty_children
+
+    # Nothing to do
+    store.flush()
+    transaction.commit()
+
+    assert store.root()['3']['foo'].size == 30
+
+
+def test_move_then_read_after_flush(factory):
+    store = factory()
+    root = store.root()
+    root['foo'] = Site()
+    root['foo']['a'] = Sprocket(size=1)
+    root['foo']['b'] = Sprocket(size=2)
+    transaction.commit()
+
+    root = store.root()
+    root['bar'] = root.pop('foo')
+    store.flush()
+    assert root['bar']['a'].size == 1
+    root['bar']['b'].size = 20
+    transaction.commit()
+
+    root = store.root()
+    assert 'foo' not in root
+    assert root['bar']['a'].size == 1
+    assert root['bar']['b'].size == 20
+
+
 def test_folder_delete_subfolder(factory):
     store = factory()
     root = store.root()
@@ -532,6 +2073,152 @@ def test_move_dirty_subtree_using_pop_add(factory):
     assert root['foo']['four']['h'].size == 8
 
 
+def test_delete_folder_moved_from(factory):
+    # Deletions are saved after moves, since a folder may be moved out of an
+    # entry which is deleted, and whose name sorts first, in the same
+    # transaction.
+    store = factory()
+    root = store.root()
+    root['a'] = Site()
+    root['a']['x'] = Sprocket(size=1)
+    root['a']['sub'] = Site()
+    root['a']['sub']['y'] = Sprocket(size=2)
+    transaction.commit()
+
+    root = store.root()
+    root['z'] = root.pop('a')
+    root['z']['x'].size = 10
+    transaction.commit()
+
+    root = store.root()
+    assert list(root.keys()) == ['z']
+    assert root['z']['x'].size == 10
+    assert root['z']['sub']['y'].size == 2
+    assert not store.fs.exists('/a')
+
+
+def test_bigfolder(factory):
+    store = factory()
+    root = store.root()
+    root['big'] = big = BigSite()
+    for i in range(10, 30):
+        big['{0:d}'.format(i)] = Sprocket(size=i)
+    big['sub'] = Site()
+    big['sub']['foo'] = Sprocket()
+    assert len(big) == 21
+    transaction.commit()
+
+    big = store.root()['big']
+    assert len(big) == 21
+    assert big.keys()[:3] == ['10', '11', '12']
+    assert big.keys(start='15', limit=2) == ['15', '16']
+    assert big.keys(start='145', limit=2) == ['15', '16']
+    assert [v.size for v in big.values(limit=2, prefetch=True)] == [10, 11]
+    assert [k for k, v in big.items(start='sub')] == ['sub']
+    assert list(big)[-1] == 'sub'
+    assert big['12'].size == 12
+    assert 'sub' in big
+    assert '9' not in big
+    with pytest.raises(KeyError):
+        big['9']
+    assert big['sub']['foo'].size == 5
+
+    path = big['12'].__dumpling__.path
+    assert path.startswith('/big/')
+    assert len(path.split('/')) == 4
+    assert store.fs.exists(path + '.yaml')
+    assert not store.fs.exists('/big/12.yaml')
+    assert not store.fs.exists('/big/sub')
+
+    del big['12']
+    big['sub'] = Sprocket(size=42)
+    transaction.commit()
+
+    big = store.root()['big']
+    assert len(big) == 20
+    assert '12' not in big
+    assert big['sub'].size == 42
+    assert not store.fs.exists(path + '.yaml')
+
+
+def test_bigfolder_pages(factory, monkeypatch):
+    import dumpling
+    monkeypatch.setattr(dumpling._KeyTree, 'page_size', 4)
+    store = factory()
+    root = store.root()
+    root['big'] = big = BigSite()
+    names = [u'{0:03d}'.format(i) for i in range(100)]
+    for name in names:
+        big[name] = Sprocket(size=int(name))
+    big[u'sub'] = Site()
+    transaction.commit()
+
+    def tree():
+        return dumpling._folder_contents(store.root()['big']).tree
+
+    # Only the pages on the way to a leaf are read
+    big = store.root()['big']
+    assert len(big) == 101
+    assert len(tree().pages) == 1
+    assert big['042'].size == 42
+    depth = len(tree().pages)
+    assert 3 < depth < 10
+    assert big.keys(start=u'0425', limit=3) == [u'043', u'044', u'045']
+    assert big[u'sub'].title == u'Test Site'
+
+    # Only the pages which change are written
+    big['0425'] = Sprocket(size=1)
+    transaction.commit()
+    assert len(tree().dirty) == 0
+    big = store.root()['big']
+    assert big.keys(start=u'042', limit=3) == [u'042', u'0425', u'043']
+
+    for name in names[10:]:
+        del big[name]
+    transaction.commit()
+    big = store.root()['big']
+    assert len(big) == 12
+    assert list(big) == names[:10] + [u'0425', u'sub']
+    assert isinstance(big[u'sub'], Site)
+    assert len(store.fs.listdir('/big/__keys__')) < 10
+
+    for name in list(big):
+        del big[name]
+    transaction.commit()
+    big = store.root()['big']
+    assert len(big) == 0
+    assert list(big) == []
+    assert store.fs.listdir('/big/__keys__') == ['0']
+
+
+def test_move_bigfolder(factory):
+    store = factory()
+    root = store.root()
+    root['foo'] = big = BigSite()
+    big['a'] = Sprocket(size=1)
+    big['b'] = Site()
+    big['b']['c'] = Sprocket(size=3)
+    transaction.commit()
+
+    root = store.root()
+    root['bar'] = root.pop('foo')
+    transaction.commit()
+
+    root = store.root()
+    assert 'foo' not in root
+    assert root['bar'].keys() == ['a', 'b']
+    assert root['bar']['a'].size == 1
+    assert root['bar']['b']['c'].size == 3
+
+
+class DummyExecutor(object):
+    calls = 0
+
+    def map(self, fn, *iterables):
+        self.calls += 1
+        return map(fn, *iterables)
+
+
 @folder
 class Site(object):
     title = Field(string_type)
@@ -540,6 +2227,74 @@ class Site(object):
         self.title = title
 
 
+@folder
+class SortedSite(object):
+    calls = 0
+    sort_version = 1
+
+    def sort_key(self, name):
+        self.calls += 1
+        return int(name)
+
+
+@folder
+class LazySite(object):
+    title = Field(string_type)
+    description = Field(string_type, default=u'', lazy=True)
+
+    def __init__(self, title):
+        self.title = title
+
+
+@model
+class Document(object):
+    title = Field(string_type)
+    body = Field(string_type, default=u'', lazy=True)
+    tags = Field(list, default=list, lazy=True)
+
+    def __init__(self, title):
+        self.title = title
+
+
+@model
+class Journal(object):
+    title = Field(string_type)
+    events = Field(log=True)
+
+    def __init__(self, title):
+        self.title = title
+
+
+@folder
+class LogSite(object):
+    events = Field(log=True)
+
+
+@bigfolder
+class BigSite(object):
+    pass
+
+
+@folder(indexes=['title'])
+class IndexedSite(object):
+    pass
+
+
+@bigfolder(indexes=['name'])
+class IndexedBigSite(object):
+    pass
+
+
+@model
+class Person(object):
+    name = Field(string_type)
+    age = Field(int, index=True)
+
+    def __init__(self, name, age):
+        self.name = name
+        self.age = age
+
+
 @model
 class Sprocket(object):
     size = Field(int, default=5)
@@ -559,3 +2314,12 @@ class Widget(object):
 
     def __init__(self, name):
         self.name = name
+
+
+@model
+class Gadget(object):
+    __dumpling_format__ = 'json'
+    name = Field(string_type)
+
+    def __init__(self, name):
+        self.name = name